@@ -0,0 +1,244 @@
+"""Benchmarks of the generation pipeline.
+
+Runs Wafer over a matrix of wafer sizes, partitions, structures and
+distance/radius values. Each case runs in its own process and reports
+structures per second, time per phase, peak memory and output file size.
+Results are saved as JSON so runs can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+The results can also calibrate the runtime and memory models of the
+estimate module with --calibration.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError as error:
+    resource = None
+
+import numpy
+import gdspy
+
+from wafer import Wafer
+from observers import Recorder
+from estimate import calibrate
+
+DEFAULT_PARTITIONS = [(1, 1), (3, 3)]
+
+# (distance, radius) in microns
+DEFAULT_PITCHES = [(1000, 250), (400, 100)]
+
+# Cases slower than the baseline by more than this fraction are regressions
+DEFAULT_THRESHOLD = 0.2
+
+# Differences below this many seconds are considered noise
+MIN_DIFFERENCE = 0.05
+
+
+def _peak_memory():
+    """Peak resident memory of this process in bytes, None if unknown."""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(case):
+    """Runs one case of the benchmark.
+
+    The time of every phase is the one reported by generate_setups to
+    its observer, see the observers module.
+
+    Args:
+        case: dictionary with size, rows, cols, structure, distance,
+              radius, hierarchical and directory.
+
+    Returns:
+        The case with its measures, or with an error message.
+    """
+    result = dict(case)
+    filename = os.path.join(case['directory'], 'benchmark')
+    try:
+        wafer = Wafer(case['size'], case.get('margin', 5), hierarchical=case['hierarchical'])
+        wafer.partition(case['rows'], case['cols'])
+        for section in range(1, wafer.num_sections + 1):
+            wafer.add_setup(case['distance'], case['radius'], case['structure'], section)
+
+        recorder = Recorder()
+        wafer.generate_setups(filename, observer=recorder)
+
+        totals = recorder.totals()
+        phases = dict((phase, total['seconds']) for phase, total in totals.items())
+        structures = totals['emit']['structures'] if 'emit' in totals else 0
+        vertices = totals['emit']['vertices'] if 'emit' in totals else 0
+
+        total = recorder.wall_time()
+        result.update({'phases': phases,
+                       'seconds': total,
+                       'structures': structures,
+                       'polygon_vertices': vertices,
+                       'structures_per_second': structures / total if total > 0 else None,
+                       'file_size': totals['write']['bytes'],
+                       'peak_memory': _peak_memory()})
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+
+    del result['directory']
+    return result
+
+
+def cases(sizes, partitions, structures, pitches, hierarchical):
+    """Builds the matrix of cases."""
+    for size in sizes:
+        for rows, cols in partitions:
+            for structure in structures:
+                for distance, radius in pitches:
+                    # Grids and lines use the radius as the thickness of the walls
+                    yield {'size': size,
+                           'rows': rows,
+                           'cols': cols,
+                           'structure': structure,
+                           'distance': distance,
+                           'radius': radius,
+                           'hierarchical': hierarchical}
+
+
+def run(case_list):
+    """Runs every case in a fresh process so peak memory is measured per case."""
+    directory = tempfile.mkdtemp(prefix='wafer-benchmark-')
+    results = []
+    try:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            for case in case_list:
+                case = dict(case, directory=directory)
+                result = pool.apply(run_case, (case,))
+                results.append(result)
+                _print_result(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def case_key(result):
+    """Identifies a case to compare it between runs."""
+    return (result['size'], result['rows'], result['cols'], result['structure'],
+            result['distance'], result['radius'], result['hierarchical'])
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Finds the cases that got slower than in a baseline run.
+
+    Args:
+        results: results of this run.
+        baseline: results of a previous run.
+        threshold: allowed slowdown as a fraction of the baseline time.
+
+    Returns:
+        List of (result, baseline_result) pairs that regressed.
+    """
+    previous = dict((case_key(result), result) for result in baseline if 'error' not in result)
+
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None or 'error' in result:
+            continue
+        if result['seconds'] > old['seconds'] * (1 + threshold) and \
+                result['seconds'] - old['seconds'] > MIN_DIFFERENCE:
+            regressions.append((result, old))
+    return regressions
+
+
+def _describe(result):
+    return "{0}mm {1}x{2} {3} d={4} r={5}".format(result['size'], result['rows'], result['cols'],
+                                                  result['structure'], result['distance'], result['radius'])
+
+
+def _print_result(result):
+    if 'error' in result:
+        print("{0:<40} {1}".format(_describe(result), result['error']))
+    else:
+        memory = result['peak_memory'] / 2.0 ** 20 if result['peak_memory'] else 0
+        print("{0:<40} {1:>10} structures {2:>8.2f} s {3:>12.0f} /s {4:>8.1f} MB {5:>10.1f} MB file".format(
+            _describe(result), result['structures'], result['seconds'],
+            result['structures_per_second'] or 0, memory, result['file_size'] / 2.0 ** 20))
+    sys.stdout.flush()
+
+
+def _pairs(text):
+    return [tuple(float(value) if '.' in value else int(value) for value in pair.replace('x', ':').split(':'))
+            for pair in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the generation pipeline.")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in Wafer.SIZES),
+                        help="wafer sizes in mm (default all)")
+    parser.add_argument('--partitions', default=','.join('{0}x{1}'.format(*p) for p in DEFAULT_PARTITIONS),
+                        help="rows x cols of each partition, e.g. 1x1,3x3")
+    parser.add_argument('--structures', default=','.join(Wafer.STRUCTURES),
+                        help="structures to generate (default all)")
+    parser.add_argument('--pitches', default=','.join('{0}:{1}'.format(*p) for p in DEFAULT_PITCHES),
+                        help="distance:radius pairs in microns, e.g. 400:100,200:50")
+    parser.add_argument('--hierarchical', action='store_true', help="write pillars as arrays of references")
+    parser.add_argument('--output', default=None, help="save the results to this JSON file")
+    parser.add_argument('--calibration', default=None,
+                        help="save the runtime and memory models of estimate.py fitted to this run to this JSON file")
+    parser.add_argument('--compare', default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown against the previous run (default 0.2)")
+    args = parser.parse_args(argv)
+
+    case_list = list(cases([int(size) for size in args.sizes.split(',')],
+                           _pairs(args.partitions),
+                           args.structures.split(','),
+                           _pairs(args.pitches),
+                           args.hierarchical))
+    results = run(case_list)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'environment': {'python': platform.python_version(),
+                                       'numpy': numpy.__version__,
+                                       'gdspy': gdspy.__version__,
+                                       'platform': platform.platform(),
+                                       'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+                       'results': results}, output, indent=2)
+
+    if args.calibration:
+        with open(args.calibration, 'w') as output:
+            json.dump(calibrate(results), output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.threshold)
+        for result, old in regressions:
+            print("slower: {0} {1:.2f} s -> {2:.2f} s".format(_describe(result), old['seconds'], result['seconds']))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""Headless batch generation of masks.
+
+Reads a job file and generates one .gds (or .oas, with "format": "oas")
+file per job, running several jobs at the same time.
+
+Example job file (JSON, or YAML when PyYAML is installed):
+
+    {
+        "defaults": {"size": 100, "margin": 5, "hierarchical": true},
+        "jobs": [
+            {
+                "name": "pillars_sweep",
+                "rows": 2,
+                "cols": 2,
+                "sections": [
+                    {"section": 1, "structure": "Pillars", "distance": 20, "radius": 5},
+                    {"section": 2, "structure": "Grid", "distance": 40, "radius": 4}
+                ]
+            }
+        ]
+    }
+
+Usage:
+
+    python cli.py jobs.json --jobs 4 --output-dir masks
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+try:
+    import yaml
+except ImportError as error:
+    yaml = None
+
+from wafer import Wafer, GenerationCancelled
+from drc import check_wafer
+from verify import verify_file
+from maskcache import MaskCache
+
+# Job keys passed straight to the Wafer constructor
+_WAFER_OPTIONS = ['cell_name', 'hierarchical', 'tolerance', 'circle_points', 'split_grid']
+
+
+def load_jobs(path):
+    """Reads the jobs of a job file.
+
+    Every job is merged over the "defaults" of the file and gets a name
+    (its position in the file if it has none).
+
+    Args:
+        path: path of a .json, .yaml or .yml job file.
+
+    Returns:
+        List of jobs as dictionaries.
+
+    Raise:
+        ValueError: If the file can not be read or has no jobs.
+    """
+    with open(path) as job_file:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError("PyYAML is needed to read {0}".format(path))
+            content = yaml.safe_load(job_file)
+        else:
+            content = json.load(job_file)
+
+    if isinstance(content, list):
+        content = {'jobs': content}
+
+    if not isinstance(content, dict) or not content.get('jobs'):
+        raise ValueError("The job file has to contain a list of jobs")
+
+    defaults = content.get('defaults', {})
+    jobs = []
+    for index, job in enumerate(content['jobs']):
+        merged = dict(defaults)
+        merged.update(job)
+        merged.setdefault('name', 'job_{0}'.format(index + 1))
+        jobs.append(merged)
+
+    return jobs
+
+
+def job_wafer(job):
+    """Creates the wafer of a job with its partition and setups.
+
+    Raise:
+        KeyError: If the job has no size or margin.
+        ValueError: If the wafer, the partition or a setup are not valid.
+    """
+    options = dict((key, job[key]) for key in _WAFER_OPTIONS if key in job)
+    wafer = Wafer(job['size'], job['margin'], **options)
+    wafer.partition(int(job.get('rows', 1)), int(job.get('cols', 1)))
+
+    for setup in job.get('sections', []):
+        wafer.add_setup(float(setup['distance']),
+                        float(setup['radius']),
+                        setup.get('structure', Wafer.PILLARS),
+                        int(setup.get('section', 1)))
+    return wafer
+
+
+def wafer_job(wafer, name, file_format=Wafer.GDS):
+    """Creates the job generating the setups of a wafer, see job_wafer."""
+    job = {'name': name,
+           'size': int(round(wafer.size / Wafer._MM_IN_MICRONS)),
+           'margin': wafer.margin / Wafer._MM_IN_MICRONS,
+           'rows': wafer.rows,
+           'cols': wafer.cols,
+           'format': file_format,
+           'sections': [{'section': section,
+                         'structure': setup['structure'],
+                         'distance': setup['distance'],
+                         'radius': setup['radius']}
+                        for section, setup in sorted(wafer.setups.items())]}
+    job.update((key, getattr(wafer, key)) for key in _WAFER_OPTIONS)
+    return job
+
+
+def run_job(job, observer=None, cancel=None):
+    """Generates the mask of one job.
+
+    Args:
+        job: dictionary with the wafer size and margin (mm), the partition
+             (rows, cols), the list of section setups and the output path
+             ommiting the extension. "memory_budget" (MB) generates the
+             sections in tiles that fit in that memory. "rules" holds the
+             limits given to drc.check_wafer, checked before generating.
+             "verify" reads the .gds file back and checks it against the
+             setups, the job fails if they do not match. "cache_dir" is the
+             directory of a maskcache.MaskCache shared by the jobs, of at
+             most "cache_size" MB, a mask generated before is copied from it.
+        observer: observer of the generation, see Wafer.generate_setups.
+                  (default None)
+        cancel: threading.Event stopping the generation once it is set.
+                (default None)
+
+    Returns:
+        Dictionary with the name, output, status ('ok', 'failed' or
+        'cancelled'), error message and time spent by the job, and the
+        number of violations of every rule if the job has rules.
+    """
+    start = time.time()
+    result = {'name': job.get('name'), 'output': None, 'status': 'failed', 'error': None}
+    try:
+        output = job.get('output', job['name'])
+        file_format = job.get('format', Wafer.GDS)
+        result['output'] = '{0}.{1}'.format(output, file_format)
+
+        wafer = job_wafer(job)
+
+        directory = os.path.dirname(output)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        memory_budget = job.get('memory_budget')
+        if memory_budget is not None:
+            memory_budget = float(memory_budget) * 2 ** 20
+
+        if job.get('rules'):
+            rules = dict((key, float(value)) for key, value in job['rules'].items())
+            result['violations'] = check_wafer(wafer, memory_budget=memory_budget, **rules)['violations']
+
+        wafer.generate_setups(output,
+                              stream=bool(job.get('stream', False)),
+                              file_format=file_format,
+                              memory_budget=memory_budget,
+                              mask_cache=_mask_cache(job),
+                              observer=observer,
+                              cancel=cancel)
+
+        if job.get('verify') and file_format == Wafer.GDS:
+            report = verify_file(wafer, result['output'])
+            result['digest'] = report['summary']['digest']
+            if report['problems']:
+                raise ValueError('; '.join(report['problems']))
+        result['status'] = 'ok'
+    except GenerationCancelled:
+        result['status'] = 'cancelled'
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+
+    result['seconds'] = time.time() - start
+    return result
+
+
+def _mask_cache(job):
+    """MaskCache of a job, None if it has no "cache_dir"."""
+    if not job.get('cache_dir'):
+        return None
+
+    if job.get('cache_size') is None:
+        return MaskCache(job['cache_dir'])
+    return MaskCache(job['cache_dir'], max_bytes=float(job['cache_size']) * 2 ** 20)
+
+
+def run_jobs(jobs, processes=None, output_dir=None, report=None):
+    """Runs the jobs in a pool of processes.
+
+    Each job runs in a fresh process, so jobs never share a gdspy library.
+
+    Args:
+        jobs: list of jobs returned by load_jobs.
+        processes: maximum number of jobs running at the same time
+                   (default number of cores).
+        output_dir: directory for the jobs without an explicit output.
+        report: optional callable receiving each result as it finishes.
+
+    Returns:
+        List with the result of every job in the order of the job file.
+    """
+    if output_dir is not None:
+        for job in jobs:
+            if 'output' not in job:
+                job['output'] = os.path.join(output_dir, job['name'])
+
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        results = {}
+        for index, result in pool.imap_unordered(_indexed_job, list(enumerate(jobs))):
+            results[index] = result
+            if report is not None:
+                report(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return [results[index] for index in range(len(jobs))]
+
+
+def _indexed_job(indexed):
+    index, job = indexed
+    return index, run_job(job)
+
+
+def _print_result(result):
+    if result['status'] == 'ok':
+        print("ok      {0} -> {1} ({2:.1f} s)".format(result['name'], result['output'], result['seconds']))
+    else:
+        print("failed  {0}: {1}".format(result['name'], result['error']))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate GDSII masks from a job file.")
+    parser.add_argument('job_file', help="JSON or YAML file describing the jobs")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="maximum number of jobs running at the same time (default number of cores)")
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help="directory for the jobs that do not set an output")
+    parser.add_argument('--report', default=None,
+                        help="write the status of every job to this JSON file")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="empty the mask caches of the jobs before running them")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_jobs(args.job_file)
+    except (IOError, ValueError) as e:
+        print("Could not read {0}: {1}".format(args.job_file, e))
+        return 2
+
+    if args.clear_cache:
+        for job in jobs:
+            cache = _mask_cache(job)
+            if cache is not None:
+                cache.invalidate()
+
+    results = run_jobs(jobs, args.jobs, args.output_dir, _print_result)
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+    failed = [result for result in results if result['status'] != 'ok']
+    print("{0} of {1} jobs done".format(len(results) - len(failed), len(results)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+import numpy as np
+
+from polygons import PolygonBatch
+
+
+class MarginArea:
+    """Describes the area inside the margin of the wafer.
+
+    The area is a circle cut by the flat of the wafer. Structures can be
+    classified against it to know which ones need to be clipped: the ones
+    completely inside are kept as they are, the ones completely outside
+    are dropped and only the ones crossing the arc or the flat go through
+    the boolean operation.
+
+    Axis aligned rectangles crossing the margin, like the walls of grids
+    and lines, can also be fitted in the area directly: the margin polygon
+    is convex, so the clipped wall has a closed form.
+
+    Atributes:
+        radius: Radius of the circle in microns.
+        inner_radius: Closest distance from the center to the edges of the
+                      polygon that approximates the arc.
+        flat_y: y coordinate of the flat.
+        points: (V,2) array with the vertices of the margin polygon, needed
+                to clip rectangles.
+    """
+
+    INSIDE = 0
+    OUTSIDE = 1
+    BOUNDARY = 2
+
+    def __init__(self, radius, inner_radius, flat_y, points=None):
+        self.radius = radius
+        self.inner_radius = inner_radius
+        self.flat_y = flat_y
+        self.points = points
+
+        if points is not None:
+            points = np.asarray(points, dtype=float)
+            # Edges of the polygon seen along x and along y
+            self._x_chains = _chains(points)
+            self._y_chains = _chains(points[:, ::-1])
+
+    def classify(self, polygons):
+        """Classifies polygons against the margin area.
+
+        A polygon is inside when all its vertices are, the area is convex.
+        It is outside when its bounding box does not reach the circle or
+        lies under the flat.
+
+        Args:
+            polygons: PolygonBatch with the polygons.
+
+        Returns:
+            Array with INSIDE, OUTSIDE or BOUNDARY for each polygon.
+        """
+        if len(polygons) == 0:
+            return np.empty(0, dtype=np.int8)
+
+        x_min, x_max, y_min, y_max = polygons.bounding_boxes()
+        farthest = polygons.reduce_vertices(np.maximum, np.hypot(polygons.points[:, 0], polygons.points[:, 1]))
+
+        inside = (farthest <= self.inner_radius) & (y_min >= self.flat_y)
+
+        return self._codes(inside, self._outside_boxes(x_min, x_max, y_min, y_max))
+
+    def classify_boxes(self, x_min, x_max, y_min, y_max):
+        """Classifies axis aligned rectangles against the margin area.
+
+        Gives the same result as classify for the vertices of the
+        rectangles, without building them.
+
+        Args:
+            x_min, x_max, y_min, y_max: limits of the rectangles, arrays
+                                        broadcastable to each other.
+
+        Returns:
+            Array with INSIDE, OUTSIDE or BOUNDARY for each rectangle.
+        """
+        x_min, x_max, y_min, y_max = np.broadcast_arrays(*[np.asarray(c, dtype=float)
+                                                           for c in (x_min, x_max, y_min, y_max)])
+
+        # Farthest corner from the center
+        farthest = np.hypot(np.maximum(np.abs(x_min), np.abs(x_max)),
+                            np.maximum(np.abs(y_min), np.abs(y_max)))
+        inside = (farthest <= self.inner_radius) & (y_min >= self.flat_y)
+
+        return self._codes(inside, self._outside_boxes(x_min, x_max, y_min, y_max))
+
+    def classify_circles(self, x, y, radius):
+        """Classifies circles against the margin area.
+
+        Args:
+            x: x coordinates of the centers, any shape.
+            y: y coordinates of the centers, broadcastable to x.
+            radius: radius of the circles.
+
+        Returns:
+            Array with INSIDE, OUTSIDE or BOUNDARY for each circle.
+        """
+        distances = np.hypot(x, y)
+        y = np.broadcast_to(y, distances.shape)
+
+        inside = (distances + radius <= self.inner_radius) & (y - radius >= self.flat_y)
+        outside = (distances - radius >= self.radius) | (y + radius <= self.flat_y)
+
+        return self._codes(inside, outside)
+
+    def split(self, polygons):
+        """Splits polygons in the ones inside and the ones crossing the margin.
+
+        Args:
+            polygons: PolygonBatch with the polygons.
+
+        Returns:
+            (inside, boundary): PolygonBatch with the polygons completely
+                inside the area and with the ones that need to be clipped.
+                The polygons completely outside are dropped.
+        """
+        codes = self.classify(polygons)
+        return polygons.filter(codes == self.INSIDE), polygons.filter(codes == self.BOUNDARY)
+
+    def clip_rectangles(self, rectangles):
+        """Fits axis aligned rectangles in the margin area.
+
+        Each rectangle is treated as a strip along its longest side and
+        clipped in closed form against the edges of the margin polygon.
+        Only the rectangles that reach the extremes of the polygon along
+        the strip, or leave it, are returned to be clipped with a boolean
+        operation.
+
+        Args:
+            rectangles: PolygonBatch with the rectangles.
+
+        Returns:
+            (clipped, unresolved): PolygonBatch with the clipped rectangles
+                and with the ones that could not be clipped this way.
+        """
+        x_min, x_max, y_min, y_max = rectangles.bounding_boxes()
+        tall = (x_max - x_min) <= (y_max - y_min)
+
+        clipped = []
+        unresolved = []
+
+        for strips, chains, swap in ((tall, self._x_chains, False), (~tall, self._y_chains, True)):
+            indices = np.flatnonzero(strips)
+            if swap:
+                limits = (y_min[indices], y_max[indices], x_min[indices], x_max[indices])
+            else:
+                limits = (x_min[indices], x_max[indices], y_min[indices], y_max[indices])
+
+            strip_points, strip_counts, solved = _clip_strips(chains, *limits)
+            if swap:
+                strip_points = strip_points[:, ::-1]
+
+            solved_indices = indices[solved]
+            clipped.append(PolygonBatch.from_counts(strip_points,
+                                                    strip_counts,
+                                                    rectangles.layers[solved_indices],
+                                                    rectangles.datatypes[solved_indices]))
+            unresolved.append(indices[~solved])
+
+        return PolygonBatch.concatenate(clipped), rectangles.filter(np.concatenate(unresolved))
+
+    def _outside_boxes(self, x_min, x_max, y_min, y_max):
+        """Bounding boxes that do not reach the circle or lie under the flat."""
+        # Closest point of the bounding box to the center
+        closest = np.hypot(np.clip(0, x_min, x_max), np.clip(0, y_min, y_max))
+        return (closest >= self.radius) | (y_max <= self.flat_y)
+
+    def _codes(self, inside, outside):
+        codes = np.full(inside.shape, self.BOUNDARY, dtype=np.int8)
+        codes[outside] = self.OUTSIDE
+        codes[inside] = self.INSIDE
+        return codes
+
+
+def _chains(points):
+    """Splits a convex polygon in its two chains between the extremes along x.
+
+    Returns:
+        (xs, chain_a, chain_b): Sorted x coordinates of the vertices and the
+            two chains as (V,2) arrays ordered from the lowest x.
+    """
+    x = points[:, 0]
+    first = np.argmin(x)
+    last = (np.argmax(x) - first) % len(points)
+
+    rolled = np.roll(points, -first, axis=0)
+    chain_a = rolled[:last + 1]
+    chain_b = np.concatenate((rolled[last:], rolled[:1]))[::-1]
+
+    return np.sort(x), chain_a, chain_b
+
+
+def _clip_strips(chains, lo, hi, bottom, top):
+    """Clips strips lo <= x <= hi, bottom <= y <= top against a convex polygon.
+
+    Across a strip the top edge of the polygon is a concave line that only
+    bends at the polygon vertices, and the bottom edge a convex one. The
+    clipped outline follows each edge, capped by the strip, through the
+    polygon vertices that fall in the strip and the points where the edge
+    crosses the strip limits. All the strips are handled at once by laying
+    out their breakpoints one after the other.
+
+    Args:
+        chains: chains of the polygon returned by _chains.
+        lo, hi, bottom, top: arrays with the limits of each strip.
+
+    Returns:
+        (points, counts, solved): Vertices and number of vertices of the
+            clipped strips, and a mask with the strips they belong to.
+            Strips reaching the extremes of the polygon or leaving it are
+            not solved.
+    """
+    xs, chain_a, chain_b = chains
+    strips = len(lo)
+
+    first = np.searchsorted(xs, lo, 'right')
+    crossed = np.searchsorted(xs, hi, 'left') - first
+    solved = (lo > xs[0]) & (hi < xs[-1])
+
+    # Breakpoints: both sides of each strip and the polygon vertices
+    # in between.
+    counts = np.where(solved, crossed, 0) + 2
+    strip = np.repeat(np.arange(strips), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    is_lo = position == 0
+    is_hi = position == counts[strip] - 1
+
+    x = xs[np.clip(first[strip] + position - 1, 0, len(xs) - 1)]
+    x[is_lo] = lo[strip[is_lo]]
+    x[is_hi] = hi[strip[is_hi]]
+
+    a = np.interp(x, chain_a[:, 0], chain_a[:, 1])
+    b = np.interp(x, chain_b[:, 0], chain_b[:, 1])
+    upper = np.maximum(a, b)
+    lower = np.minimum(a, b)
+    strip_top = top[strip]
+    strip_bottom = bottom[strip]
+
+    # Strips that leave the polygon somewhere are left to the boolean
+    # operation.
+    empty = np.minimum(strip_top, upper) <= np.maximum(strip_bottom, lower)
+    solved &= np.bincount(strip[empty], minlength=strips) == 0
+
+    keep = solved[strip]
+    strip, x, upper, lower = strip[keep], x[keep], upper[keep], lower[keep]
+    strip_top, strip_bottom = strip_top[keep], strip_bottom[keep]
+    is_end = is_lo[keep] | is_hi[keep]
+    has_next = ~is_hi[keep]
+
+    sides = []
+    for edge, limit, side in ((lower, strip_bottom, 0), (upper, strip_top, 1)):
+        if side == 0:
+            capped = edge < limit
+            y = np.maximum(edge, limit)
+        else:
+            capped = edge > limit
+            y = np.minimum(edge, limit)
+
+        # Breakpoints on the strip limit are redundant, except at the sides
+        used = is_end | ~capped
+        sides.append((strip[used], x[used], y[used], side))
+
+        # Points where the edge crosses the strip limit
+        current = np.flatnonzero(has_next)
+        following = current + 1
+        kink = (edge[current] - limit[current]) * (edge[following] - limit[following]) < 0
+        current, following = current[kink], following[kink]
+        kink_x = x[current] + (limit[current] - edge[current]) * \
+            (x[following] - x[current]) / (edge[following] - edge[current])
+        sides.append((strip[current], kink_x, limit[current], side))
+
+    vertex_strip = np.concatenate([vertices[0] for vertices in sides])
+    vertex_x = np.concatenate([vertices[1] for vertices in sides])
+    vertex_y = np.concatenate([vertices[2] for vertices in sides])
+    vertex_side = np.concatenate([np.full(len(vertices[0]), vertices[3]) for vertices in sides])
+
+    # Bottom side from left to right and then top side from right to left
+    order = np.lexsort((np.where(vertex_side == 0, vertex_x, -vertex_x), vertex_side, vertex_strip))
+    vertex_strip, vertex_x, vertex_y = vertex_strip[order], vertex_x[order], vertex_y[order]
+
+    repeated = np.zeros(len(order), dtype=bool)
+    repeated[1:] = (vertex_strip[1:] == vertex_strip[:-1]) & \
+                   (vertex_x[1:] == vertex_x[:-1]) & (vertex_y[1:] == vertex_y[:-1])
+    vertex_strip, vertex_x, vertex_y = vertex_strip[~repeated], vertex_x[~repeated], vertex_y[~repeated]
+
+    points = np.column_stack((vertex_x, vertex_y))
+    counts = np.bincount(vertex_strip, minlength=strips)[solved]
+
+    return points, counts, solved
@@ -0,0 +1,463 @@
+"""Design rule checks on the generated structures.
+
+The sections are built like in a generation and all their structures are
+checked at once against the rules of the mask shop:
+
+    min_width: narrowest side of the bounding box of every structure. It
+               is the diameter of the pillars and the thickness of the
+               walls, and it catches the structures narrowed by the margin.
+    min_spacing: distance between structures that do not touch, also
+                 between the structures of neighbouring sections across
+                 the gap between them.
+    min_margin: distance from the structures to the edge of the margin
+                area. The structures fitted in the margin touch it.
+    min_boundary: distance from the structures to the edges of their
+                  section.
+    min_area: area of the structures cut by the margin, the slivers the
+              clipping leaves behind. (default min_width squared)
+
+Close structures are found with a GridIndex, see the spatial module.
+
+Example:
+
+    report = check_wafer(wafer, min_width=2, min_spacing=3, min_margin=0)
+    for marker in report['markers']:
+        print(marker)
+"""
+import time
+
+import numpy
+
+from wafer import TILE_BYTES_PER_VERTEX, Wafer, build_section, split_section, tile_vertices
+from polygons import PolygonBatch
+from spatial import GridIndex, box_distances
+import pillar as Pillar
+import grid as Grid
+
+RULES = ('width', 'spacing', 'margin', 'boundary', 'area')
+
+# Memory used by every vertex of a tile while it is built and checked: the
+# tile of a generation, the copy joining the structures inside and fitted
+# in the margin, and the values measured for every vertex.
+CHECK_BYTES_PER_VERTEX = 160
+
+# Vertices projected at the same time when measuring the spacing
+_CHUNK_VERTICES = 2 ** 22
+
+
+def check_wafer(wafer, min_width=None, min_spacing=None, min_margin=None, min_boundary=None, min_area=None,
+                memory_budget=None, max_markers=100):
+    """Checks the structures of the setups of a wafer.
+
+    Rules left as None are not checked.
+
+    Args:
+        wafer: Wafer with its partition and setups.
+        min_width, min_spacing, min_margin, min_boundary, min_area: limits
+            of the rules, in the units of the wafer.
+        memory_budget: bytes of memory the check can use, the sections are
+                       checked in tiles like in generate_setups.
+                       (default None)
+        max_markers: largest number of markers kept for every rule.
+
+    Returns:
+        Dictionary with:
+            structures: number of structures checked.
+            violations: dictionary from rule to the number of violations.
+            sections: dictionary from section number to a dictionary with
+                      its structures and violations of every rule.
+            markers: list with the rule, section, x, y and measured value of
+                     the first violations of every rule.
+            seconds: time spent.
+
+    Raise:
+        ValueError: If a section is out of range or the memory budget is
+                    too small.
+    """
+    start = time.time()
+    if min_area is None and min_width is not None:
+        min_area = min_width ** 2
+    limits = dict((rule, limit) for rule, limit in zip(RULES, (min_width, min_spacing, min_margin,
+                                                               min_boundary, min_area))
+                  if limit is not None)
+
+    max_vertices = None
+    if memory_budget is not None:
+        max_vertices = tile_vertices(memory_budget) * TILE_BYTES_PER_VERTEX // CHECK_BYTES_PER_VERTEX
+    wafer._create_margin_area()
+
+    report = {'structures': 0,
+              'violations': dict((rule, 0) for rule in limits),
+              'sections': {},
+              'markers': []}
+
+    # Structures close to the edges of their section, checked against the
+    # ones of the other sections at the end.
+    edges = []
+    for section, setup in sorted(wafer.setups.items()):
+        spec = wafer._section_spec(setup['distance'], setup['radius'], setup['structure'], section)
+        # Pillars are checked one by one, not as arrays of references, and
+        # grids as whole walls, the pieces of split walls touch each other.
+        spec['hierarchical'] = False
+        spec['split_grid'] = False
+        area = (spec['x'], spec['y'], spec['width'], spec['height'])
+
+        counts = dict((rule, 0) for rule in limits)
+        counts['structures'] = 0
+        report['sections'][section] = counts
+
+        specs = [spec] if max_vertices is None else split_section(spec, max_vertices)
+        if 'spacing' in limits:
+            extents = numpy.array([_tile_extent(tile_spec) for tile_spec in specs])
+            neighbours = _neighbour_tiles(extents, limits['spacing'])
+
+        # Structures of the tiles built so far close to the tiles to come
+        borders = {}
+        section_edges = []
+        for tile, tile_spec in enumerate(specs):
+            geometry = build_section(tile_spec)
+            polygons = PolygonBatch.concatenate([geometry['inside'], geometry['clipped']])
+            clipped = numpy.arange(len(polygons)) >= len(geometry['inside'])
+            counts['structures'] += len(polygons)
+            report['structures'] += len(polygons)
+            if len(polygons) == 0:
+                continue
+
+            boxes = polygons.bounding_boxes()
+            for rule, (indices, values, x, y) in _check_tile(polygons, boxes, clipped, limits,
+                                                             spec['margin_area'], area).items():
+                _record(report, section, rule, values, x, y, max_markers)
+
+            if 'spacing' not in limits:
+                continue
+
+            spacing = limits['spacing']
+            for other in neighbours[tile]:
+                if other in borders:
+                    near = polygons.filter(_near_boxes(boxes, extents[other:other + 1], spacing))
+                    _, distances, x, y = _check_across([near, borders[other]], spacing)
+                    _record(report, section, 'spacing', distances, x, y, max_markers)
+
+            later = neighbours[tile][neighbours[tile] > tile]
+            if len(later):
+                borders[tile] = polygons.filter(_near_boxes(boxes, extents[later], spacing))
+            for other in [other for other in borders if neighbours[other].max() <= tile]:
+                del borders[other]
+
+            left, top, width, height = area
+            section_edges.append(polygons.filter(_near_edges(boxes, (left, left + width, top - height, top), spacing)))
+
+        if section_edges:
+            edges.append((PolygonBatch.concatenate(section_edges), section))
+
+    if len(edges) > 1:
+        sections, distances, x, y = _check_across([polygons for polygons, _ in edges], limits['spacing'])
+        sections = numpy.array([section for _, section in edges])[sections]
+        for section in numpy.unique(sections).tolist():
+            selection = sections == section
+            _record(report, section, 'spacing', distances[selection], x[selection], y[selection], max_markers)
+
+    report['seconds'] = time.time() - start
+    return report
+
+
+def check_width(polygons, min_width, boxes=None):
+    """Finds the structures narrower than min_width.
+
+    The width of a structure is the narrowest side of its bounding box.
+
+    Args:
+        polygons: PolygonBatch with the structures.
+        min_width: smallest width of a structure.
+        boxes: bounding boxes of the structures, computed if None.
+               (default None)
+
+    Returns:
+        (indices, widths): indices of the structures and their widths.
+    """
+    x_min, x_max, y_min, y_max = boxes or polygons.bounding_boxes()
+    widths = numpy.minimum(x_max - x_min, y_max - y_min)
+    indices = numpy.flatnonzero(widths < min_width)
+    return indices, widths[indices]
+
+
+def check_area(polygons, min_area):
+    """Finds the structures with less area than min_area.
+
+    Returns:
+        (indices, areas): indices of the structures and their areas.
+    """
+    areas = polygon_areas(polygons)
+    indices = numpy.flatnonzero(areas < min_area)
+    return indices, areas[indices]
+
+
+def check_spacing(polygons, min_spacing, index=None, boxes=None):
+    """Finds the pairs of structures closer than min_spacing.
+
+    Structures that touch or overlap are merged in the mask and are not
+    reported.
+
+    Args:
+        polygons: PolygonBatch with the structures.
+        min_spacing: smallest distance between two structures.
+        index: GridIndex of the structures, built if None. (default None)
+        boxes: bounding boxes of the structures, computed if None.
+               (default None)
+
+    Returns:
+        (first, second, distances): indices of the structures of every pair
+            and the distance between them, see separations.
+    """
+    boxes = boxes or polygons.bounding_boxes()
+    if index is None:
+        index = GridIndex(*boxes)
+
+    first, second, _ = index.pairs(min_spacing)
+    distances = separations(polygons, first, second, boxes)
+    close = (distances > 0) & (distances < min_spacing)
+    return first[close], second[close], distances[close]
+
+
+def check_margin(polygons, margin_area, min_distance, boxes=None):
+    """Finds the structures closer than min_distance to the edge of the margin area.
+
+    Args:
+        polygons: PolygonBatch with the structures.
+        margin_area: MarginArea of the wafer.
+        min_distance: smallest distance to the margin.
+        boxes: bounding boxes of the structures, computed if None.
+               (default None)
+
+    Returns:
+        (indices, distances): indices of the structures and their distance
+            to the margin, 0 for the ones fitted in it.
+    """
+    x_min, x_max, y_min, y_max = boxes or polygons.bounding_boxes()
+    farthest = polygons.reduce_vertices(numpy.maximum, numpy.hypot(polygons.points[:, 0], polygons.points[:, 1]))
+
+    distances = numpy.maximum(numpy.minimum(margin_area.inner_radius - farthest, y_min - margin_area.flat_y), 0)
+    indices = numpy.flatnonzero(distances < min_distance)
+    return indices, distances[indices]
+
+
+def check_boundary(polygons, area, min_distance, boxes=None):
+    """Finds the structures closer than min_distance to the edges of their section.
+
+    Args:
+        polygons: PolygonBatch with the structures of the section.
+        area: (x, y, width, height) of the section, see Wafer._section_area.
+        min_distance: smallest distance to the edges.
+        boxes: bounding boxes of the structures, computed if None.
+               (default None)
+
+    Returns:
+        (indices, distances): indices of the structures and their distance
+            to the closest edge.
+    """
+    x, y, width, height = area
+    x_min, x_max, y_min, y_max = boxes or polygons.bounding_boxes()
+
+    distances = numpy.minimum(numpy.minimum(x_min - x, x + width - x_max),
+                              numpy.minimum(y - y_max, y_min - (y - height)))
+    indices = numpy.flatnonzero(distances < min_distance)
+    return indices, distances[indices]
+
+
+def polygon_areas(polygons):
+    """Calculates the area of every polygon with the shoelace formula."""
+    if len(polygons) == 0:
+        return numpy.empty(0)
+
+    x = polygons.points[:, 0]
+    y = polygons.points[:, 1]
+    # Next vertex of every vertex, the last one of a polygon goes back to the first
+    following = numpy.arange(1, len(x) + 1)
+    following[polygons.offsets[1:] - 1] = polygons.offsets[:-1]
+
+    return numpy.abs(polygons.reduce_vertices(numpy.add, x * y[following] - x[following] * y)) / 2
+
+
+def separations(polygons, first, second, boxes=None):
+    """Measures the distance between pairs of polygons.
+
+    The distance is the largest of the distance between the bounding boxes
+    and the gap between the polygons along the line joining their centers.
+    It is exact for walls and pillars, and never bigger than the real
+    distance for the rest, so no violation is missed. It is 0 when the
+    polygons touch or overlap.
+
+    Args:
+        polygons: PolygonBatch with the polygons.
+        first, second: indices of the polygons of every pair.
+        boxes: bounding boxes of the polygons, computed if None.
+               (default None)
+
+    Returns:
+        Array with the distance of every pair.
+    """
+    boxes = numpy.column_stack(boxes or polygons.bounding_boxes())
+    distances = box_distances(boxes[first], boxes[second])
+    if len(first) == 0:
+        return distances
+
+    counts = polygons.counts
+    centers = polygons.reduce_vertices(numpy.add, polygons.points) / counts[:, numpy.newaxis]
+    directions = centers[second] - centers[first]
+    lengths = numpy.hypot(directions[:, 0], directions[:, 1])
+    directions /= numpy.where(lengths > 0, lengths, 1)[:, numpy.newaxis]
+
+    # Pairs are projected in chunks so the vertices fit in memory
+    step = max(_CHUNK_VERTICES // int(counts.max()), 1)
+    for chunk in range(0, len(first), step):
+        pairs = slice(chunk, chunk + step)
+        far = _project(polygons, first[pairs], directions[pairs], numpy.maximum)
+        near = _project(polygons, second[pairs], directions[pairs], numpy.minimum)
+        gaps = numpy.where(lengths[pairs] > 0, near - far, 0)
+        distances[pairs] = numpy.maximum(distances[pairs], gaps)
+
+    return distances
+
+
+def _project(polygons, indices, directions, ufunc):
+    """Reduces the projections of the vertices of some polygons, each one on its direction."""
+    counts = polygons.counts[indices]
+    starts = numpy.cumsum(counts) - counts
+    vertices = numpy.repeat(polygons.offsets[indices] - starts, counts) + numpy.arange(counts.sum())
+
+    projections = numpy.einsum('ij,ij->i', polygons.points[vertices], numpy.repeat(directions, counts, axis=0))
+    return ufunc.reduceat(projections, starts)
+
+
+def _check_tile(polygons, boxes, clipped, limits, margin_area, area):
+    """Checks the structures of one tile of a section.
+
+    Returns:
+        Dictionary from rule to (indices, values, x, y) of the violations.
+    """
+    found = {}
+    x_min, x_max, y_min, y_max = boxes
+    x = (x_min + x_max) / 2
+    y = (y_min + y_max) / 2
+
+    if 'width' in limits:
+        indices, values = check_width(polygons, limits['width'], boxes)
+        found['width'] = (indices, values, x[indices], y[indices])
+
+    for rule, check, argument in (('margin', check_margin, margin_area),
+                                  ('boundary', check_boundary, area)):
+        if rule in limits:
+            indices, values = check(polygons, argument, limits[rule], boxes)
+            found[rule] = (indices, values, x[indices], y[indices])
+
+    # Only the structures cut by the margin can be slivers
+    if 'area' in limits:
+        cut = numpy.flatnonzero(clipped)
+        indices, values = check_area(polygons.filter(cut), limits['area'])
+        found['area'] = (cut[indices], values, x[cut[indices]], y[cut[indices]])
+
+    if 'spacing' in limits:
+        first, second, distances = check_spacing(polygons, limits['spacing'], boxes=boxes)
+        found['spacing'] = (first, distances) + _pair_centers(boxes, first, second)
+
+    return found
+
+
+def _tile_extent(spec):
+    """Box around the structures of a tile before they are fitted in the margin.
+
+    Returns:
+        (x_min, x_max, y_min, y_max), all of them nan if the tile is empty.
+    """
+    area = (spec['x'], spec['y'], spec['width'], spec['height'])
+    distance = spec['distance']
+    radius = spec['radius']
+
+    if spec['structure'] == Wafer.PILLARS:
+        start_x, start_y, pitch, columns, rows = Pillar.generate_pilars_lattice(distance, radius, *area)
+        xs = start_x + numpy.arange(columns)[spec.get('columns') or slice(None)] * pitch
+        ys = start_y - numpy.arange(rows)[spec.get('rows') or slice(None)] * pitch
+        if len(xs) == 0 or len(ys) == 0:
+            return (numpy.nan,) * 4
+        return xs[0] - radius, xs[-1] + radius, ys[-1] - radius, ys[0] + radius
+
+    horizontal, vertical = Grid.generate_grid_walls(distance, radius, *area,
+                                                    walls_x=spec.get('columns'), walls_y=spec.get('rows'))
+    if spec['structure'] == Wafer.LINES_H:
+        horizontal = horizontal[:0]
+    elif spec['structure'] == Wafer.LINES_V:
+        vertical = vertical[:0]
+
+    walls = numpy.concatenate((horizontal, vertical))
+    if len(walls) == 0:
+        return (numpy.nan,) * 4
+    return walls[:, :, 0].min(), walls[:, :, 0].max(), walls[:, :, 1].min(), walls[:, :, 1].max()
+
+
+def _neighbour_tiles(extents, distance):
+    """Finds the tiles closer than distance to each tile.
+
+    Returns:
+        List with an array of the indices of the neighbours of every tile.
+    """
+    tiles = numpy.arange(len(extents))
+    neighbours = []
+    for tile in tiles:
+        close = box_distances(extents[tile:tile + 1], extents) < distance
+        neighbours.append(tiles[close & (tiles != tile)])
+    return neighbours
+
+
+def _check_across(batches, min_spacing):
+    """Finds the pairs of structures of different batches closer than min_spacing.
+
+    Returns:
+        (batches, distances, x, y): batch of the first structure of every
+            pair, the distance between them and the point between them.
+    """
+    polygons = PolygonBatch.concatenate(batches)
+    labels = numpy.repeat(numpy.arange(len(batches)), [len(batch) for batch in batches])
+
+    boxes = polygons.bounding_boxes()
+    first, second, distances = check_spacing(polygons, min_spacing, boxes=boxes)
+    across = labels[first] != labels[second]
+    first, second = first[across], second[across]
+    return (labels[first], distances[across]) + _pair_centers(boxes, first, second)
+
+
+def _near_boxes(boxes, others, distance):
+    """Selects the boxes closer than distance to any of the other boxes."""
+    boxes = numpy.column_stack(boxes)
+    near = numpy.zeros(len(boxes), dtype=bool)
+    for other in others:
+        near |= box_distances(boxes, other[numpy.newaxis, :]) < distance
+    return near
+
+
+def _near_edges(boxes, limits, distance):
+    """Selects the boxes closer than distance to the edges of the area given by its limits."""
+    x_min, x_max, y_min, y_max = boxes
+    return ((x_min - limits[0] < distance) | (limits[1] - x_max < distance) |
+            (y_min - limits[2] < distance) | (limits[3] - y_max < distance))
+
+
+def _pair_centers(boxes, first, second):
+    """Middle point between the centers of pairs of boxes."""
+    x_min, x_max, y_min, y_max = boxes
+    x = (x_min + x_max) / 2
+    y = (y_min + y_max) / 2
+    return (x[first] + x[second]) / 2, (y[first] + y[second]) / 2
+
+
+def _record(report, section, rule, values, x, y, max_markers):
+    """Adds the violations of a rule to the report."""
+    report['violations'][rule] += len(values)
+    report['sections'][section][rule] += len(values)
+
+    kept = sum(1 for marker in report['markers'] if marker['rule'] == rule)
+    for index in range(min(max_markers - kept, len(values))):
+        report['markers'].append({'rule': rule,
+                                  'section': section,
+                                  'x': float(x[index]),
+                                  'y': float(y[index]),
+                                  'value': float(values[index])})
@@ -0,0 +1,477 @@
+"""Estimates the cost of a generation without building any geometry.
+
+The number of structures of every section follows from the same lattice
+arithmetic used to generate them, classified against the margin area row
+by row or wall by wall. They are the structures counted by
+wafer.build_section, the ones inside the margin or crossing it before
+they are fitted, so they match the counters of the generation. The file
+size follows from the size of the GDSII records, and the runtime and peak
+memory from a linear model fitted to the results of benchmark.py:
+
+    python benchmark.py --output results.json --calibration calibration.json
+
+Example:
+
+    report = estimate(wafer)
+    for warning in report['warnings']:
+        print(warning)
+"""
+import json
+import os
+
+import numpy
+
+from wafer import Wafer, tile_vertices
+from clipping import MarginArea
+from gdsii import MAX_VERTICES
+import pillar as Pillar
+import grid as Grid
+
+# Runtime and memory models fitted with calibrate on the default benchmark:
+#     seconds = seconds[0] + seconds[1] * generated vertices + seconds[2] * vertices
+#     memory = memory[0] + memory[1] * vertices held at the same time
+DEFAULT_CALIBRATION = {'seconds': [0.002, 7.6e-08, 7.0e-08],
+                       'memory': [36.0e6, 25.0]}
+
+# Files bigger than this are rejected by many mask writers and viewers
+MAX_FILE_SIZE = 2 ** 31
+
+# Bytes of the header, library, top cell and the end of the file
+_FILE_BYTES = 200
+
+# BOUNDARY record with its LAYER, DATATYPE, XY and ENDEL records, without
+# the coordinates. Every vertex takes 8 bytes and the first one is repeated.
+_BOUNDARY_BYTES = 32
+
+# AREF with its SNAME, COLROW, XY and ENDEL records
+_AREF_BYTES = 68
+
+# SREF with its SNAME, XY and ENDEL records
+_SREF_BYTES = 44
+
+# BGNSTR, STRNAME and ENDSTR records of the pillar, grid and field cells
+_CELL_BYTES = 64
+
+
+def estimate(wafer, calibration=None, stream=False, memory_limit=None, max_file_size=MAX_FILE_SIZE,
+             memory_budget=None):
+    """Estimates the cost of generating the setups of a wafer.
+
+    Args:
+        wafer: Wafer with its partition and setups.
+        calibration: runtime and memory models returned by calibrate.
+                     (default DEFAULT_CALIBRATION)
+        stream: True if the file is going to be streamed. (default False)
+        memory_limit: bytes of memory available, if None the physical
+                      memory of the machine. (default None)
+        max_file_size: largest file accepted by the mask writer.
+                       (default MAX_FILE_SIZE)
+        memory_budget: memory budget given to generate_setups, the sections
+                       are built in tiles that fit in it. (default None)
+
+    Returns:
+        Dictionary with:
+            sections: dictionary from section number to a dictionary with
+                      the structure, structures, inside, clipped, arrays,
+                      vertices, generated_vertices, file_size and seconds of
+                      the section.
+            structures, vertices, file_size, seconds: totals of the file.
+            peak_memory: bytes of memory used by the generation.
+            warnings: messages about the limits the generation would exceed.
+    """
+    calibration = calibration or DEFAULT_CALIBRATION
+    seconds_model = calibration['seconds']
+    memory_model = calibration['memory']
+
+    wafer._create_margin_area()
+    outline_vertices = 2 * len(wafer.margin_points)
+
+    sections = {}
+    warnings = []
+    radii = set()
+    grids = set()
+    for section, setup in sorted(wafer.setups.items()):
+        if section > wafer.num_sections:
+            warnings.append("Section {0} is not part of the current partition".format(section))
+            continue
+
+        spec = wafer._section_spec(setup['distance'], setup['radius'], setup['structure'], section)
+        if spec['distance'] <= 0:
+            warnings.append("Section {0}: the distance between structures has to be positive".format(section))
+            continue
+
+        if spec['structure'] == Wafer.PILLARS:
+            cost = _pillars_cost(spec)
+            if spec['hierarchical'] and cost['arrays']:
+                radii.add(spec['radius'])
+        else:
+            cost = _walls_cost(spec)
+            if cost['arrays']:
+                grids.add((spec['distance'], spec['radius']))
+
+        cost['structure'] = spec['structure']
+        cost['seconds'] = seconds_model[1] * cost['generated_vertices'] + seconds_model[2] * cost['vertices']
+        sections[section] = cost
+
+        warnings.extend(_section_warnings(wafer, section, spec, cost))
+
+    # Hierarchical sections repeating a field inside the margin are built
+    # once in a field cell and the others are a reference to it.
+    if wafer.hierarchical and memory_budget is None:
+        placed = set()
+        fields = wafer._shared_fields([(section, wafer.setups[section]) for section in sorted(sections)])
+        for section, field in sorted(fields.items()):
+            cost = sections[section]
+            if field in placed:
+                cost.update(vertices=0, generated_vertices=0, seconds=0, file_size=_SREF_BYTES)
+            else:
+                cost['file_size'] += _CELL_BYTES + _SREF_BYTES
+                placed.add(field)
+
+    structures = sum(cost['structures'] for cost in sections.values())
+    vertices = sum(cost['vertices'] for cost in sections.values()) + outline_vertices
+    generated = [cost['generated_vertices'] for cost in sections.values()] or [0]
+
+    file_size = _FILE_BYTES + 2 * _BOUNDARY_BYTES + 8 * outline_vertices
+    file_size += sum(cost['file_size'] for cost in sections.values())
+    for radius in radii:
+        template = Pillar.generate_pilar_template(radius, wafer.tolerance, wafer.circle_points)
+        file_size += _CELL_BYTES + _BOUNDARY_BYTES + 8 * (len(template) + 1)
+    for distance, thickness in grids:
+        file_size += _CELL_BYTES + len(Grid.generate_grid_cell(distance, thickness)) * (_BOUNDARY_BYTES + 8 * 5)
+
+    # The whole cell is kept until it is written, unless it is streamed.
+    # With a memory budget only one tile is held at a time.
+    if memory_budget is not None:
+        held = min(max(generated), tile_vertices(memory_budget))
+    else:
+        held = max(generated) + (0 if stream else vertices)
+    peak_memory = memory_model[0] + memory_model[1] * held
+
+    if memory_limit is None:
+        memory_limit = _physical_memory()
+    if memory_limit is not None and peak_memory > memory_limit:
+        if memory_budget is not None:
+            advice = ""
+        elif stream:
+            advice = ", try setting a memory budget"
+        else:
+            advice = ", try streaming the file or setting a memory budget"
+        warnings.append("The generation needs about {0:.1f} GB of memory and only {1:.1f} GB are available{2}".format(
+            peak_memory / 2.0 ** 30, memory_limit / 2.0 ** 30, advice))
+
+    if max_file_size is not None and file_size > max_file_size:
+        warnings.append("The file would be about {0:.1f} GB, bigger than the {1:.1f} GB accepted by the mask writer".format(
+            file_size / 2.0 ** 30, max_file_size / 2.0 ** 30))
+
+    return {'sections': sections,
+            'structures': structures,
+            'vertices': vertices,
+            'file_size': file_size,
+            'peak_memory': peak_memory,
+            'seconds': seconds_model[0] + sum(cost['seconds'] for cost in sections.values()),
+            'warnings': warnings}
+
+
+def _pillars_cost(spec):
+    """Counts the pillars of a section row by row."""
+    radius = spec['radius']
+    margin_area = spec['margin_area']
+    start_x, start_y, pitch, columns, rows = Pillar.generate_pilars_lattice(spec['distance'],
+                                                                           radius,
+                                                                           spec['x'],
+                                                                           spec['y'],
+                                                                           spec['width'],
+                                                                           spec['height'])
+    template = Pillar.generate_pilar_template(radius, spec['tolerance'], spec['circle_points'])
+    ys = start_y - numpy.arange(rows) * pitch
+
+    # Same conditions as MarginArea.classify_circles, solved for x in every row
+    inside_first, inside_last = _columns_within(start_x, pitch, columns, ys, margin_area.inner_radius - radius,
+                                                ys - radius >= margin_area.flat_y, closed=True)
+    kept_first, kept_last = _columns_within(start_x, pitch, columns, ys, margin_area.radius + radius,
+                                            ys + radius > margin_area.flat_y, closed=False)
+
+    inside = int(numpy.sum(inside_last - inside_first + 1))
+    boundary = int(numpy.sum(kept_last - kept_first + 1)) - inside
+
+    arrays = 0
+    if spec['hierarchical']:
+        arrays = _arrays_count(inside_first, inside_last)
+        explicit = boundary
+        generated = rows * columns + boundary * len(template)
+    else:
+        explicit = inside + boundary
+        generated = rows * columns * len(template)
+
+    # On average half of a clipped pillar is inside the margin
+    vertices = (explicit - boundary) * len(template) + boundary * (len(template) // 2 + 2)
+    return {'structures': inside + boundary,
+            'inside': inside,
+            'clipped': boundary,
+            'arrays': arrays,
+            'vertices': vertices,
+            'generated_vertices': generated,
+            'file_size': explicit * _BOUNDARY_BYTES + 8 * (vertices + explicit) + arrays * _AREF_BYTES}
+
+
+def _columns_within(start_x, pitch, columns, ys, reach, valid, closed):
+    """Finds the columns of every row whose centers are within a distance of the center.
+
+    Returns:
+        (first, last): first and last column of every row, last is smaller
+            than first in the rows without any.
+    """
+    half = numpy.sqrt(numpy.maximum(reach ** 2 - ys ** 2, 0))
+    if closed:
+        valid = valid & (reach ** 2 >= ys ** 2)
+    else:
+        valid = valid & (reach ** 2 > ys ** 2)
+    valid &= reach > 0
+
+    low = (-half - start_x) / pitch
+    high = (half - start_x) / pitch
+    if closed:
+        first, last = numpy.ceil(low), numpy.floor(high)
+    else:
+        first, last = numpy.floor(low) + 1, numpy.ceil(high) - 1
+
+    first = numpy.maximum(first, 0).astype(int)
+    last = numpy.minimum(last, columns - 1).astype(int)
+    last[~valid] = first[~valid] - 1
+    last = numpy.maximum(last, first - 1)
+    return first, last
+
+
+def _arrays_count(inside_first, inside_last):
+    """Counts the arrays of references of a hierarchical section.
+
+    Consecutive rows with the same inside run make one array.
+    """
+    has_inside = inside_last >= inside_first
+    runs = numpy.where(has_inside[:, numpy.newaxis], numpy.column_stack((inside_first, inside_last)), -1)
+    changes = numpy.ones(len(runs), dtype=bool)
+    changes[1:] = (runs[1:] != runs[:-1]).any(axis=1)
+    return int(numpy.count_nonzero(changes & has_inside))
+
+
+def _walls_cost(spec):
+    """Counts the walls of a section classifying their bounding boxes.
+
+    The pieces of the walls of split grids are counted row by row.
+    """
+    distance = spec['distance']
+    thickness = spec['radius']
+    x, y, width, height = spec['x'], spec['y'], spec['width'], spec['height']
+    margin_area = spec['margin_area']
+
+    start_x, start_y, pitch, walls_x_axis, walls_y_axis = Grid.generate_grid_lattice(distance, thickness,
+                                                                                     x, y, width, height)
+    split = spec['structure'] == Wafer.GRID and spec['split_grid']
+    if split and spec['hierarchical'] and walls_x_axis and walls_y_axis:
+        return _grid_cells_cost(spec)
+
+    codes = []
+    if spec['structure'] in (Wafer.GRID, Wafer.LINES_V):
+        corners = start_x + numpy.arange(walls_x_axis) * pitch
+        codes.append(margin_area.classify_boxes(corners, corners + thickness, y - height, y))
+    if spec['structure'] == Wafer.LINES_H or (spec['structure'] == Wafer.GRID and not split):
+        corners = start_y - numpy.arange(walls_y_axis) * pitch
+        codes.append(margin_area.classify_boxes(x, x + width, corners - thickness, corners))
+    codes = numpy.concatenate(codes) if codes else numpy.empty(0)
+
+    inside = int(numpy.count_nonzero(codes == MarginArea.INSIDE))
+    boundary = int(numpy.count_nonzero(codes == MarginArea.BOUNDARY))
+    generated = 4 * len(codes)
+
+    if split:
+        starts, ends = Grid.gaps(x, x + width, start_x + numpy.arange(walls_x_axis) * pitch, thickness)
+        corners = start_y - numpy.arange(walls_y_axis) * pitch
+        inside_first, inside_last, kept_first, kept_last = _intervals_within(starts, ends, corners - thickness,
+                                                                             corners, margin_area)
+        pieces = int(numpy.sum(inside_last - inside_first + 1))
+        inside += pieces
+        boundary += int(numpy.sum(kept_last - kept_first + 1)) - pieces
+        generated += 4 * len(starts) * walls_y_axis
+
+    vertices = 4 * inside + int(round(_clipped_wall_vertices(spec) * boundary))
+    return {'structures': inside + boundary,
+            'inside': inside,
+            'clipped': boundary,
+            'arrays': 0,
+            'vertices': vertices,
+            'generated_vertices': generated,
+            'file_size': (inside + boundary) * _BOUNDARY_BYTES + 8 * (vertices + inside + boundary)}
+
+
+def _grid_cells_cost(spec):
+    """Counts the unit cells of a hierarchical split grid row by row.
+
+    Structures are the rectangles of the cells, the cells inside the margin
+    are referenced and their vertices are not counted. The rectangles of
+    the cells crossing the margin are classified one by one.
+    """
+    distance = spec['distance']
+    thickness = spec['radius']
+    area = (spec['x'], spec['y'], spec['width'], spec['height'])
+    margin_area = spec['margin_area']
+
+    start_x, start_y, pitch, columns, rows = Grid.generate_grid_lattice(distance, thickness, *area)
+    xs = start_x + numpy.arange(columns) * pitch
+    ys = start_y - numpy.arange(rows) * pitch
+    inside_first, inside_last, kept_first, kept_last = _intervals_within(xs, xs + pitch, ys - pitch, ys,
+                                                                         margin_area)
+    inside_cells = int(numpy.sum(inside_last - inside_first + 1))
+
+    # Cells kept on both sides of the inside run of every row
+    has_inside = inside_last >= inside_first
+    left = numpy.where(has_inside, inside_first, kept_last + 1)
+    right = numpy.where(has_inside, inside_last + 1, kept_last + 1)
+    starts = numpy.concatenate((kept_first, right))
+    counts = numpy.maximum(numpy.concatenate((left, kept_last + 1)) - starts, 0)
+    boundary_rows = numpy.repeat(numpy.tile(numpy.arange(rows), 2), counts)
+    boundary_cols = numpy.repeat(starts, counts) + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) -
+                                                                                              counts, counts)
+
+    cell = Grid.generate_grid_cell(distance, thickness)
+    origins = numpy.column_stack((xs[boundary_cols], ys[boundary_rows]))
+    rectangles = (cell[numpy.newaxis, :, :, :] + origins[:, numpy.newaxis, numpy.newaxis, :]).reshape(-1, 4, 2)
+    rectangles = numpy.concatenate((rectangles, Grid.generate_grid_edges(distance, thickness, *area)))
+    codes = margin_area.classify_boxes(rectangles[:, :, 0].min(axis=1), rectangles[:, :, 0].max(axis=1),
+                                       rectangles[:, :, 1].min(axis=1), rectangles[:, :, 1].max(axis=1))
+    explicit = int(numpy.count_nonzero(codes == MarginArea.INSIDE))
+    boundary = int(numpy.count_nonzero(codes == MarginArea.BOUNDARY))
+    arrays = _arrays_count(inside_first, inside_last)
+
+    vertices = 4 * explicit + int(round(_clipped_wall_vertices(spec) * boundary))
+    return {'structures': inside_cells * len(cell) + explicit + boundary,
+            'inside': inside_cells * len(cell) + explicit,
+            'clipped': boundary,
+            'arrays': arrays,
+            'vertices': vertices,
+            'generated_vertices': columns * rows + 4 * len(rectangles),
+            'file_size': (explicit + boundary) * _BOUNDARY_BYTES + 8 * (vertices + explicit + boundary) +
+                         arrays * _AREF_BYTES}
+
+
+def _intervals_within(starts, ends, y_min, y_max, margin_area):
+    """Classifies the rectangles of rows of intervals against the margin area.
+
+    Every row is a band between y_min and y_max holding the same intervals
+    along x, sorted and not overlapping. Gives the same result as
+    MarginArea.classify_boxes solving its conditions for x in every row.
+
+    Returns:
+        (first, last, kept_first, kept_last): first and last interval
+            inside the margin and not outside of it of every row, last is
+            smaller than first in the rows without any.
+    """
+    farthest = numpy.maximum(numpy.abs(y_min), numpy.abs(y_max))
+    reach = numpy.sqrt(numpy.maximum(margin_area.inner_radius ** 2 - farthest ** 2, 0))
+    valid = (farthest <= margin_area.inner_radius) & (y_min >= margin_area.flat_y)
+
+    first = numpy.searchsorted(starts, -reach, 'left')
+    last = numpy.searchsorted(ends, reach, 'right') - 1
+    last = numpy.where(valid, numpy.maximum(last, first - 1), first - 1)
+
+    # Closest point of each band to the center
+    closest = numpy.clip(0, y_min, y_max)
+    reach = numpy.sqrt(numpy.maximum(margin_area.radius ** 2 - closest ** 2, 0))
+    valid = (reach > 0) & (y_max > margin_area.flat_y)
+    kept_first = numpy.searchsorted(ends, -reach, 'right')
+    kept_last = numpy.searchsorted(starts, reach, 'left') - 1
+    kept_last = numpy.where(valid, numpy.maximum(kept_last, kept_first - 1), kept_first - 1)
+
+    return first, last, kept_first, kept_last
+
+
+def _clipped_wall_vertices(spec):
+    """Average vertices of a wall fitted in the margin area.
+
+    A clipped wall follows the edges of the margin polygon across its
+    thickness at both ends, on average it gets a vertex of the polygon
+    every edge length.
+    """
+    points = spec['margin_points']
+    edge = numpy.hypot(*(points[1] - points[0]))
+    return 4 + 2 * spec['radius'] / edge
+
+
+def _section_warnings(wafer, section, spec, cost):
+    warnings = []
+    distance = spec['distance']
+    radius = spec['radius']
+    precision = wafer.precision / wafer.unit
+
+    size = 2 * radius if spec['structure'] == Wafer.PILLARS else radius
+    if size > distance:
+        warnings.append("Section {0}: the structures overlap, they are {1} um wide every {2} um".format(
+            section, size, distance))
+    if 0 < radius < precision:
+        warnings.append("Section {0}: the structures are smaller than the precision of the file".format(section))
+    if spec['structure'] == Wafer.PILLARS:
+        template = Pillar.generate_pilar_template(radius, spec['tolerance'], spec['circle_points'])
+        if len(template) + 1 > MAX_VERTICES:
+            warnings.append("Section {0}: pillars with {1} vertices do not fit in a GDSII polygon".format(
+                section, len(template)))
+    if cost['structures'] == 0:
+        warnings.append("Section {0}: no structure fits in the section".format(section))
+    return warnings
+
+
+def _physical_memory():
+    """Bytes of physical memory of the machine, None if unknown."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def calibrate(results):
+    """Fits the runtime and memory models to the results of benchmark.py.
+
+    Args:
+        results: list of results saved by benchmark.py.
+
+    Returns:
+        Calibration to be passed to estimate.
+    """
+    times = []
+    memories = []
+    for result in results:
+        if 'error' in result:
+            continue
+
+        wafer = Wafer(result['size'], result.get('margin', 5), hierarchical=result['hierarchical'])
+        wafer.partition(result['rows'], result['cols'])
+        for section in range(1, wafer.num_sections + 1):
+            wafer.add_setup(result['distance'], result['radius'], result['structure'], section)
+        report = estimate(wafer, memory_limit=0, max_file_size=None)
+
+        generated = [cost['generated_vertices'] for cost in report['sections'].values()]
+        times.append((sum(generated), report['vertices'], result['seconds']))
+        if result.get('peak_memory'):
+            memories.append((max(generated) + report['vertices'], result['peak_memory']))
+
+    calibration = dict(DEFAULT_CALIBRATION)
+    if len(times) >= 3:
+        times = numpy.array(times, dtype=float)
+        features = numpy.column_stack((numpy.ones(len(times)), times[:, :2]))
+        calibration['seconds'] = _fit(features, times[:, 2])
+    if len(memories) >= 2:
+        memories = numpy.array(memories, dtype=float)
+        features = numpy.column_stack((numpy.ones(len(memories)), memories[:, 0]))
+        calibration['memory'] = _fit(features, memories[:, 1])
+    return calibration
+
+
+def _fit(features, values):
+    """Least squares fit that does not allow negative coefficients."""
+    coefficients = numpy.linalg.lstsq(features, values, rcond=None)[0]
+    return [max(float(coefficient), 0.0) for coefficient in coefficients]
+
+
+def load_calibration(filename):
+    """Reads a calibration saved by benchmark.py."""
+    with open(filename) as infile:
+        return json.load(infile)
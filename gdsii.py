@@ -0,0 +1,608 @@
+import collections
+import datetime
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+# Record types (first byte) and data types (second byte) of the GDSII stream
+# format used by the writer.
+HEADER = 0x0002
+BGNLIB = 0x0102
+LIBNAME = 0x0206
+UNITS = 0x0305
+ENDLIB = 0x0400
+BGNSTR = 0x0502
+STRNAME = 0x0606
+ENDSTR = 0x0700
+BOUNDARY = 0x0800
+SREF = 0x0A00
+AREF = 0x0B00
+LAYER = 0x0D02
+DATATYPE = 0x0E02
+XY = 0x1003
+ENDEL = 0x1100
+SNAME = 0x1206
+COLROW = 0x1302
+
+# Elements the reader counts without measuring them: PATH, TEXT, NODE
+# and BOX.
+_OTHER_ELEMENTS = (0x0900, 0x0C00, 0x1500, 0x2D00)
+
+# Maximum number of vertices of a BOUNDARY, the closing vertex included,
+# that fits in the XY record.
+MAX_VERTICES = 8191
+
+_STREAM_VERSION = 600
+
+# Halfwords of the file scanned at a time for BOUNDARY elements
+_READ_WINDOW = 2 ** 24
+
+
+def eight_byte_real(value):
+    """Encodes a number in the GDSII 8 byte real format.
+
+    Args:
+        value: number to be encoded.
+
+    Returns:
+        The 8 bytes representing the number.
+    """
+    if value == 0:
+        return b'\x00' * 8
+
+    sign = 0
+    if value < 0:
+        sign = 0x80
+        value = -value
+
+    # The mantissa is a 56 bit fraction and the exponent is a power of 16
+    # with an excess of 64.
+    exponent = 64
+    while value >= 1:
+        value /= 16.0
+        exponent += 1
+    while value < 1.0 / 16:
+        value *= 16.0
+        exponent -= 1
+
+    mantissa = int(round(value * 2 ** 56))
+    if mantissa == 2 ** 56:
+        mantissa = 2 ** 52
+        exponent += 1
+    return struct.pack('>BB', sign | exponent, (mantissa >> 48) & 0xff) + \
+        struct.pack('>HL', (mantissa >> 32) & 0xffff, mantissa & 0xffffffff)
+
+
+def decode_real(data):
+    """Decodes a number in the GDSII 8 byte real format, see eight_byte_real."""
+    data = bytes(data)
+    exponent = (bytearray(data)[0] & 0x7f) - 64
+    mantissa = struct.unpack('>Q', b'\x00' + data[1:8])[0]
+    value = mantissa / 2.0 ** 56 * 16.0 ** exponent
+    return -value if bytearray(data)[0] & 0x80 else value
+
+
+def encode_boundaries(points, counts, layer, datatype, multiplier):
+    """Encodes polygons as GDSII BOUNDARY elements.
+
+    Every element is made of 32 bit big-endian words: the BOUNDARY, LAYER,
+    DATATYPE and XY headers take 5 words, followed by the coordinates with
+    the first vertex repeated at the end and the ENDEL record. All the
+    elements are laid out in a single array and converted to bytes at once.
+
+    Args:
+        points: (M,2) array with the vertices of all the polygons one after
+                the other.
+        counts: number of vertices of each polygon.
+        layer: GDSII layer of the polygons, one for all of them or one for
+               each polygon.
+        datatype: GDSII datatype of the polygons, like layer.
+        multiplier: factor that converts the coordinates to database units
+                    (unit/precision).
+
+    Returns:
+        The bytes of the BOUNDARY elements.
+
+    Raises:
+        ValueError: If a polygon has too many vertices or a coordinate does
+                    not fit in the database units.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    counts = np.asarray(counts, dtype=np.int64).reshape(-1)
+    if len(counts) == 0:
+        return b''
+
+    if counts.max() + 1 > MAX_VERTICES:
+        raise ValueError("Polygons can not have more than {0} vertices".format(MAX_VERTICES - 1))
+
+    scaled = np.round(points * multiplier)
+    if len(scaled) and np.abs(scaled).max() > np.iinfo(np.int32).max:
+        raise ValueError("Coordinates do not fit in the GDSII database units")
+    scaled = scaled.astype(np.int32)
+
+    # Closing every polygon with its first vertex
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    closed = np.insert(scaled, ends, scaled[starts], axis=0)
+
+    words = 6 + 2 * (counts + 1)
+    record_starts = np.cumsum(words) - words
+
+    layer = np.asarray(layer, dtype=np.int64)
+    datatype = np.asarray(datatype, dtype=np.int64)
+
+    headers = np.empty((len(counts), 5), dtype=np.uint32)
+    headers[:, 0] = (4 << 16) | BOUNDARY
+    headers[:, 1] = (6 << 16) | LAYER
+    headers[:, 2] = (layer << 16) | 6
+    headers[:, 3] = (DATATYPE << 16) | datatype
+    headers[:, 4] = ((4 + 8 * (counts + 1)) << 16) | XY
+
+    out = np.empty(words.sum(), dtype='>i4')
+    is_coordinate = np.ones(len(out), dtype=bool)
+
+    header_index = record_starts[:, np.newaxis] + np.arange(5)
+    endel_index = record_starts + words - 1
+    is_coordinate[header_index] = False
+    is_coordinate[endel_index] = False
+
+    out[header_index] = headers.view(np.int32)
+    out[endel_index] = np.array([(4 << 16) | ENDEL], dtype=np.uint32).view(np.int32)
+    out[is_coordinate] = closed.reshape(-1)
+
+    return out.tobytes()
+
+
+def _timestamp():
+    now = datetime.datetime.today()
+    return (now.year, now.month, now.day, now.hour, now.minute, now.second)
+
+
+def _name_record(record, name):
+    if len(name) % 2 != 0:
+        name = name + '\0'
+    return struct.pack('>2h', 4 + len(name), record) + name.encode('ascii')
+
+
+class StreamWriter:
+    """Writes a GDSII library to disk while its top cell is being generated.
+
+    The header of the library and the beginning of the top cell are written
+    when the writer is created. Elements are then appended to the top cell
+    as soon as they are generated, so they can be released from memory
+    right after. Cells referenced by the top cell (pillar cells) are
+    written after it when the writer is closed.
+
+    Example:
+        writer = StreamWriter('mask.gds', 'WAFER')
+        writer.write([polygon, polygon_set])
+        writer.add_cell(pillar_cell)
+        writer.close()
+
+    Atributes:
+        bytes_written: Size of the stream written so far.
+    """
+
+    def __init__(self, outfile, cell_name, name='library', unit=1.0e-6, precision=1.0e-9):
+        if isinstance(outfile, str):
+            self._outfile = open(outfile, 'wb')
+            self._close = True
+        else:
+            self._outfile = outfile
+            self._close = False
+
+        self.unit = unit
+        self.precision = precision
+        self.bytes_written = 0
+
+        self._multiplier = unit / precision
+        self._cells = []
+        self._cell_names = set()
+
+        timestamp = _timestamp()
+        self._write(struct.pack('>3h', 6, HEADER, _STREAM_VERSION) +
+                    struct.pack('>14h', 28, BGNLIB, *(timestamp + timestamp)) +
+                    _name_record(LIBNAME, name) +
+                    struct.pack('>2h', 20, UNITS) +
+                    eight_byte_real(precision / unit) +
+                    eight_byte_real(precision))
+
+        self._write(struct.pack('>14h', 28, BGNSTR, *(timestamp + timestamp)) +
+                    _name_record(STRNAME, cell_name))
+
+    def _write(self, data):
+        self._outfile.write(data)
+        self.bytes_written += len(data)
+
+    def write(self, elements):
+        """Appends gdspy elements to the top cell.
+
+        Args:
+            elements: Polygon, PolygonSet, PolygonBatch, CellReference or
+                      CellArray objects.
+        """
+        for element in elements:
+            self._write(element.to_gds(self._multiplier))
+
+    def add_cell(self, cell):
+        """Registers a cell referenced by the top cell.
+
+        The cell is written when the writer is closed, registering it more
+        than once has no effect.
+
+        Args:
+            cell: gdspy.Cell to be included in the library.
+        """
+        if cell.name not in self._cell_names:
+            self._cell_names.add(cell.name)
+            self._cells.append(cell)
+
+    def close(self):
+        """Finishes the top cell, writes the referenced cells and ends the library."""
+        self._write(struct.pack('>2h', 4, ENDSTR))
+
+        for cell in self._cells:
+            self._write(cell.to_gds(self._multiplier))
+
+        self._write(struct.pack('>2h', 4, ENDLIB))
+        if self._close:
+            self._outfile.close()
+
+
+def read_summary(path, regions=None, digest=True):
+    """Tallies the contents of a GDSII file without loading it.
+
+    The file is memory mapped and walked record by record. Runs of
+    BOUNDARY elements, which make almost all of a generated mask, are
+    located and measured with numpy a window of the file at a time, so no
+    Python object is created for them and the memory used does not grow
+    with the size of the file. References are assumed to have no
+    rotation, reflection or magnification, like the ones written by the
+    generator.
+
+    Args:
+        path: path of the .gds file.
+        regions: optional dictionary from a name to the (x_min, x_max,
+                 y_min, y_max) of a region in user units. The polygons of
+                 the top cells are counted in the region holding the center
+                 of their bounding box, and the references in the one
+                 holding their origin.
+        digest: If True the SHA-256 of the file is calculated, with the
+                modification times of the library and the cells taken as
+                zero, so two generations of the same mask get the same
+                digest. (default True)
+
+    Returns:
+        Dictionary with:
+            library: name of the library.
+            unit, precision: user unit and database unit in meters.
+            cells: dictionary from cell name to its own polygons, vertices,
+                   references, instances placed by them and other elements.
+            top_cells: names of the cells that are not referenced.
+            polygons, vertices: totals of the top cells, every instance of
+                                a referenced cell counted.
+            layers: dictionary from (layer, datatype) to the polygons,
+                    vertices and bounding_box of the layer, like the totals.
+            bounding_box: (x_min, x_max, y_min, y_max) of all the polygons
+                          in user units, None if there are none.
+            regions: dictionary from region name to its polygons and vertices.
+            digest: hexadecimal digest or None.
+            bytes: size of the file.
+
+    Raise:
+        ValueError: If the file is not a GDSII stream.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else np.empty(0, dtype=np.uint8)
+    if len(data) < 4 or len(data) % 2 != 0 or struct.unpack('>2H', data[:4].tobytes())[1] != HEADER:
+        raise ValueError("{0} is not a GDSII stream".format(path))
+
+    reader = _Reader(data, regions or {}, hashlib.sha256() if digest else None)
+    reader.walk()
+    return reader.summary()
+
+
+class _Reader:
+    """State of read_summary while it walks a file."""
+
+    def __init__(self, data, regions, hasher):
+        self.data = data
+        self.words = data.view('>u2')
+        self.region_names = list(regions)
+        self.region_boxes = np.array([regions[name] for name in self.region_names], dtype=float).reshape(-1, 4)
+        self.hasher = hasher
+
+        self.library = None
+        self.db_in_user = 1.0
+        self.db_in_meters = 1.0e-9
+        self.cells = collections.OrderedDict()
+        self.cell = None
+        self.element = None
+
+    def walk(self):
+        position = 0
+        while position < len(self.words) - 1:
+            length, record = int(self.words[position]), int(self.words[position + 1])
+            if length < 4 or length % 2 != 0:
+                raise ValueError("Invalid record at byte {0}".format(2 * position))
+
+            if record == BOUNDARY and self.cell is not None and self.element is None:
+                end = self._boundaries(position)
+                if end > position:
+                    self._hash(position, end)
+                    position = end
+                    continue
+
+            end = position + length // 2
+            self._record(record, position, end)
+            position = end
+            if record == ENDLIB:
+                break
+
+    def summary(self):
+        flat = {}
+        referenced = set(reference[0] for cell in self.cells.values() for reference in cell['references'])
+        top_cells = [name for name in self.cells if name not in referenced]
+
+        layers = {}
+        regions = dict((name, {'polygons': 0, 'vertices': 0}) for name in self.region_names)
+        for name in top_cells:
+            for key, tally in self._flatten(name, flat).items():
+                _merge_layer(layers, key, tally, 1, (0, 0))
+
+            cell = self.cells[name]
+            for index, region in enumerate(self.region_names):
+                regions[region]['polygons'] += int(cell['regions'][index, 0])
+                regions[region]['vertices'] += int(cell['regions'][index, 1])
+
+            for sname, columns, rows, points in cell['references']:
+                index = self._region_of(points[:1] * self.db_in_user)[0]
+                if index >= 0 and sname in self.cells:
+                    child = self._flatten(sname, flat)
+                    region = regions[self.region_names[index]]
+                    region['polygons'] += columns * rows * sum(tally[0] for tally in child.values())
+                    region['vertices'] += columns * rows * sum(tally[1] for tally in child.values())
+
+        bounding_box = None
+        result_layers = {}
+        for key, (polygons, vertices, x_min, x_max, y_min, y_max) in sorted(layers.items()):
+            box = tuple(value * self.db_in_user for value in (x_min, x_max, y_min, y_max))
+            result_layers[key] = {'polygons': polygons, 'vertices': vertices, 'bounding_box': box}
+            if bounding_box is None:
+                bounding_box = box
+            else:
+                bounding_box = (min(bounding_box[0], box[0]), max(bounding_box[1], box[1]),
+                                min(bounding_box[2], box[2]), max(bounding_box[3], box[3]))
+
+        cells = {}
+        for name, cell in self.cells.items():
+            cells[name] = {'polygons': sum(tally[0] for tally in cell['layers'].values()),
+                           'vertices': sum(tally[1] for tally in cell['layers'].values()),
+                           'references': len(cell['references']),
+                           'instances': sum(columns * rows for _, columns, rows, _ in cell['references']),
+                           'other': cell['other']}
+
+        return {'library': self.library,
+                'unit': self.db_in_meters / self.db_in_user,
+                'precision': self.db_in_meters,
+                'cells': cells,
+                'top_cells': top_cells,
+                'polygons': sum(layer['polygons'] for layer in result_layers.values()),
+                'vertices': sum(layer['vertices'] for layer in result_layers.values()),
+                'layers': result_layers,
+                'bounding_box': bounding_box,
+                'regions': regions,
+                'digest': self.hasher.hexdigest() if self.hasher is not None else None,
+                'bytes': len(self.data)}
+
+    def _flatten(self, name, flat, parents=()):
+        """Layers of a cell with the ones of the cells it references."""
+        if name in flat:
+            return flat[name]
+        if name in parents:
+            raise ValueError("The cell {0} references itself".format(name))
+
+        cell = self.cells[name]
+        layers = dict((key, list(tally)) for key, tally in cell['layers'].items())
+        for sname, columns, rows, points in cell['references']:
+            if sname not in self.cells:
+                continue
+
+            # Instances at the corners of the array bound the rest
+            origin = points[0]
+            corners = [origin]
+            if len(points) == 3:
+                step_column = (points[1] - origin) / columns
+                step_row = (points[2] - origin) / rows
+                corners += [origin + (columns - 1) * step_column,
+                            origin + (rows - 1) * step_row,
+                            origin + (columns - 1) * step_column + (rows - 1) * step_row]
+            corners = np.array(corners)
+
+            for key, tally in self._flatten(sname, flat, parents + (name,)).items():
+                _merge_layer(layers, key, tally, columns * rows, corners)
+
+        flat[name] = layers
+        return layers
+
+    def _new_cell(self, name):
+        self.cell = {'layers': {},
+                     'regions': np.zeros((len(self.region_names), 2), dtype=np.int64),
+                     'references': [],
+                     'other': 0}
+        self.cells[name] = self.cell
+
+    def _hash(self, start, end):
+        if self.hasher is not None:
+            self.hasher.update(self.data[2 * start:2 * end])
+
+    def _record(self, record, start, end):
+        """Handles a record that is not part of a run of BOUNDARY elements."""
+        body = self.data[2 * start + 4:2 * end]
+
+        if record in (BGNLIB, BGNSTR):
+            # The modification times are left out of the digest
+            if self.hasher is not None:
+                self.hasher.update(self.data[2 * start:2 * start + 4])
+                self.hasher.update(b'\x00' * len(body))
+        else:
+            self._hash(start, end)
+
+        if record == LIBNAME:
+            self.library = body.tobytes().rstrip(b'\x00').decode('ascii', 'replace')
+        elif record == UNITS:
+            self.db_in_user = decode_real(body[:8])
+            self.db_in_meters = decode_real(body[8:16])
+        elif record == STRNAME:
+            self._new_cell(body.tobytes().rstrip(b'\x00').decode('ascii', 'replace'))
+        elif record == ENDSTR:
+            self.cell = None
+        elif record in (BOUNDARY, SREF, AREF) or record in _OTHER_ELEMENTS:
+            self.element = {'type': record, 'layer': 0, 'datatype': 0, 'columns': 1, 'rows': 1}
+        elif self.element is not None:
+            if record == LAYER:
+                self.element['layer'] = struct.unpack('>H', body[:2].tobytes())[0]
+            elif record == DATATYPE:
+                self.element['datatype'] = struct.unpack('>H', body[:2].tobytes())[0]
+            elif record == SNAME:
+                self.element['sname'] = body.tobytes().rstrip(b'\x00').decode('ascii', 'replace')
+            elif record == COLROW:
+                self.element['columns'], self.element['rows'] = struct.unpack('>2h', body[:4].tobytes())
+            elif record == XY:
+                self.element['xy'] = body.view('>i4').astype(np.int64).reshape(-1, 2)
+            elif record == ENDEL:
+                self._element(self.element)
+                self.element = None
+
+    def _element(self, element):
+        """Tallies an element read record by record."""
+        if self.cell is None:
+            return
+
+        if element['type'] == BOUNDARY and 'xy' in element:
+            xy = element['xy']
+            self._tally(np.array([element['layer']]), np.array([element['datatype']]), np.array([len(xy) - 1]),
+                        *[np.array([value]) for value in (xy[:, 0].min(), xy[:, 0].max(),
+                                                          xy[:, 1].min(), xy[:, 1].max())])
+        elif element['type'] in (SREF, AREF) and 'xy' in element:
+            self.cell['references'].append((element.get('sname'), element['columns'], element['rows'],
+                                            element['xy'].astype(float)))
+        else:
+            self.cell['other'] += 1
+
+    def _boundaries(self, position):
+        """Tallies the run of BOUNDARY elements starting at a position.
+
+        The window of the file after the position is searched for the
+        records of BOUNDARY elements laid out as the writers of this
+        package and gdspy do, and the run is the elements that follow each
+        other from the position.
+
+        Returns:
+            Halfword where the run ends, the position if there is no run.
+        """
+        words = np.asarray(self.words[position:min(position + _READ_WINDOW, len(self.words))])
+        size = len(words) - 10
+        if size <= 0:
+            return position
+
+        starts = np.flatnonzero((words[:size] == 4) & (words[1:size + 1] == BOUNDARY) &
+                                (words[2:size + 2] == 6) & (words[3:size + 3] == LAYER) &
+                                (words[5:size + 5] == 6) & (words[6:size + 6] == DATATYPE) &
+                                (words[9:size + 9] == XY))
+        if len(starts) == 0 or starts[0] != 0:
+            return position
+
+        xy_words = words[starts + 8].astype(np.int64) // 2
+        ends = starts + 10 + xy_words
+        valid = (ends <= len(words)) & (xy_words >= 6) & ((xy_words - 2) % 4 == 0)
+        endel = np.minimum(ends, len(words)) - 2
+        valid &= (words[endel] == 4) & (words[endel + 1] == ENDEL)
+
+        chained = np.ones(len(starts), dtype=bool)
+        chained[1:] = starts[1:] == ends[:-1]
+        run = int(np.argmin(valid & chained)) if not (valid & chained).all() else len(starts)
+        if run == 0:
+            return position
+
+        starts, ends, xy_words = starts[:run], ends[:run], xy_words[:run]
+        layers = words[starts + 4].astype(np.int64)
+        datatypes = words[starts + 7].astype(np.int64)
+        vertices = (xy_words - 2) // 4
+
+        # Coordinates are read as (x, y) pairs of 32 bit words. Elements are
+        # grouped by the alignment of their coordinates, so the pairs of
+        # each group are the rows of one view of the file.
+        boxes = np.empty((run, 4), dtype=np.int64)
+        first = starts + 10
+        for alignment in range(4):
+            group = np.flatnonzero(first % 4 == alignment)
+            if len(group) == 0:
+                continue
+
+            rows = (first[group] - alignment) // 4
+            last = rows + vertices[group]
+            offset = 2 * (position + alignment)
+            pairs = self.data[offset:offset + 8 * int(last[-1])].view('>i4').reshape(-1, 2)
+
+            # Every other range is the gap between two elements
+            bounds = np.column_stack((rows, last)).reshape(-1)[:-1]
+            for column, (low, high) in enumerate(((0, 1), (2, 3))):
+                values = pairs[:, column]
+                boxes[group, low] = np.minimum.reduceat(values, bounds)[::2]
+                boxes[group, high] = np.maximum.reduceat(values, bounds)[::2]
+
+        self._tally(layers, datatypes, vertices - 1, *boxes.T)
+        return position + int(ends[-1])
+
+    def _tally(self, layers, datatypes, vertices, x_min, x_max, y_min, y_max):
+        """Adds polygons to the layers and regions of the current cell."""
+        unique, inverse = np.unique(layers * 2 ** 16 + datatypes, return_inverse=True)
+        polygons = np.bincount(inverse)
+        counts = np.bincount(inverse, weights=vertices)
+
+        for index, key in enumerate(unique.tolist()):
+            selection = inverse == index if len(unique) > 1 else slice(None)
+            tally = (int(polygons[index]), int(counts[index]),
+                     int(x_min[selection].min()), int(x_max[selection].max()),
+                     int(y_min[selection].min()), int(y_max[selection].max()))
+            _merge_layer(self.cell['layers'], divmod(key, 2 ** 16), tally, 1, (0, 0))
+
+        if len(self.region_names):
+            centers = np.column_stack(((x_min + x_max) / 2.0, (y_min + y_max) / 2.0)) * self.db_in_user
+            regions = self._region_of(centers)
+            inside = regions >= 0
+            self.cell['regions'][:, 0] += np.bincount(regions[inside], minlength=len(self.region_names))
+            self.cell['regions'][:, 1] += np.bincount(regions[inside], weights=vertices[inside],
+                                                      minlength=len(self.region_names)).astype(np.int64)
+
+    def _region_of(self, points):
+        """Index of the region holding every point, -1 if none does."""
+        regions = np.full(len(points), -1, dtype=np.int64)
+        for index, (x_min, x_max, y_min, y_max) in enumerate(self.region_boxes):
+            inside = ((points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+                      (points[:, 1] >= y_min) & (points[:, 1] <= y_max))
+            regions[inside & (regions < 0)] = index
+        return regions
+
+
+def _merge_layer(layers, key, tally, instances, offsets):
+    """Adds the tally of a layer, placed at some offsets, to a dictionary of layers.
+
+    Tallies are [polygons, vertices, x_min, x_max, y_min, y_max].
+    """
+    offsets = np.asarray(offsets, dtype=float).reshape(-1, 2)
+    polygons, vertices, x_min, x_max, y_min, y_max = tally
+    box = (x_min + offsets[:, 0].min(), x_max + offsets[:, 0].max(),
+           y_min + offsets[:, 1].min(), y_max + offsets[:, 1].max())
+
+    if key not in layers:
+        layers[key] = [0, 0, box[0], box[1], box[2], box[3]]
+    merged = layers[key]
+    merged[0] += polygons * instances
+    merged[1] += vertices * instances
+    merged[2] = min(merged[2], box[0])
+    merged[3] = max(merged[3], box[1])
+    merged[4] = min(merged[4], box[2])
+    merged[5] = max(merged[5], box[3])
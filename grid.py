@@ -2,6 +2,9 @@ import numpy as np
 
 def generate_grid_region(distance, thickness, x, y, width, height): 
     """Generate Grid structures in a specific area.
+
+    Thin wrapper around generate_grid_walls that returns the corners of
+    each "wall" as tuples.
     
     Args:
         distance: Distance from the center of one "wall" to the other.
@@ -15,7 +18,154 @@ def generate_grid_region(distance, thickness, x, y, width, height):
         (horizontal_points, vertical_points): Set of points in each 
             direction.
     """
+    horizontal, vertical = generate_grid_walls(distance, thickness, x, y, width, height)
+
+    # Each "wall" is a rectangle determined by 2 coordinates in oposite vertices    
+    horizontal_points = [(tuple(wall[0]), tuple(wall[2])) for wall in horizontal.tolist()]
+    vertical_points = [(tuple(wall[0]), tuple(wall[2])) for wall in vertical.tolist()]
+
+    return (horizontal_points, vertical_points)
+
+def generate_grid_walls(distance, thickness, x, y, width, height, walls_x=None, walls_y=None):
+    """Generate the "walls" of a Grid structure in a specific area.
+
+    Args:
+        distance: Distance from the center of one "wall" to the other.
+        thickness: Distance from one edge of the "wall" to the other.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+        walls_x: slice of the walls along x to be generated. (default all)
+        walls_y: slice of the walls along y to be generated. (default all)
+
+    return:
+        (horizontal, vertical): (N,4,2) arrays with the vertices of the
+            rectangular "walls" along each axis.
+    """
+    start_x, start_y, _, walls_x_axis, walls_y_axis = generate_grid_lattice(distance, thickness,
+                                                                              x, y, width, height)
+
+    corners = start_x + np.arange(walls_x_axis)[walls_x or slice(None)] * distance
+    horizontal = rectangles(corners, y, corners + thickness, y - height)
+
+    corners = start_y - np.arange(walls_y_axis)[walls_y or slice(None)] * distance
+    vertical = rectangles(x, corners, x + width, corners - thickness)
+
+    return (horizontal, vertical)
+
+def generate_grid_pieces(distance, thickness, x, y, width, height, walls_x=None, walls_y=None):
+    """Generate the "walls" of a Grid structure without overlaps.
+
+    The walls along x are whole, like in generate_grid_walls, and the walls
+    along y are split where they cross them, so every crossing is drawn
+    once.
+
+    Args:
+        distance: Distance from the center of one "wall" to the other.
+        thickness: Distance from one edge of the "wall" to the other.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+        walls_x: slice of the walls along x to be generated. (default all)
+        walls_y: slice of the walls along y to be split. (default all)
+
+    return:
+        (horizontal, pieces): (N,4,2) arrays with the vertices of the walls
+            along x and of the pieces of the walls along y, wall by wall.
+    """
+    start_x, start_y, _, walls_x_axis, walls_y_axis = generate_grid_lattice(distance, thickness,
+                                                                              x, y, width, height)
+    horizontal, _ = generate_grid_walls(distance, thickness, x, y, width, height, walls_x, slice(0, 0))
+
+    starts, ends = gaps(x, x + width, start_x + np.arange(walls_x_axis) * distance, thickness)
+    corners = start_y - np.arange(walls_y_axis)[walls_y or slice(None)] * distance
+    pieces = rectangles(*np.broadcast_arrays(starts, corners[:, np.newaxis], ends, corners[:, np.newaxis] - thickness))
+
+    return (horizontal, pieces)
+
+def generate_grid_cell(distance, thickness):
+    """Generate the unit cell of a Grid structure.
+
+    The cell is one crossing with the wall along x below it and the wall
+    along y to its right, so the cells repeated every distance along both
+    axes draw the grid without overlaps. Its origin is the top left corner
+    of the crossing.
+
+    return:
+        (N,4,2) array with the vertices of the rectangles of the cell.
+    """
+    cell = rectangles([0, thickness], [-distance, -thickness], [thickness, distance], [0, 0])
+    return cell[:1] if distance <= thickness else cell
+
+def generate_grid_edges(distance, thickness, x, y, width, height, walls_x=None, walls_y=None):
+    """Generate the ends of the "walls" of a Grid left out by its unit cells.
+
+    The unit cells cover the lattice of the walls, the walls along x go on
+    to the top and bottom of the drawing area and the walls along y to its
+    left and right.
+
+    Args:
+        distance: Distance from the center of one "wall" to the other.
+        thickness: Distance from one edge of the "wall" to the other.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+        walls_x: slice of the cells along x, the walls along x get their
+                 top end if it starts at the first cell and their bottom
+                 end if it reaches the last one. The walls along y get their
+                 ends in the same way. (default all)
+        walls_y: slice of the cells along y. (default all)
 
+    return:
+        (N,4,2) array with the vertices of the ends, empty ones left out.
+    """
+    start_x, start_y, _, walls_x_axis, walls_y_axis = generate_grid_lattice(distance, thickness,
+                                                                              x, y, width, height)
+    columns = range(walls_x_axis)[walls_x or slice(None)]
+    rows = range(walls_y_axis)[walls_y or slice(None)]
+    end_x = start_x + walls_x_axis * distance
+    end_y = start_y - walls_y_axis * distance
+
+    if len(columns) == 0 or len(rows) == 0:
+        return np.empty((0, 4, 2))
+
+    corners_x = start_x + np.asarray(columns, dtype=float) * distance
+    corners_y = start_y - np.asarray(rows, dtype=float) * distance
+
+    edges = []
+    if rows[0] == 0:
+        edges.append(rectangles(corners_x, y, corners_x + thickness, start_y))
+    if rows[-1] == walls_y_axis - 1:
+        edges.append(rectangles(corners_x, end_y, corners_x + thickness, y - height))
+    if columns[0] == 0:
+        edges.append(rectangles(x, corners_y, start_x, corners_y - thickness))
+    if columns[-1] == walls_x_axis - 1:
+        edges.append(rectangles(end_x, corners_y, x + width, corners_y - thickness))
+
+    edges = np.concatenate(edges) if edges else np.empty((0, 4, 2))
+    # The walls can fill the area exactly, leaving empty ends
+    sizes = np.abs(edges[:, 2] - edges[:, 0])
+    return edges[(sizes > 0).all(axis=1)]
+
+def generate_grid_lattice(distance, thickness, x, y, width, height):
+    """Calculates where the "walls" of a Grid structure go within the drawing area.
+
+    Args:
+        distance: Distance from the center of one "wall" to the other.
+        thickness: Distance from one edge of the "wall" to the other.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+
+    return:
+        (start_x, start_y, pair_distance, walls_x_axis, walls_y_axis): Left
+            edge of the first wall along x, top edge of the first wall along y,
+            distance between walls and number of walls along each axis.
+    """
     pair_distance = thickness + (distance - thickness)
 
     walls_x_axis = int(width / pair_distance)
@@ -25,17 +175,39 @@ def generate_grid_region(distance, thickness, x, y, width, height):
     # middle of the area
     gap_x_axis = (width - (walls_x_axis * pair_distance))/2 #gap both sides of the rectangle
     gap_y_axis = (height - (walls_y_axis * pair_distance))/2
-        
-    # Each "wall" is a rectangle determined by 2 coordinates in oposite vertices    
-    horizontal_points = []
-    vertical_points = []
 
-    for col in range(0, walls_x_axis):
-        corner = x + gap_x_axis + col*distance
-        horizontal_points.append(((corner, y),(corner + thickness, y - height)))
+    return (x + gap_x_axis, y - gap_y_axis, pair_distance, walls_x_axis, walls_y_axis)
 
-    for row in range(0, walls_y_axis):
-        corner = y - gap_y_axis - row*distance
-        vertical_points.append(((x , corner),(x + width,corner - thickness)))
+def gaps(lo, hi, corners, thickness):
+    """Ranges of an axis between lo and hi left free by walls starting at corners.
 
-    return (horizontal_points, vertical_points)
+    return:
+        (starts, ends): arrays with the limits of the ranges that are not
+            empty.
+    """
+    starts = np.concatenate(([lo], corners + thickness))
+    ends = np.concatenate((corners, [hi]))
+    free = ends > starts
+    return starts[free], ends[free]
+
+def rectangles(x1, y1, x2, y2):
+    """Builds rectangles from the coordinates of 2 oposite vertices.
+
+    The vertices follow the same order as gdspy.Rectangle. Any of the
+    coordinates can be an array, the rest are broadcasted to it.
+
+    return:
+        (N,4,2) array with the vertices of each rectangle.
+    """
+    x1, y1, x2, y2 = np.broadcast_arrays(*[np.asarray(c, dtype=float).reshape(-1) for c in (x1, y1, x2, y2)])
+
+    vertices = np.empty((len(x1), 4, 2))
+    vertices[:, 0, 0] = x1
+    vertices[:, 0, 1] = y1
+    vertices[:, 1, 0] = x1
+    vertices[:, 1, 1] = y2
+    vertices[:, 2, 0] = x2
+    vertices[:, 2, 1] = y2
+    vertices[:, 3, 0] = x2
+    vertices[:, 3, 1] = y1
+    return vertices
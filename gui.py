@@ -1,24 +1,88 @@
-import thread
+import os
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 try:
     import Tkinter as tk
 except ImportError as error:
     import tkinter as tk
 
-import ttk
-from wafer import Wafer
+try:
+    import ttk
+except ImportError as error:
+    from tkinter import ttk
+
+try:
+    import tkMessageBox as messagebox
+except ImportError as error:
+    from tkinter import messagebox
+
+try:
+    import Queue as queue
+except ImportError as error:
+    import queue
+
+from wafer import Wafer, GenerationCancelled
+from observers import Observer
+from estimate import estimate
+from cli import wafer_job
+import preview
 
 __version__ = '0.1.1'
 __author__ = 'Manuel Garcia'
 
+# Milliseconds between two checks of the progress of a generation
+PROGRESS_INTERVAL = 100
+
+# Side of the preview of the wafer in pixels
+PREVIEW_SIZE = 320
+
+# Seconds between two checks of a job sent to a server
+SERVER_INTERVAL = 1
+
+
+class ProgressObserver(Observer):
+    """Sends the events of a generation to the queue polled by the window.
+
+    The generation runs in another thread, the window is only changed
+    from the Tk loop.
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def notify(self, event):
+        self.messages.put(('phase', event))
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    if minutes:
+        return "{0}m {1:02d}s".format(minutes, seconds)
+    return "{0}s".format(seconds)
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return "{0:.1f} {1}".format(size, unit)
+        size /= 1024.0
+
 
 class AppGUI(tk.Tk):
 
     def __init__(self):
         tk.Tk.__init__(self)
 
-        self.wafer = Wafer(Wafer.SIZE_2_IN, 5)
+        self.wafer = Wafer(Wafer.SIZE_2_IN, 5, cache=True)
+
+        # Generations run one at a time out of the Tk loop
+        self.executor = ThreadPool(1)
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.status_timer = None
+
         self.initialize()
         
         self.update_sections()
@@ -27,9 +91,11 @@ class AppGUI(tk.Tk):
         self.section_selector_cmb.current(0)
         self.structure_selector_cmb.current(0)
         self.wafer_size_selector_cmb.current(0)
+        self.format_selector_cmb.current(0)
         self.radius_ent.insert(0, '0.0')
         self.distance_ent.insert(0, '0.0')
         self.filename_ent.insert(0, self.wafer.DEFAULT_FILENAME)
+        self.layout_changed()
 
     def disable_controls(self, state):
         state_text = 'normal'
@@ -40,6 +106,8 @@ class AppGUI(tk.Tk):
         self.rows_ent.config(state=state_text)
         self.cols_ent.config(state=state_text)
         self.filename_ent.config(state=state_text)
+        self.format_selector_cmb.config(state=state_text)
+        self.server_ent.config(state=state_text)
         self.distance_ent.config(state=state_text)
         self.radius_ent.config(state=state_text)
         self.generate_sections_btn.config(state=state_text)
@@ -48,19 +116,147 @@ class AppGUI(tk.Tk):
         self.structure_selector_cmb.config(state=state_text)
         self.wafer_size_selector_cmb.config(state=state_text)       
          
-    def generation_safe_thread(self, filename):
-        self.wafer.generate_setups(filename)
-        self.set_status_bar("Done creating file!", 2)
-        self.disable_controls(False)
+    def generation_worker(self, filename, file_format):
+        """Generates the file, runs in the executor thread."""
+        try:
+            self.wafer.generate_setups(filename,
+                                       observer=ProgressObserver(self.messages),
+                                       cancel=self.cancel_event,
+                                       file_format=file_format)
+            self.messages.put(('done', filename))
+        except GenerationCancelled:
+            self.messages.put(('cancelled', '{0}.{1}'.format(filename, file_format)))
+        except Exception as e:
+            self.messages.put(('error', '{0}: {1}'.format(type(e).__name__, e)))
+
+    def server_worker(self, url, filename, file_format):
+        """Submits the file to a job server and downloads it, runs in the executor thread."""
+        # The server module needs Python 3, the rest of the window does not
+        import server
+
+        path = '{0}.{1}'.format(filename, file_format)
+        try:
+            job_id = server.submit(url, wafer_job(self.wafer, os.path.basename(filename), file_format))
+            cancelled = False
+            while True:
+                if self.cancel_event.is_set() and not cancelled:
+                    cancelled = True
+                    try:
+                        server.cancel(url, job_id)
+                    except ValueError:
+                        # Finished meanwhile
+                        pass
+
+                status = server.job_status(url, job_id)
+                if status['status'] not in (server.QUEUED, server.RUNNING):
+                    break
+                self.messages.put(('server', status))
+                time.sleep(SERVER_INTERVAL)
+
+            if status['status'] == server.OK:
+                server.download(url, job_id, path)
+                self.messages.put(('done', filename))
+            elif status['status'] == server.CANCELLED:
+                self.messages.put(('cancelled', path))
+            else:
+                self.messages.put(('error', status['error']))
+        except Exception as e:
+            self.messages.put(('error', '{0}: {1}'.format(type(e).__name__, e)))
 
     def generate(self):
+        file_format = self.wafer.FORMATS[self.format_selector_cmb.current()]
         filename = self.filename_ent.get()
+        url = self.server_ent.get().strip().rstrip('/')
+
+        report = self.update_estimate()
+        if report is not None and report['warnings']:
+            message = "\n".join(report['warnings'] + ["", "Create the file anyway?"])
+            if not messagebox.askyesno("Creating {0}.{1}".format(filename, file_format), message):
+                return
 
-        my_thread = thread.start_new_thread( self.generation_safe_thread, (filename,))
+        self.cancel_event.clear()
+        self.generation_sections = len(self.wafer.setups)
+        self.generation_done = 0
+        self.generation_start = time.time()
+
+        # Every section counts as one step, writing the file as another
+        self.progress_bar.config(maximum=self.generation_sections + 1, value=0)
         self.disable_controls(True)
+        self.cancel_btn.config(state='normal')
+        self.set_status_bar("Creating {0}.{1} file ...".format(filename, file_format), -1)
+
+        if url:
+            self.executor.apply_async(self.server_worker, (url, filename, file_format))
+        else:
+            self.executor.apply_async(self.generation_worker, (filename, file_format))
+        self.after(PROGRESS_INTERVAL, self.poll_progress)
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.cancel_btn.config(state='disabled')
+        self.set_status_bar("Cancelling after the current section ...", -1)
+
+    def poll_progress(self):
+        """Shows the messages sent by the generation since the last check."""
+        while True:
+            try:
+                kind, value = self.messages.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == 'phase':
+                self.show_progress(value)
+                continue
+            if kind == 'server':
+                self.show_server_progress(value)
+                continue
+
+            self.cancel_btn.config(state='disabled')
+            self.disable_controls(False)
+            if kind == 'done':
+                self.progress_bar.config(value=self.progress_bar['maximum'])
+                self.set_status_bar("Done creating file!", 2)
+            elif kind == 'cancelled':
+                self.progress_bar.config(value=0)
+                self.set_status_bar("Creating {0} cancelled".format(value), 2)
+            else:
+                self.progress_bar.config(value=0)
+                self.set_status_bar(value, -1)
+            return
+
+        self.after(PROGRESS_INTERVAL, self.poll_progress)
+
+    def show_progress(self, event):
+        if event['phase'] in ('emit', 'write'):
+            self.generation_done += 1
+            self.progress_bar.config(value=self.generation_done)
+
+        if event['section'] is not None:
+            message = "Section {0}/{1} ({2})".format(event['section'], self.generation_sections, event['phase'])
+        else:
+            message = "Creating file ({0})".format(event['phase'])
+
+        if self.generation_done:
+            elapsed = time.time() - self.generation_start
+            remaining = elapsed / self.generation_done * (self.generation_sections + 1 - self.generation_done)
+            message += " - ETA {0}".format(format_duration(remaining))
+
+        self.status_lbl.config(text=message)
+
+    def show_server_progress(self, status):
+        import server
+
+        if status['status'] == server.QUEUED:
+            message = "Queued on the server, {0} jobs before it".format(status['position'])
+        elif status['section'] is not None:
+            self.progress_bar.config(value=status['done'])
+            message = "Section {0}/{1} on the server ({2})".format(status['section'], status['sections'],
+                                                                   status['phase'])
+        else:
+            message = "Creating file on the server"
+
+        self.status_lbl.config(text=message)
 
-        self.set_status_bar("Creating {0}.gds file ...".format(filename), -1)
-        
     def generate_sections(self):
         number_rows = int(self.rows_ent.get())
         number_cols = int(self.cols_ent.get())
@@ -70,6 +266,7 @@ class AppGUI(tk.Tk):
         self.wafer.partition(number_rows, number_cols)
 
         self.update_sections()
+        self.layout_changed()
         
         self.set_status_bar("Maximum number of sections: {0}".format(number_rows*number_cols), 2)
 
@@ -97,11 +294,14 @@ class AppGUI(tk.Tk):
             self.structure_selector_cmb.current(0)
             self.radius_ent.insert(0, '0.0')
             self.distance_ent.insert(0, '0.0')
+
+        self.layout_changed()
     
     def wafer_size_changed(self, event):
         size = int(self.selected_wafer.get())
 
         self.wafer.change_wafer_size(size)
+        self.layout_changed()
 
     def save_section(self):
         section = int(self.selected_section.get())
@@ -112,8 +312,65 @@ class AppGUI(tk.Tk):
                              radius,
                              self.wafer.STRUCTURES[self.structure_selector_cmb.current()],
                              section)
+        self.layout_changed()
         self.set_status_bar("Section {0} saved!".format(section), 2)
 
+    def layout_changed(self):
+        """Updates everything that depends on the partition and the setups."""
+        self.update_estimate()
+        self.update_preview()
+
+    def update_estimate(self):
+        """Shows the estimated cost of the file and of the selected section.
+
+        Returns:
+            The report of estimate.estimate, None if it could not be estimated.
+        """
+        try:
+            report = estimate(self.wafer)
+        except Exception as e:
+            self.estimate_lbl.config(text="Could not estimate the file: {0}".format(e))
+            return None
+
+        lines = ["File: {0} structures, {1} vertices, {2}, {3} of memory, about {4}".format(
+            report['structures'], report['vertices'], format_bytes(report['file_size']),
+            format_bytes(report['peak_memory']), format_duration(report['seconds']))]
+
+        section = self.selected_section.get()
+        cost = report['sections'].get(int(section)) if section else None
+        if cost is not None:
+            lines.append("Section {0}: {1} structures ({2} clipped), {3} vertices, {4}".format(
+                section, cost['structures'], cost['clipped'], cost['vertices'], format_bytes(cost['file_size'])))
+
+        lines.extend(report['warnings'])
+        self.estimate_lbl.config(text="\n".join(lines), fg='red' if report['warnings'] else 'black')
+        return report
+
+    def update_preview(self):
+        """Draws the wafer, its sections and the density of the structures."""
+        self.preview_cnv.delete(tk.ALL)
+
+        transform = preview.view(self.wafer, PREVIEW_SIZE, PREVIEW_SIZE)
+        density = preview.density_map(self.wafer, PREVIEW_SIZE, PREVIEW_SIZE, transform)
+        self.preview_img = tk.PhotoImage(width=PREVIEW_SIZE, height=PREVIEW_SIZE)
+        self.preview_img.put(preview.image_data(density))
+        self.preview_cnv.create_image(0, 0, image=self.preview_img, anchor=tk.NW)
+
+        self.wafer._create_wafer_points()
+        for points, color in ((self.wafer.wafer_points, 'black'), (self.wafer.margin_points, 'gray')):
+            self.preview_cnv.create_polygon(*preview.to_pixels(points, transform).ravel(),
+                                            outline=color, fill='')
+
+        section = self.selected_section.get()
+        selected = int(section) if section else None
+        for number in range(1, self.wafer.num_sections + 1):
+            x, y, width, height = self.wafer._section_area(number)
+            (left, top), (right, bottom) = preview.to_pixels([(x, y), (x + width, y - height)], transform)
+            color = 'red' if number == selected else 'gray'
+            self.preview_cnv.create_rectangle(left, top, right, bottom, outline=color,
+                                              width=2 if number == selected else 1)
+            self.preview_cnv.create_text((left + right) / 2, (top + bottom) / 2, text=str(number), fill=color)
+
     def update_sections(self):
         self.section_selector_cmb['values'] = range(1, self.wafer.num_sections + 1)
     
@@ -155,14 +412,18 @@ class AppGUI(tk.Tk):
         if text == '':
             event.widget.insert(0, '1')
     
-    def reset_status_bar(self, delay):
-        if delay != -1:
-            time.sleep(delay)
-            self.status_lbl.config(text="...")
+    def reset_status_bar(self):
+        self.status_timer = None
+        self.status_lbl.config(text="...")
 
     def set_status_bar(self, message, delay):
+        if self.status_timer is not None:
+            self.after_cancel(self.status_timer)
+            self.status_timer = None
+
         self.status_lbl.config(text=message)
-        thread.start_new_thread( self.reset_status_bar, (delay,) )
+        if delay != -1:
+            self.status_timer = self.after(int(delay * 1000), self.reset_status_bar)
 
     def initialize(self):
         # creating outer containers
@@ -171,6 +432,8 @@ class AppGUI(tk.Tk):
         self.sectionsLayoutSection = tk.LabelFrame(self.optionSection, text="Sections Layout")
         self.sub_structureSection = tk.LabelFrame(self.structureSection, text='Structure')
         self.statusSection = tk.LabelFrame(self)
+        self.estimateSection = tk.LabelFrame(self, text="Estimate")
+        self.previewSection = tk.LabelFrame(self, text="Preview")
 
         # creating labels
         # self.sections_gen_lbl = tk.Label(self.optionSection, text="Sections layout:")
@@ -180,12 +443,14 @@ class AppGUI(tk.Tk):
         self.margin_lbl = tk.Label(self.sectionsLayoutSection, text="Margin (mm):")
 
         self.filename_lbl = tk.Label(self.optionSection, text="File name:")
+        self.server_lbl = tk.Label(self.optionSection, text="Server (empty for this machine):")
 
         self.section_lbl = tk.Label(self.structureSection, text="Selected Section:")
         self.distance_lbl = tk.Label(self.structureSection, text="Distance between structures(um):")
         self.radius_lbl = tk.Label(self.structureSection, text="Radius/length(um):")
        
         self.status_lbl = tk.Label(self.statusSection, text="Ready!")
+        self.estimate_lbl = tk.Label(self.estimateSection, text="", justify=tk.LEFT)
 
         # creating text fields
         self.rows_ent = tk.Entry(self.sectionsLayoutSection, width=10)
@@ -196,6 +461,7 @@ class AppGUI(tk.Tk):
         self.margin_ent.insert(0, '5')
        
         self.filename_ent = tk.Entry(self.optionSection)
+        self.server_ent = tk.Entry(self.optionSection)
 
         self.distance_ent = tk.Entry(self.structureSection, width=10)
         self.radius_ent = tk.Entry(self.structureSection, width=10)
@@ -218,6 +484,14 @@ class AppGUI(tk.Tk):
         self.create_file_btn = tk.Button(self.optionSection, text="Create", command=self.generate)
         self.generate_sections_btn = tk.Button(self.sectionsLayoutSection, text="Generate", command=self.generate_sections)
         self.save_section_btn = tk.Button(self.structureSection, text="Save", command=self.save_section)
+        self.cancel_btn = tk.Button(self.statusSection, text="Cancel", command=self.cancel, state='disabled')
+
+        # creating preview
+        self.preview_cnv = tk.Canvas(self.previewSection, width=PREVIEW_SIZE, height=PREVIEW_SIZE,
+                                     background='white', highlightthickness=0)
+
+        # creating progress bar
+        self.progress_bar = ttk.Progressbar(self.statusSection, orient=tk.HORIZONTAL, mode='determinate')
 
         #creating section selector
         self.selected_section = tk.StringVar()
@@ -233,11 +507,22 @@ class AppGUI(tk.Tk):
         self.wafer_size_selector_cmb['values'] = self.wafer.SIZES
         self.wafer_size_selector_cmb.bind('<<ComboboxSelected>>', self.wafer_size_changed)
 
+        self.format_selector_cmb = ttk.Combobox(self.optionSection, width=5)
+        self.format_selector_cmb['values'] = self.wafer.FORMATS
+
         # adding components to the window
+        self.previewSection.pack(side=tk.RIGHT, padx=5, pady=2, anchor=tk.N)
         self.optionSection.pack(padx=5, pady=2)
+        self.estimateSection.pack(padx=5, pady=2, fill=tk.X)
         self.statusSection.pack(padx=5, pady=2, fill=tk.X)
 
-        self.status_lbl.grid(row=0, column=0, padx=5, pady=5)
+        self.estimate_lbl.grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+        self.preview_cnv.grid(row=0, column=0, padx=5, pady=5)
+
+        self.status_lbl.grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky=tk.W)
+        self.progress_bar.grid(row=1, column=0, padx=5, pady=5, sticky=tk.W + tk.E)
+        self.cancel_btn.grid(row=1, column=1, padx=5, pady=5)
+        self.statusSection.columnconfigure(0, weight=1)
 
         # self.sections_gen_lbl.grid(row=0, column=0, pady=5)
         self.sectionsLayoutSection.grid(row=0, column=0, columnspan=4, padx=5, pady=5)
@@ -269,7 +554,12 @@ class AppGUI(tk.Tk):
 
         self.filename_ent.grid(row=5, column=1,padx=5)
 
-        self.create_file_btn.grid(row=5, column=2,padx=5, pady=5)
+        self.format_selector_cmb.grid(row=5, column=2,padx=5)
+
+        self.create_file_btn.grid(row=5, column=3,padx=5, pady=5)
+
+        self.server_lbl.grid(row=6, column=0, padx=5, pady=5)
+        self.server_ent.grid(row=6, column=1, columnspan=2, padx=5, sticky=tk.W + tk.E)
 
 window = AppGUI()
 window.title("GDS Lithography mask generator")
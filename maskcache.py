@@ -0,0 +1,245 @@
+"""Content addressed cache of generated masks on disk.
+
+Finished files and the geometry of their sections are stored under a
+key that is the hash of everything they depend on: the parameters of the
+wafer, the setups, the file format and the version of the generator. A
+mask requested again is copied from the cache instead of being generated,
+and a mask sharing sections with a cached one only builds the others:
+
+    cache = MaskCache('~/.cache/masks', max_bytes=10 * 2 ** 30)
+    wafer.generate_setups('mask', mask_cache=cache)
+
+The cache can be shared by several processes and users. Entries are
+written to a temporary file and renamed, so a reader never sees half an
+entry. Once the entries take more than max_bytes the least recently used
+ones are removed.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import gdspy
+
+from polygons import PolygonBatch
+
+# Version of the geometry and files generated, part of every key. It has
+# to be increased with every change of the generator that changes the
+# masks it writes, so entries of older versions are never served.
+VERSION = 4
+
+DEFAULT_MAX_BYTES = 4 * 2 ** 30
+
+_MASKS = 'masks'
+_SECTIONS = 'sections'
+
+
+class MaskCache:
+    """Cache of finished masks and section geometry in a directory.
+
+    Atributes:
+        directory: directory holding the entries, created if missing.
+        max_bytes: size the entries are trimmed to after every store,
+                   removing the least recently used ones. (default 4 GB)
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+
+        for kind in (_MASKS, _SECTIONS):
+            path = os.path.join(self.directory, kind)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def mask_key(self, wafer, file_format, max_vertices=None):
+        """Key of the file generated from the setups of a wafer.
+
+        Args:
+            wafer: Wafer with its partition and setups.
+            file_format: GDS or OASIS.
+            max_vertices: vertices of the tiles the sections are split in,
+                          see wafer.tile_vertices. Tiled files hold the
+                          structures in another order. (default None, whole
+                          sections)
+        """
+        setups = [[section, setup['distance'], setup['radius'], setup['structure']]
+                  for section, setup in sorted(wafer.setups.items())]
+        return _digest([_MASKS, file_format, wafer.cell_name, wafer.size, wafer.margin, wafer.angle,
+                        wafer.rows, wafer.cols, wafer.unit, wafer.precision, wafer.tolerance,
+                        wafer.circle_points, wafer.hierarchical, wafer.split_grid, setups, max_vertices])
+
+    def section_key(self, wafer, section, setup):
+        """Key of the geometry of one section, see Wafer._section_key."""
+        return _digest([_SECTIONS] + list(wafer._section_key(section, setup)))
+
+    def get_mask(self, key, path):
+        """Copies a cached mask to a path.
+
+        Returns:
+            True if the mask was in the cache, False if not.
+        """
+        entry = self._path(_MASKS, key)
+        try:
+            _touch(entry)
+            shutil.copyfile(entry, path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def put_mask(self, key, path):
+        """Stores a finished mask, unless it is bigger than the whole cache."""
+        if self.max_bytes is not None and os.path.getsize(path) > self.max_bytes:
+            return
+
+        self._store(_MASKS, key, lambda entry: shutil.copyfile(path, entry))
+
+    def has_section(self, key):
+        return os.path.exists(self._path(_SECTIONS, key))
+
+    def get_section(self, key):
+        """Loads the geometry of a section.
+
+        Returns:
+            Dictionary like the one returned by wafer.build_section, without
+            phases, or None if the section is not in the cache.
+        """
+        entry = self._path(_SECTIONS, key)
+        try:
+            _touch(entry)
+            with np.load(entry) as blob:
+                return {'arrays': blob['arrays'],
+                        'inside': _load_batch(blob, 'inside'),
+                        'clipped': _load_batch(blob, 'clipped'),
+                        'structures': int(blob['structures']),
+                        'phases': []}
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def put_section(self, key, geometry):
+        """Stores the geometry built by wafer.build_section for a section."""
+        arrays = {'arrays': geometry['arrays'], 'structures': np.array(geometry['structures'])}
+        for name in ('inside', 'clipped'):
+            batch = geometry[name]
+            arrays.update({name + '_points': batch.points,
+                           name + '_offsets': batch.offsets,
+                           name + '_layers': np.ascontiguousarray(batch.layers),
+                           name + '_datatypes': np.ascontiguousarray(batch.datatypes)})
+
+        self._store(_SECTIONS, key, lambda entry: _save_arrays(entry, arrays))
+
+    def invalidate(self, key=None):
+        """Removes an entry, or every entry if no key is given."""
+        for kind in (_MASKS, _SECTIONS):
+            for name, path, _, _ in self._entries(kind):
+                if key is None or name == key:
+                    _remove(path)
+
+    def size(self):
+        """Bytes taken by the entries."""
+        return sum(size for kind in (_MASKS, _SECTIONS) for _, _, size, _ in self._entries(kind))
+
+    def evict(self):
+        """Removes the least recently used entries until they fit in max_bytes."""
+        if self.max_bytes is None:
+            return
+
+        entries = self._entries(_MASKS) + self._entries(_SECTIONS)
+        total = sum(size for _, _, size, _ in entries)
+        for _, path, size, _ in sorted(entries, key=lambda entry: entry[3]):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+    def _store(self, kind, key, write):
+        """Writes an entry to a temporary file and renames it to its key."""
+        handle, temporary = tempfile.mkstemp(dir=os.path.join(self.directory, kind), suffix='.tmp')
+        os.close(handle)
+        try:
+            write(temporary)
+            _rename(temporary, self._path(kind, key))
+        except:
+            _remove(temporary)
+            raise
+        self.evict()
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, key)
+
+    def _entries(self, kind):
+        """(key, path, size, last use) of the entries of a kind."""
+        entries = []
+        directory = os.path.join(self.directory, kind)
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((name, path, status.st_size, status.st_mtime))
+        return entries
+
+
+def _digest(values):
+    """Hash of a list of plain values, the same for equal values in any process."""
+    text = json.dumps(_plain([VERSION, gdspy.__version__] + values), separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _plain(value):
+    """Numbers as floats, so a distance of 2 and one of 2.0 give the same key."""
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    return float(value)
+
+
+def _load_batch(blob, name):
+    return PolygonBatch(blob[name + '_points'],
+                        blob[name + '_offsets'],
+                        blob[name + '_layers'],
+                        blob[name + '_datatypes'])
+
+
+def _save_arrays(path, arrays):
+    # Through a file, np.savez adds .npz to the names without it
+    with open(path, 'wb') as blob:
+        np.savez(blob, **arrays)
+
+
+def _rename(source, destination):
+    """Moves a file over an entry.
+
+    Python 2 has no os.replace, its os.rename replaces the entry too except
+    on Windows. There an entry that already exists is kept, it has the same
+    content since its name is the key.
+    """
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        replace(source, destination)
+        return
+
+    try:
+        os.rename(source, destination)
+    except OSError:
+        if not os.path.exists(destination):
+            raise
+        _remove(source)
+
+
+def _touch(path):
+    """Marks an entry as used, the modification time is the last use."""
+    os.utime(path, None)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
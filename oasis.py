@@ -0,0 +1,441 @@
+import struct
+
+import numpy as np
+
+import gdspy
+
+from polygons import PolygonBatch
+
+# Record types of the OASIS format used by the writer
+START = 1
+END = 2
+CELL = 14
+PLACEMENT = 17
+RECTANGLE = 20
+POLYGON = 21
+
+MAGIC = b'%SEMI-OASIS\r\n'
+
+# Repetition types
+_MODAL_REPETITION = 0
+_GRID = 1
+_ROW = 2
+_COLUMN = 3
+
+# Point list of arbitrary deltas
+_G_DELTAS = 4
+
+# Directions of the octangular deltas: east, north, west, south, northeast,
+# northwest, southwest and southeast.
+_DIRECTIONS = {(1, 0): 0, (0, 1): 1, (-1, 0): 2, (0, -1): 3,
+               (1, 1): 4, (-1, 1): 5, (-1, -1): 6, (1, -1): 7}
+
+# The END record is padded to this size
+_END_SIZE = 256
+
+
+def unsigned_integer(value):
+    """Encodes a non negative integer in 7 bit groups, lowest first."""
+    value = int(value)
+    if value < 0:
+        raise ValueError("Unsigned integers can not be negative: {0}".format(value))
+
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def signed_integer(value):
+    """Encodes an integer with its sign in the lowest bit."""
+    value = int(value)
+    return unsigned_integer((-value << 1) | 1 if value < 0 else value << 1)
+
+
+def real(value):
+    """Encodes a real, whole numbers are written as integers."""
+    if value == int(value) and value >= 0:
+        return unsigned_integer(0) + unsigned_integer(value)
+    return unsigned_integer(7) + struct.pack('<d', value)
+
+
+def string(value):
+    """Encodes a string preceded by its length."""
+    if not isinstance(value, bytes):
+        value = value.encode('ascii')
+    return unsigned_integer(len(value)) + value
+
+
+def g_delta(dx, dy):
+    """Encodes a displacement between two vertices.
+
+    Horizontal, vertical and diagonal displacements take a single integer
+    with the direction and the length, the rest take one for each axis.
+    """
+    dx, dy = int(dx), int(dy)
+    direction = _DIRECTIONS.get(((dx > 0) - (dx < 0), (dy > 0) - (dy < 0)))
+    if direction is not None and (dx == 0 or dy == 0 or abs(dx) == abs(dy)):
+        return unsigned_integer((max(abs(dx), abs(dy)) << 4) | (direction << 1))
+
+    return unsigned_integer((abs(dx) << 2) | ((dx < 0) << 1) | 1) + signed_integer(dy)
+
+
+def repetitions(origins):
+    """Finds the regular arrays in a set of positions.
+
+    Positions are split in rows with the same y, every row in runs with
+    the same spacing and runs with the same x, size and spacing that
+    repeat at a regular distance along y are joined in grids.
+
+    Args:
+        origins: (N,2) integer array with the positions.
+
+    Returns:
+        List of (x, y, columns, rows, x_space, y_space) with the bottom left
+        position of every array.
+    """
+    origins = np.asarray(origins, dtype=np.int64).reshape(-1, 2)
+    if len(origins) == 0:
+        return []
+
+    origins = origins[np.lexsort((origins[:, 0], origins[:, 1]))]
+
+    runs = {}
+    row_starts = np.flatnonzero(np.r_[True, origins[1:, 1] != origins[:-1, 1]])
+    for start, end in zip(row_starts, np.r_[row_starts[1:], len(origins)]):
+        y = int(origins[start, 1])
+        for x, count, space in _uniform_runs(origins[start:end, 0]):
+            runs.setdefault((x, count, space), []).append(y)
+
+    arrays = []
+    for (x, columns, x_space), ys in sorted(runs.items()):
+        for y, rows, y_space in _uniform_runs(np.array(ys, dtype=np.int64)):
+            arrays.append((x, y, columns, rows, x_space, y_space))
+    return arrays
+
+
+def _uniform_runs(values):
+    """Splits sorted values in runs with the same positive spacing.
+
+    Returns:
+        List of (first value, count, spacing), the spacing is 0 for runs of
+        a single value.
+    """
+    differences = np.diff(values)
+    if len(differences) and differences[0] > 0 and (differences == differences[0]).all():
+        return [(int(values[0]), len(values), int(differences[0]))]
+
+    runs = []
+    start = 0
+    while start < len(values):
+        end = start + 1
+        if end < len(values) and differences[start] > 0:
+            space = differences[start]
+            while end < len(differences) and differences[end] == space:
+                end += 1
+            end += 1
+            runs.append((int(values[start]), end - start, int(space)))
+        else:
+            runs.append((int(values[start]), 1, 0))
+        start = end
+    return runs
+
+
+class OasisWriter:
+    """Writes a layout in the OASIS format.
+
+    It works like gdsii.StreamWriter: elements are appended to the top
+    cell as soon as they are generated and the referenced cells are written
+    when the writer is closed.
+
+    Blocks of identical polygons, like the pillars or walls inside the
+    margin, are written once with a repetition for every regular array of
+    positions. Arrays of references are written as a single placement with
+    a grid repetition. Polygons that do not repeat, like most of the ones
+    fitted in the margin, are written one by one.
+
+    Example:
+        writer = OasisWriter('mask.oas', 'WAFER')
+        writer.write([polygon, batch])
+        writer.add_cell(pillar_cell)
+        writer.close()
+
+    Atributes:
+        bytes_written: Size of the stream written so far.
+    """
+
+    def __init__(self, outfile, cell_name, unit=1.0e-6, precision=1.0e-9):
+        if isinstance(outfile, str):
+            self._outfile = open(outfile, 'wb')
+            self._close = True
+        else:
+            self._outfile = outfile
+            self._close = False
+
+        self.unit = unit
+        self.precision = precision
+        self.bytes_written = 0
+
+        self._multiplier = unit / precision
+        self._cells = []
+        self._cell_names = set()
+
+        # Database units in a micron, 1.0e-6 / 1.0e-9 is not exactly 1000
+        grid = 1.0e-6 / precision
+        if abs(grid - round(grid)) < 1.0e-6 * grid:
+            grid = int(round(grid))
+
+        # The table offsets are written in the START record and are all 0,
+        # the file has no name tables.
+        self._write(MAGIC +
+                    unsigned_integer(START) +
+                    string('1.0') +
+                    real(grid) +
+                    unsigned_integer(0) +
+                    unsigned_integer(0) * 12)
+        self._begin_cell(cell_name)
+
+    def _write(self, data):
+        self._outfile.write(data)
+        self.bytes_written += len(data)
+
+    def _begin_cell(self, name):
+        self._write(unsigned_integer(CELL) + string(name))
+        # Modal variables do not carry over from one cell to the next
+        self._modal = {}
+
+    def write(self, elements):
+        """Appends elements to the top cell.
+
+        Args:
+            elements: Polygon, PolygonSet, PolygonBatch, CellReference or
+                      CellArray objects.
+
+        Raises:
+            ValueError: If an element can not be written.
+        """
+        for element in elements:
+            self._write(self._encode(element))
+
+    def add_cell(self, cell):
+        """Registers a cell referenced by the top cell.
+
+        The cell is written when the writer is closed, registering it more
+        than once has no effect.
+
+        Args:
+            cell: gdspy.Cell to be included in the file.
+        """
+        if cell.name not in self._cell_names:
+            self._cell_names.add(cell.name)
+            self._cells.append(cell)
+
+    def close(self):
+        """Writes the referenced cells and ends the file."""
+        # Cells referenced from the cells written here are added to the list
+        index = 0
+        while index < len(self._cells):
+            cell = self._cells[index]
+            self._begin_cell(cell.name)
+            self.write(cell.elements)
+            index += 1
+
+        end = unsigned_integer(END)
+        validation = unsigned_integer(0)
+        padding = _END_SIZE - len(end) - len(validation)
+        padding -= len(unsigned_integer(padding))
+        self._write(end + string(b'\x00' * padding) + validation)
+
+        if self._close:
+            self._outfile.close()
+
+    def _encode(self, element):
+        if isinstance(element, PolygonBatch):
+            return self._encode_batch(element)
+
+        if isinstance(element, gdspy.Polygon):
+            return self._polygon(element.points, element.layer, element.datatype)
+
+        if isinstance(element, gdspy.PolygonSet):
+            return b''.join(self._polygon(points, layer, datatype)
+                            for points, layer, datatype in zip(element.polygons,
+                                                                element.layers,
+                                                                element.datatypes))
+
+        if isinstance(element, (gdspy.CellArray, gdspy.CellReference)):
+            return self._placement(element)
+
+        raise ValueError("{0} can not be written to an OASIS file".format(type(element).__name__))
+
+    def _encode_batch(self, batch):
+        if len(batch) == 0:
+            return b''
+
+        # Polygons are grouped by number of vertices, layer and datatype,
+        # only polygons of the same group can be the same shape.
+        counts = batch.counts
+        keys = (counts << 32) | (batch.layers << 16) | batch.datatypes
+        if (keys == keys[0]).all():
+            return self._encode_shapes(batch.vertices(), int(batch.layers[0]), int(batch.datatypes[0]))
+
+        order = np.argsort(keys, kind='stable')
+        batch = batch.filter(order)
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+
+        data = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            points = batch.points[batch.offsets[start]:batch.offsets[end]]
+            data.append(self._encode_shapes(points.reshape(end - start, -1, 2),
+                                            int(batch.layers[start]),
+                                            int(batch.datatypes[start])))
+        return b''.join(data)
+
+    def _encode_shapes(self, vertices, layer, datatype):
+        """Encodes an (N,V,2) array of polygons with the same layer and datatype."""
+        # Polygons with the same vertices relative to their first one are
+        # the same shape at a different position. The coordinates are
+        # rounded before taking the differences, like in GDSII files.
+        scaled = np.round(vertices * self._multiplier).astype(np.int64)
+        origins = scaled[:, 0]
+        shapes = (scaled - scaled[:, :1]).reshape(len(vertices), -1)
+
+        # Shapes are grouped by a hash of their coordinates, sorting the
+        # whole rows is much slower. Shapes that only share the hash with
+        # the first one of their group are written one by one.
+        weights = np.random.RandomState(0).randint(1, 2 ** 62, shapes.shape[1]).astype(np.int64)
+        keys = shapes.dot(weights)
+        keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        same = (shapes == shapes[first[inverse]]).all(axis=1)
+
+        # Origins of every group one after the other
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse[same], kind='stable')
+        grouped = origins[same][order]
+        bounds = np.searchsorted(inverse[same][order], np.arange(len(first) + 1))
+
+        data = []
+        for index, shape in enumerate(shapes[first]):
+            shape = shape.reshape(-1, 2)
+            for x, y, columns, rows, x_space, y_space in repetitions(grouped[bounds[index]:bounds[index + 1]]):
+                data.append(self._shape(shape + (x, y),
+                                        layer,
+                                        datatype,
+                                        _repetition(columns, rows, x_space, y_space)))
+
+        for index in np.flatnonzero(~same):
+            data.append(self._shape(shapes[index].reshape(-1, 2) + origins[index],
+                                    layer,
+                                    datatype,
+                                    None))
+        return b''.join(data)
+
+    def _polygon(self, points, layer, datatype):
+        points = np.round(np.asarray(points, dtype=float) * self._multiplier).astype(np.int64)
+        return self._shape(points, layer, datatype, None)
+
+    def _shape(self, points, layer, datatype, repetition):
+        """Encodes a polygon in database units as a RECTANGLE or a POLYGON."""
+        # Repeated vertices, also the closing one, are not needed
+        keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+        points = points[keep]
+        if len(points) < 3:
+            return b''
+
+        x_min, y_min = points.min(axis=0)
+        x_max, y_max = points.max(axis=0)
+        rectangle = len(points) == 4 and \
+            np.all((points[:, 0] == x_min) | (points[:, 0] == x_max)) and \
+            np.all((points[:, 1] == y_min) | (points[:, 1] == y_max))
+
+        data = []
+        info = 0
+        for bit, name, value, encode in ((0x01, 'layer', layer, unsigned_integer),
+                                          (0x02, 'datatype', datatype, unsigned_integer)):
+            if self._modal.get(name) != value:
+                self._modal[name] = value
+                info |= bit
+                data.append(encode(value))
+
+        if rectangle:
+            width, height = int(x_max - x_min), int(y_max - y_min)
+            position = (x_min, y_min)
+            record = RECTANGLE
+            # Width and height are always written, the modal ones are not used
+            info |= 0x60
+            data.append(unsigned_integer(width) + unsigned_integer(height))
+        else:
+            position = points[0]
+            record = POLYGON
+            point_list = _point_list(points)
+            if self._modal.get('polygon') != point_list:
+                self._modal['polygon'] = point_list
+                info |= 0x20
+                data.append(point_list)
+
+        info |= 0x18
+        data.append(signed_integer(position[0]) + signed_integer(position[1]))
+
+        if repetition is not None:
+            info |= 0x04
+            data.append(self._repetition(repetition))
+
+        return unsigned_integer(record) + struct.pack('B', info) + b''.join(data)
+
+    def _placement(self, reference):
+        if reference.rotation or (reference.magnification not in (None, 1)) or reference.x_reflection:
+            raise ValueError("Rotated, scaled or reflected references can not be written to an OASIS file")
+
+        self.add_cell(reference.ref_cell)
+
+        info = 0x30
+        data = []
+        name = reference.ref_cell.name
+        if self._modal.get('cell') != name:
+            self._modal['cell'] = name
+            info |= 0x80
+            data.append(string(name))
+
+        data.append(signed_integer(round(reference.origin[0] * self._multiplier)) +
+                    signed_integer(round(reference.origin[1] * self._multiplier)))
+
+        if isinstance(reference, gdspy.CellArray) and reference.columns * reference.rows > 1:
+            info |= 0x08
+            data.append(self._repetition(_repetition(reference.columns,
+                                                     reference.rows,
+                                                     int(round(reference.spacing[0] * self._multiplier)),
+                                                     int(round(reference.spacing[1] * self._multiplier)))))
+
+        return unsigned_integer(PLACEMENT) + struct.pack('B', info) + b''.join(data)
+
+    def _repetition(self, repetition):
+        """Encodes a repetition, or refers to the last one if it is the same."""
+        if self._modal.get('repetition') == repetition:
+            return unsigned_integer(_MODAL_REPETITION)
+        self._modal['repetition'] = repetition
+        return repetition
+
+
+def _repetition(columns, rows, x_space, y_space):
+    """Encodes a grid of positions, None for a single position."""
+    if columns > 1 and rows > 1:
+        return unsigned_integer(_GRID) + unsigned_integer(columns - 2) + unsigned_integer(rows - 2) + \
+            unsigned_integer(x_space) + unsigned_integer(y_space)
+    if columns > 1:
+        return unsigned_integer(_ROW) + unsigned_integer(columns - 2) + unsigned_integer(x_space)
+    if rows > 1:
+        return unsigned_integer(_COLUMN) + unsigned_integer(rows - 2) + unsigned_integer(y_space)
+    return None
+
+
+def _point_list(points):
+    """Encodes the vertices of a polygon after the first one as displacements."""
+    deltas = np.diff(points, axis=0)
+    return unsigned_integer(_G_DELTAS) + unsigned_integer(len(deltas)) + \
+        b''.join(g_delta(dx, dy) for dx, dy in deltas.tolist())
@@ -0,0 +1,210 @@
+"""Observers of the generation pipeline.
+
+Wafer.generate_setups accepts an observer that is notified once every
+phase of the generation finishes. Each notification is an event, a
+dictionary with:
+
+    phase: name of the phase (see PHASES).
+    section: number of the section, None for the phases of the whole wafer.
+    start, end: wall clock times in seconds since the epoch.
+    seconds: duration of the phase.
+    structures: structures produced by the phase, None if not relevant.
+    vertices: vertices of those structures, None if not relevant.
+    clipped: structures that went through the clipping, None if not relevant.
+    bytes: bytes written to the file by the phase, None if not relevant.
+
+When sections are built in worker processes the phases of different
+sections overlap, so the sum of the durations may be longer than the
+generation itself.
+
+Example:
+
+    wafer.generate_setups('chip', observer=SummaryObserver())
+"""
+import json
+import sys
+import time
+
+# Phases in the order they happen
+PHASES = ['outline', 'positions', 'classify', 'clip', 'emit', 'write']
+
+COUNTERS = ['structures', 'vertices', 'clipped', 'bytes']
+
+
+def phase_event(phase, section, start, end, **counters):
+    """Creates the event of a finished phase."""
+    event = {'phase': phase,
+             'section': section,
+             'start': start,
+             'end': end,
+             'seconds': end - start}
+    for name in COUNTERS:
+        event[name] = counters.get(name)
+    return event
+
+
+class PhaseClock:
+    """Measures consecutive phases.
+
+    Every call to mark closes the current phase and starts the next one.
+    The events are sent to the observer, or kept in events when there is
+    none, so they can be returned from a worker process.
+    """
+
+    def __init__(self, observer=None, section=None):
+        self.observer = observer
+        self.section = section
+        self.events = []
+        self._start = time.time()
+
+    def restart(self):
+        """Starts the current phase again, ignoring the time since the last mark."""
+        self._start = time.time()
+
+    def mark(self, phase, **counters):
+        end = time.time()
+        event = phase_event(phase, self.section, self._start, end, **counters)
+        if self.observer is not None:
+            self.observer.notify(event)
+        else:
+            self.events.append(event)
+        self._start = end
+
+
+class _NullClock:
+    """Clock used when nobody observes the generation, it measures nothing."""
+
+    events = ()
+
+    def restart(self):
+        pass
+
+    def mark(self, phase, **counters):
+        pass
+
+
+NULL_CLOCK = _NullClock()
+
+
+def clock(enabled, observer=None, section=None):
+    """Returns a PhaseClock, or a clock that does nothing if not enabled."""
+    if not enabled:
+        return NULL_CLOCK
+    return PhaseClock(observer, section)
+
+
+class Observer:
+    """Base class of the observers, it ignores every event."""
+
+    def notify(self, event):
+        """Called when a phase finishes."""
+        pass
+
+    def finish(self):
+        """Called once the file has been written."""
+        pass
+
+
+class Recorder(Observer):
+    """Keeps every event of the generation.
+
+    Atributes:
+        events: events received so far, in the order they were received.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def notify(self, event):
+        self.events.append(event)
+
+    def clear(self):
+        self.events = []
+
+    def wall_time(self):
+        """Seconds from the start of the first phase to the end of the last one."""
+        if not self.events:
+            return 0.0
+        return max(event['end'] for event in self.events) - min(event['start'] for event in self.events)
+
+    def totals(self):
+        """Adds up the events of every phase.
+
+        Returns:
+            Dictionary from phase name to a dictionary with the number of
+            events, the seconds and the sum of every counter. Counters no
+            event of the phase reported are None.
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['phase'], dict([('count', 0), ('seconds', 0.0)] +
+                                                           [(name, None) for name in COUNTERS]))
+            total['count'] += 1
+            total['seconds'] += event['seconds']
+            for name in COUNTERS:
+                if event[name] is not None:
+                    total[name] = (total[name] or 0) + event[name]
+        return totals
+
+
+class SummaryObserver(Recorder):
+    """Prints a table with the time and counters of every phase.
+
+    Args:
+        stream: file where the table is printed. (default sys.stdout)
+    """
+
+    def __init__(self, stream=None):
+        Recorder.__init__(self)
+        self.stream = stream
+
+    def finish(self):
+        stream = self.stream or sys.stdout
+        totals = self.totals()
+        names = [phase for phase in PHASES if phase in totals]
+        names += sorted(phase for phase in totals if phase not in PHASES)
+
+        stream.write("{0:<10} {1:>6} {2:>10} {3:>12} {4:>14} {5:>10} {6:>12}\n".format(
+            'phase', 'count', 'seconds', 'structures', 'vertices', 'clipped', 'bytes'))
+        for phase in names:
+            total = totals[phase]
+            stream.write("{0:<10} {1:>6} {2:>10.3f} {3:>12} {4:>14} {5:>10} {6:>12}\n".format(
+                phase, total['count'], total['seconds'],
+                *['-' if total[name] is None else total[name] for name in COUNTERS]))
+        stream.write("{0:<10} {1:>6} {2:>10.3f}\n".format('wall', '', self.wall_time()))
+        stream.flush()
+        self.clear()
+
+
+class TraceObserver(Recorder):
+    """Writes the events to a JSON file in the Trace Event Format.
+
+    The file can be opened with chrome://tracing or Perfetto, every
+    section is shown in its own row.
+
+    Args:
+        filename: name of the JSON file.
+    """
+
+    def __init__(self, filename):
+        Recorder.__init__(self)
+        self.filename = filename
+
+    def finish(self):
+        origin = min(event['start'] for event in self.events) if self.events else 0.0
+
+        trace = []
+        for event in self.events:
+            section = event['section']
+            trace.append({'name': event['phase'],
+                          'cat': 'wafer' if section is None else 'section',
+                          'ph': 'X',
+                          'ts': (event['start'] - origin) * 1e6,
+                          'dur': event['seconds'] * 1e6,
+                          'pid': 0,
+                          'tid': 0 if section is None else section,
+                          'args': dict((name, event[name]) for name in COUNTERS if event[name] is not None)})
+
+        with open(self.filename, 'w') as outfile:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, outfile, indent=1)
+        self.clear()
@@ -1,10 +1,16 @@
 import numpy as np
 
-from tools import generate_circle_points as gc
+from tools import circle_template
+
+# Largest amount of points of a pillar outline
+PILLAR_POINTS = 100
 
 def generate_pilars_positions(distance, radius, x, y, width, height):
     """Calculates the position of the pilars within the drawing area.
 
+    Thin wrapper around generate_pilars_centers that returns a list of
+    (x, y) tuples.
+
     Args:
         distance: Distance from the center of one pillar to the center
                     of an adjacent one.
@@ -15,6 +21,56 @@ def generate_pilars_positions(distance, radius, x, y, width, height):
         height: height of the rectangular drawing area.
         
     """
+    centers = generate_pilars_centers(distance, radius, x, y, width, height)
+
+    return [tuple(point) for point in centers.tolist()]
+
+def generate_pilars_centers(distance, radius, x, y, width, height, columns=None, rows=None):
+    """Calculates the position of the pilars within the drawing area.
+
+    Args:
+        distance: Distance from the center of one pillar to the center
+                    of an adjacent one.
+        radius: Distance from the center of the pillar to the edge.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+        columns: slice of the columns of the lattice to be generated. (default all)
+        rows: slice of the rows of the lattice to be generated. (default all)
+
+    Returns:
+        (N,2) array with the centers of the pillars ordered column by column
+        from the top left pillar.
+    """
+    start_x, start_y, pair_distance, pilars_x_axis, pilars_y_axis = \
+        generate_pilars_lattice(distance, radius, x, y, width, height)
+
+    xs = start_x + np.arange(pilars_x_axis)[columns or slice(None)] * pair_distance
+    ys = start_y - np.arange(pilars_y_axis)[rows or slice(None)] * pair_distance
+
+    centers = np.empty((len(xs) * len(ys), 2))
+    centers[:, 0] = np.repeat(xs, len(ys))
+    centers[:, 1] = np.tile(ys, len(xs))
+    return centers
+
+def generate_pilars_lattice(distance, radius, x, y, width, height):
+    """Calculates the regular lattice that holds the pilars within the drawing area.
+
+    Args:
+        distance: Distance from the center of one pillar to the center
+                    of an adjacent one.
+        radius: Distance from the center of the pillar to the edge.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+
+    Returns:
+        (start_x, start_y, pair_distance, columns, rows): Center of the top left
+            pillar, distance between adjacent centers and number of pillars
+            in each direction. Columns grow to the right and rows grow down.
+    """
     pair_distance = (2 * radius) + (distance - 2*radius)
         
     pilars_x_axis = int(width / pair_distance)
@@ -23,15 +79,13 @@ def generate_pilars_positions(distance, radius, x, y, width, height):
     gap_x_axis = (width - (pilars_x_axis * pair_distance))/2 + radius#gap both sides of the rectangle
     gap_y_axis = (height - (pilars_y_axis * pair_distance))/2 + radius
 
-    points = [] #set of positions
-    for col in range(0, pilars_x_axis):
-        for row in range(0, pilars_y_axis):
-            points.append(( (x + gap_x_axis) + col*pair_distance,
-                                (y - gap_y_axis) - row*pair_distance))
-    return points
+    return (x + gap_x_axis, y - gap_y_axis, pair_distance, pilars_x_axis, pilars_y_axis)
 
 def generate_pilars_region(distance, radius, x,y,width, height):
     """Generate Pillar structures in a specific area.
+
+    Thin wrapper around generate_pilars_vertices that returns a list with
+    the (x, y) vertices of every pillar.
     
     Args:
         distance: Distance from the center of one pillar to the center
@@ -42,17 +96,65 @@ def generate_pilars_region(distance, radius, x,y,width, height):
         width: width of the rectangular drawing area.
         height: height of the rectangular drawing area.
     """
+    vertices = generate_pilars_vertices(distance, radius, x, y, width, height)
 
-    points = generate_pilars_positions(distance, radius, x, y, width, height)
+    return [[tuple(point) for point in pilar] for pilar in vertices.tolist()]
+
+def generate_pilars_vertices(distance, radius, x, y, width, height, tolerance=None, points=None,
+                             columns=None, rows=None):
+    """Generate Pillar structures in a specific area.
+    
+    Args:
+        distance: Distance from the center of one pillar to the center
+                    of an adjacent one.
+        radius: Distance from the center of the pillar to the edge.
+        x: x coordinate of the rectangular drawing area.
+        y: y coordinate of the rectangular drawing area.
+        width: width of the rectangular drawing area.
+        height: height of the rectangular drawing area.
+        tolerance: Maximum chord error of the pillar outline.
+        points: Fixed amount of points of the pillar outline.
+        columns: slice of the columns of the lattice to be generated. (default all)
+        rows: slice of the rows of the lattice to be generated. (default all)
+
+    Returns:
+        (N,V,2) array with the V vertices of each one of the N pillars.
+    """
+    centers = generate_pilars_centers(distance, radius, x, y, width, height, columns, rows)
 
+    return translate_pilar_template(radius, centers, tolerance, points)
+
+def translate_pilar_template(radius, centers, tolerance=None, points=None):
+    """Places a copy of the pillar outline at each one of the centers.
+
+    Args:
+        radius: Distance from the center of the pillar to the edge.
+        centers: (N,2) array with the centers of the pillars.
+        tolerance: Maximum chord error of the pillar outline.
+        points: Fixed amount of points of the pillar outline.
+
+    Returns:
+        (N,V,2) array with the V vertices of each one of the N pillars.
+    """
     # The template is a circle located at 0,0 and with the specific radius
     # calculating this once save a lot of time. Then we only need to transale
     # the template.
-    template_x, template_y = gc(radius, 0, 360, 100)
-    pilars = []
-    
-    for point in points:
-        pilars.append(zip(  template_x + point[0],
-                                template_y + point[1]))
-    return pilars
+    template = generate_pilar_template(radius, tolerance, points)
 
+    return np.asarray(centers, dtype=float).reshape(-1, 1, 2) + template
+
+def generate_pilar_template(radius, tolerance=None, points=None):
+    """Generates the outline of a single pillar centered at (0,0).
+
+    The amount of points comes from the maximum chord error allowed, up to
+    PILLAR_POINTS. Without tolerance nor points PILLAR_POINTS are used.
+
+    Args:
+        radius: Distance from the center of the pillar to the edge.
+        tolerance: Maximum chord error of the outline.
+        points: Fixed amount of points of the outline.
+
+    Returns:
+        (V,2) array with the vertices of the pillar.
+    """
+    return circle_template(radius, 0, 360, tolerance, points, PILLAR_POINTS)
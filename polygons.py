@@ -0,0 +1,174 @@
+import numpy as np
+
+from gdsii import encode_boundaries
+
+
+class PolygonBatch:
+    """Polygons stored as a structure of arrays.
+
+    The vertices of all the polygons are kept one after the other in a
+    single array and each polygon is a range of it, so the geometry of a
+    section goes from the generation through the clipping to the file
+    without creating a Python object for every polygon. Batches can be
+    added to a gdspy.Cell or given to a writer like any other element.
+
+    Atributes:
+        points: (M,2) array with the vertices of all the polygons.
+        offsets: (N+1,) array with the index of the first vertex of each
+                 polygon in points, the last one is M.
+        layers: GDSII layer of each polygon.
+        datatypes: GDSII datatype of each polygon.
+    """
+
+    def __init__(self, points, offsets, layers=0, datatypes=0):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(-1)
+        self.layers = np.broadcast_to(np.asarray(layers, dtype=np.int64), (len(self.offsets) - 1,))
+        self.datatypes = np.broadcast_to(np.asarray(datatypes, dtype=np.int64), (len(self.offsets) - 1,))
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty((0, 2)), [0])
+
+    @classmethod
+    def from_counts(cls, points, counts, layers=0, datatypes=0):
+        """Creates the batch from the vertices and the number of vertices of each polygon."""
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(points, offsets, layers, datatypes)
+
+    @classmethod
+    def from_vertices(cls, vertices, layers=0, datatypes=0):
+        """Creates the batch from an (N,V,2) array of polygons with V vertices.
+
+        The vertices are not copied.
+        """
+        vertices = np.asarray(vertices, dtype=float)
+        if len(vertices) == 0:
+            return cls.empty()
+
+        return cls(vertices.reshape(-1, 2), np.arange(len(vertices) + 1) * vertices.shape[1], layers, datatypes)
+
+    @classmethod
+    def from_polygons(cls, polygons, layers=0, datatypes=0):
+        """Creates the batch from a list of (V,2) arrays."""
+        if len(polygons) == 0:
+            return cls.empty()
+
+        return cls.from_counts(np.concatenate(polygons), [len(polygon) for polygon in polygons], layers, datatypes)
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Joins batches one after the other."""
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+
+        return cls.from_counts(np.concatenate([batch.points for batch in batches]),
+                               np.concatenate([batch.counts for batch in batches]),
+                               np.concatenate([batch.layers for batch in batches]),
+                               np.concatenate([batch.datatypes for batch in batches]))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        """Number of vertices of each polygon."""
+        return np.diff(self.offsets)
+
+    @property
+    def polygons(self):
+        """List with the vertices of each polygon."""
+        return np.split(self.points, self.offsets[1:-1]) if len(self) else []
+
+    def vertices(self):
+        """Returns the polygons as an (N,V,2) array, if all of them have V vertices.
+
+        Raises:
+            ValueError: If the polygons have different number of vertices.
+        """
+        counts = self.counts
+        if len(counts) and (counts != counts[0]).any():
+            raise ValueError("The polygons do not have the same number of vertices")
+
+        return self.points.reshape(len(counts), counts[0] if len(counts) else 0, 2)
+
+    def bounding_boxes(self):
+        """Returns (x_min, x_max, y_min, y_max), arrays with the limits of each polygon."""
+        if len(self) == 0:
+            return tuple(np.empty(0) for _ in range(4))
+
+        starts = self.offsets[:-1]
+        x = self.points[:, 0]
+        y = self.points[:, 1]
+        return (np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts),
+                np.minimum.reduceat(y, starts), np.maximum.reduceat(y, starts))
+
+    def reduce_vertices(self, ufunc, values):
+        """Reduces a value of every vertex to a value of every polygon.
+
+        Args:
+            ufunc: numpy ufunc applied, like np.maximum.
+            values: (M,) array with a value for each vertex.
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=np.asarray(values).dtype)
+        return ufunc.reduceat(values, self.offsets[:-1])
+
+    def translate(self, dx, dy):
+        """Moves the polygons.
+
+        Args:
+            dx, dy: displacement of all the polygons or arrays with the
+                    displacement of each one.
+
+        Returns:
+            New PolygonBatch with the moved polygons.
+        """
+        displacement = np.column_stack(np.broadcast_arrays(np.asarray(dx, dtype=float).reshape(-1),
+                                                           np.asarray(dy, dtype=float).reshape(-1)))
+        if len(displacement) > 1:
+            displacement = np.repeat(displacement, self.counts, axis=0)
+
+        return PolygonBatch(self.points + displacement, self.offsets, self.layers, self.datatypes)
+
+    def filter(self, selection):
+        """Selects some of the polygons.
+
+        Args:
+            selection: boolean mask or indices of the polygons to keep.
+
+        Returns:
+            New PolygonBatch with the selected polygons, in the order of
+            the selection.
+        """
+        indices = np.arange(len(self))[selection]
+        counts = self.counts[indices]
+
+        # Index of every vertex of the selected polygons
+        starts = np.repeat(self.offsets[indices] - (np.cumsum(counts) - counts), counts)
+        points = self.points[starts + np.arange(counts.sum())]
+
+        return PolygonBatch.from_counts(points, counts, self.layers[indices], self.datatypes[indices])
+
+    def get_polygons(self, by_spec=False, depth=None):
+        """Returns the polygons the same way gdspy elements do."""
+        if not by_spec:
+            return self.polygons
+
+        polygons = {}
+        for layer, datatype in sorted(set(zip(self.layers.tolist(), self.datatypes.tolist()))):
+            selection = (self.layers == layer) & (self.datatypes == datatype)
+            polygons[(layer, datatype)] = self.filter(selection).polygons
+        return polygons
+
+    def to_gds(self, multiplier):
+        """Converts the polygons to GDSII BOUNDARY elements.
+
+        Args:
+            multiplier: factor that converts the coordinates to database units.
+        """
+        return encode_boundaries(self.points, self.counts, self.layers, self.datatypes, multiplier)
@@ -0,0 +1,130 @@
+"""Preview of the layout of a wafer.
+
+The structures are not drawn one by one: every pixel gets the fraction of
+its area covered by structures, calculated in closed form from the pitch,
+size and extent of the structures of each section. The cost only depends
+on the number of pixels and sections, not on the number of structures.
+"""
+import numpy as np
+
+from wafer import Wafer
+import pillar as Pillar
+import grid as Grid
+
+# Sub-pixels along each axis used to find the part of a pixel inside the margin
+MARGIN_SAMPLES = 3
+
+# Colors of an empty and of a completely covered pixel
+EMPTY_COLOR = (255, 255, 255)
+FULL_COLOR = (31, 63, 127)
+
+
+def view(wafer, width, height, border=4):
+    """Fits the wafer in an image.
+
+    Args:
+        wafer: Wafer to be shown.
+        width: width of the image in pixels.
+        height: height of the image in pixels.
+        border: empty pixels around the wafer.
+
+    Returns:
+        (scale, center_x, center_y): pixels per micron and position of the
+            center of the wafer in the image.
+    """
+    scale = (min(width, height) - 2 * border) / float(wafer.size)
+    return scale, width / 2.0, height / 2.0
+
+
+def to_pixels(points, transform):
+    """Converts points in microns to pixels, y grows down in the image."""
+    scale, center_x, center_y = transform
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return np.column_stack((center_x + points[:, 0] * scale, center_y - points[:, 1] * scale))
+
+
+def density_map(wafer, width, height, transform=None):
+    """Calculates the fraction of every pixel covered by structures.
+
+    Args:
+        wafer: Wafer with its partition and setups.
+        width: width of the image in pixels.
+        height: height of the image in pixels.
+        transform: result of view, calculated if None.
+
+    Returns:
+        (height, width) array with values between 0 and 1.
+    """
+    scale, center_x, center_y = transform or view(wafer, width, height)
+    size = 1.0 / scale
+
+    # Limits of every pixel in microns
+    left = (np.arange(width) - center_x) * size
+    top = (center_y - np.arange(height)) * size
+
+    wafer._create_margin_area()
+    empty = np.ones((height, width))
+    for section, setup in sorted(wafer.setups.items()):
+        if section > wafer.num_sections or setup['distance'] <= 0:
+            continue
+
+        area = wafer._section_area(section)
+        for (x_min, x_max, y_min, y_max), coverage in _section_layers(setup, area):
+            covered_x = np.clip(np.minimum(left + size, x_max) - np.maximum(left, x_min), 0, size) / size
+            covered_y = np.clip(np.minimum(top, y_max) - np.maximum(top - size, y_min), 0, size) / size
+            empty *= 1 - coverage * covered_y[:, np.newaxis] * covered_x[np.newaxis, :]
+
+    return (1 - empty) * _margin_fraction(wafer.margin_area, left, top, size)
+
+
+def _section_layers(setup, area):
+    """Splits the structures of a section in layers of uniform density.
+
+    Returns:
+        List of ((x_min, x_max, y_min, y_max), coverage) with the extent of
+        every layer and the fraction of it covered by structures.
+    """
+    distance = setup['distance']
+    radius = setup['radius']
+    structure = setup['structure']
+
+    if structure == Wafer.PILLARS:
+        start_x, start_y, pitch, columns, rows = Pillar.generate_pilars_lattice(distance, radius, *area)
+        if columns == 0 or rows == 0:
+            return []
+        extent = (start_x - radius, start_x + (columns - 1) * pitch + radius,
+                  start_y - (rows - 1) * pitch - radius, start_y + radius)
+        return [(extent, min(np.pi * radius ** 2 / pitch ** 2, 1.0))]
+
+    x, y, width, height = area
+    start_x, start_y, pitch, walls_x_axis, walls_y_axis = Grid.generate_grid_lattice(distance, radius, *area)
+    coverage = min(radius / float(pitch), 1.0)
+
+    layers = []
+    if structure in (Wafer.GRID, Wafer.LINES_V) and walls_x_axis:
+        layers.append(((start_x, start_x + (walls_x_axis - 1) * pitch + radius, y - height, y), coverage))
+    if structure in (Wafer.GRID, Wafer.LINES_H) and walls_y_axis:
+        layers.append(((x, x + width, start_y - (walls_y_axis - 1) * pitch - radius, start_y), coverage))
+    return layers
+
+
+def _margin_fraction(margin_area, left, top, size):
+    """Fraction of every pixel inside the margin, sampled at sub-pixels."""
+    offsets = (np.arange(MARGIN_SAMPLES) + 0.5) * size / MARGIN_SAMPLES
+    xs = (left[:, np.newaxis] + offsets).reshape(-1)
+    ys = (top[:, np.newaxis] - offsets).reshape(-1)
+
+    inside = (np.hypot(xs[np.newaxis, :], ys[:, np.newaxis]) <= margin_area.radius) & \
+        (ys[:, np.newaxis] >= margin_area.flat_y)
+    inside = inside.reshape(len(top), MARGIN_SAMPLES, len(left), MARGIN_SAMPLES)
+    return inside.mean(axis=(1, 3))
+
+
+def image_data(density):
+    """Converts a density map to the data of a Tk PhotoImage."""
+    levels = np.linspace(0, 1, 256)[:, np.newaxis]
+    palette = np.round(np.array(EMPTY_COLOR) * (1 - levels) + np.array(FULL_COLOR) * levels).astype(int)
+    palette = np.array(['#{0:02x}{1:02x}{2:02x}'.format(*color) for color in palette])
+
+    colors = palette[np.round(np.clip(density, 0, 1) * 255).astype(int)]
+    return ' '.join('{' + ' '.join(row) + '}' for row in colors.tolist())
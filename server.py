@@ -0,0 +1,620 @@
+"""Local service generating the masks of several users.
+
+Jobs, with the keys of the jobs of a cli.py job file, are submitted over
+HTTP or a Unix socket and queued by priority. A bounded pool of worker
+processes generates them one job per process, so the users of a machine
+share its cores and memory instead of competing for them:
+
+    python server.py --port 8470 --processes 2 --output-dir masks
+
+The API speaks JSON:
+
+    POST   /jobs              queues a job, its "priority" (default 0) is
+                              taken first when higher. Returns its id.
+    GET    /jobs              status of every job.
+    GET    /jobs/<id>         status and progress of a job.
+    GET    /jobs/<id>/result  the generated file.
+    DELETE /jobs/<id>         cancels a queued or running job.
+
+Example:
+
+    job_id = submit('http://localhost:8470', job, priority=1)
+    while job_status('http://localhost:8470', job_id)['status'] in (QUEUED, RUNNING):
+        time.sleep(1)
+    download('http://localhost:8470', job_id, 'mask.gds')
+
+A server started with --socket /tmp/masks.sock has the url unix:/tmp/masks.sock.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from wafer import Wafer
+from cli import _WAFER_OPTIONS, job_wafer, run_job
+from observers import Observer
+
+DEFAULT_PORT = 8470
+
+# Prefix of the url of a server listening on a Unix socket
+_UNIX_SCHEME = 'unix:'
+
+# Status of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+OK = 'ok'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Bytes of the file sent at a time
+_CHUNK_BYTES = 2 ** 20
+
+# Seconds between two checks of the worker processes
+_CHECK_INTERVAL = 1
+
+# The workers are spawned, a fork would copy the locks held by the
+# threads of the server at that moment.
+_CONTEXT = multiprocessing.get_context('spawn')
+
+# Keys of a job a client may set. The cache and the memory budget are the
+# ones of the server, a client can only lower the budget.
+_JOB_KEYS = ['name', 'size', 'margin', 'rows', 'cols', 'sections', 'format',
+             'stream', 'verify', 'rules', 'memory_budget'] + _WAFER_OPTIONS
+
+
+class JobServer:
+    """Queue of jobs run by a bounded number of worker processes.
+
+    Every job runs in a new process. A process killed while generating,
+    for instance when the machine runs out of memory, fails its job and
+    the next one starts.
+
+    Atributes:
+        output_dir: directory of the generated files, created if missing.
+        processes: jobs generated at the same time. (default number of cores)
+        defaults: keys added to every job, like a "memory_budget" or a shared
+                  "cache_dir". Only the memory_budget can be lowered by a job.
+                  (default None)
+    """
+
+    def __init__(self, output_dir, processes=None, defaults=None):
+        self.output_dir = os.path.abspath(output_dir)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.defaults = defaults or {}
+
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        self._lock = threading.Lock()
+        self._records = {}
+        self._jobs = {}
+        self._events = {}
+        self._workers = {}
+        self._queue = []
+        self._order = itertools.count()
+
+        # Progress, results and cancellation cross the process boundary
+        # through the manager.
+        self._manager = multiprocessing.Manager()
+        self._messages = self._manager.Queue()
+        self._collector = threading.Thread(target=self._collect_messages)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, job, priority=0):
+        """Queues a job.
+
+        The output of the job is always a file in output_dir, named after
+        the id of the job.
+
+        Args:
+            job: dictionary like the jobs returned by cli.load_jobs.
+            priority: jobs with a higher priority run first, the ones with
+                      the same priority in the order they came. (default 0)
+
+        Returns:
+            Id of the job.
+
+        Raise:
+            ValueError: If the job has keys a client can not set, a name that
+                        is not a string of printable characters, or if the
+                        wafer, partition or setups of the job are not valid.
+        """
+        unknown = sorted(key for key in job if key not in _JOB_KEYS)
+        if unknown:
+            raise ValueError("The job can not set {0}".format(', '.join(unknown)))
+
+        job_id = uuid.uuid4().hex[:12]
+        merged = dict(self.defaults)
+        merged.update((key, value) for key, value in job.items() if key != 'memory_budget')
+
+        if job.get('memory_budget') is not None:
+            try:
+                memory_budget = float(job['memory_budget'])
+            except (TypeError, ValueError):
+                raise ValueError("The memory_budget of the job is not a number")
+            if merged.get('memory_budget') is None or memory_budget < float(merged['memory_budget']):
+                merged['memory_budget'] = memory_budget
+
+        merged.setdefault('name', 'job_{0}'.format(job_id))
+        # The name is sent back in the headers of the result
+        if not isinstance(merged['name'], str) or any(ord(char) < 32 or ord(char) == 127
+                                                      for char in merged['name']):
+            raise ValueError("The name of the job has to be a string without control characters")
+        merged['output'] = os.path.join(self.output_dir, job_id)
+
+        try:
+            job_wafer(merged)
+        except (KeyError, TypeError) as e:
+            raise ValueError("The job is not valid: {0}".format(e))
+
+        record = {'id': job_id,
+                  'name': merged['name'],
+                  'priority': priority,
+                  'status': QUEUED,
+                  'submitted': time.time(),
+                  'started': None,
+                  'finished': None,
+                  'sections': len(merged.get('sections', [])),
+                  'done': 0,
+                  'section': None,
+                  'phase': None,
+                  'error': None,
+                  'result': None}
+
+        with self._lock:
+            self._records[job_id] = record
+            self._jobs[job_id] = merged
+            heapq.heappush(self._queue, (-priority, next(self._order), job_id))
+            workers = self._dispatch()
+        _start(workers)
+        return job_id
+
+    def status(self, job_id):
+        """Status of a job, None if there is no such job.
+
+        Returns:
+            Dictionary with the id, name, priority, status, the times it was
+            submitted, started and finished, the number of sections and of
+            sections done, the current section and phase, the error and the
+            result of cli.run_job. Queued jobs also have their position,
+            the number of jobs that run before them.
+        """
+        with self._lock:
+            if job_id not in self._records:
+                return None
+
+            status = dict(self._records[job_id])
+            if status['status'] == QUEUED:
+                queued = [entry[2] for entry in sorted(self._queue)
+                          if self._records[entry[2]]['status'] == QUEUED]
+                status['position'] = queued.index(job_id)
+        return status
+
+    def statuses(self):
+        """Status of every job in the order they were submitted."""
+        with self._lock:
+            job_ids = sorted(self._records, key=lambda job_id: self._records[job_id]['submitted'])
+        return [self.status(job_id) for job_id in job_ids]
+
+    def result_path(self, job_id):
+        """Path of the file generated by a job, None until it is done."""
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record['status'] != OK:
+                return None
+            return record['result']['output']
+
+    def cancel(self, job_id):
+        """Cancels a job.
+
+        A queued job is removed from the queue, a running one stops before
+        its next section and leaves no file.
+
+        Returns:
+            True if the job was queued or running.
+        """
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None or record['status'] not in (QUEUED, RUNNING):
+                return False
+
+            if record['status'] == QUEUED:
+                # Left in the heap, it is skipped when it comes out
+                del self._jobs[job_id]
+                record['status'] = CANCELLED
+                record['finished'] = time.time()
+            else:
+                self._events[job_id].set()
+            return True
+
+    def close(self):
+        """Cancels the running jobs and stops the worker processes."""
+        with self._lock:
+            for event in self._events.values():
+                event.set()
+            self._queue = []
+            workers = list(self._workers.values())
+
+        for worker in workers:
+            # A worker taken by _dispatch may not be started yet
+            if worker.pid is not None:
+                worker.join()
+        self._messages.put(None)
+        self._collector.join()
+        self._manager.shutdown()
+
+    def _dispatch(self):
+        """Takes the queued jobs with the highest priority while there are free processes.
+
+        Has to be called with the lock held. Their processes are returned
+        instead of started, so they start once the lock is released.
+        """
+        workers = []
+        while self._queue and len(self._workers) < self.processes:
+            _, _, job_id = heapq.heappop(self._queue)
+            record = self._records[job_id]
+            if record['status'] != QUEUED:
+                continue
+
+            record['status'] = RUNNING
+            record['started'] = time.time()
+            self._events[job_id] = self._manager.Event()
+            worker = _CONTEXT.Process(target=_run,
+                                      args=(job_id, self._jobs[job_id], self._messages, self._events[job_id]))
+            worker.daemon = True
+            self._workers[job_id] = worker
+            workers.append(worker)
+        return workers
+
+    def _finished(self, job_id, result):
+        """Records the result of a job and starts the next ones."""
+        self._workers[job_id].join()
+        with self._lock:
+            record = self._records[job_id]
+            record['status'] = result['status']
+            record['finished'] = time.time()
+            record['error'] = result['error']
+            record['result'] = result
+            if result['status'] == OK:
+                record['done'] = record['sections']
+
+            del self._jobs[job_id]
+            del self._events[job_id]
+            del self._workers[job_id]
+            workers = self._dispatch()
+        _start(workers)
+
+    def _collect_messages(self):
+        """Applies the phases and results sent by the workers to the status of their jobs."""
+        emitted = {}
+        while True:
+            try:
+                message = self._messages.get(timeout=_CHECK_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            except (EOFError, OSError):
+                # The manager is gone, the server is exiting
+                return
+            if message is None:
+                return
+
+            if message[0] == 'result':
+                self._finished(message[1], message[2])
+                continue
+
+            _, job_id, phase, section = message
+            with self._lock:
+                record = self._records[job_id]
+                if record['status'] != RUNNING:
+                    continue
+
+                # Tiled sections emit once per tile
+                if phase == 'emit' and emitted.get(job_id) != section:
+                    emitted[job_id] = section
+                    record['done'] += 1
+                record['section'] = section
+                record['phase'] = phase
+
+    def _check_workers(self):
+        """Fails the jobs whose process died without sending a result."""
+        with self._lock:
+            dead = [(job_id, worker.exitcode) for job_id, worker in self._workers.items()
+                    if worker.exitcode not in (None, 0)]
+
+        # A worker sends its result before exiting, so the ones exiting
+        # normally are always finished by their result.
+        for job_id, exitcode in dead:
+            job = self._jobs[job_id]
+            output = '{0}.{1}'.format(job['output'], job.get('format', Wafer.GDS))
+            if os.path.exists(output):
+                os.remove(output)
+
+            self._finished(job_id, {'name': job['name'],
+                                    'output': None,
+                                    'status': FAILED,
+                                    'error': "The worker process exited with code {0}".format(exitcode)})
+
+
+def _start(workers):
+    """Starts the processes returned by JobServer._dispatch."""
+    for worker in workers:
+        worker.start()
+
+
+class _ProgressObserver(Observer):
+    """Sends the phases of the generation of a job to the server."""
+
+    def __init__(self, job_id, messages):
+        self.job_id = job_id
+        self.messages = messages
+
+    def notify(self, event):
+        self.messages.put(('phase', self.job_id, event['phase'], event['section']))
+
+
+def _run(job_id, job, messages, cancel):
+    """Generates a job in a worker process and sends its result to the server."""
+    result = run_job(job, observer=_ProgressObserver(job_id, messages), cancel=cancel)
+    messages.put(('result', job_id, result))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Requests of the API, the JobServer is the jobs attribute of the server."""
+
+    def do_GET(self):
+        parts = self._parts()
+        if parts == ['jobs']:
+            self._send_json(200, self.server.jobs.statuses())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            status = self.server.jobs.status(parts[1])
+            if status is None:
+                self._send_error(404, "There is no job {0}".format(parts[1]))
+            else:
+                self._send_json(200, status)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+            self._send_result(parts[1])
+        else:
+            self._send_error(404, "Unknown path {0}".format(self.path))
+
+    def do_POST(self):
+        if self._parts() != ['jobs']:
+            self._send_error(404, "Unknown path {0}".format(self.path))
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(job, dict):
+                raise ValueError("The job has to be a JSON object")
+            priority = int(job.pop('priority', 0))
+            job_id = self.server.jobs.submit(job, priority)
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+
+        self._send_json(201, {'id': job_id})
+
+    def do_DELETE(self):
+        parts = self._parts()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            self._send_error(404, "Unknown path {0}".format(self.path))
+        elif self.server.jobs.cancel(parts[1]):
+            self._send_json(200, self.server.jobs.status(parts[1]))
+        elif self.server.jobs.status(parts[1]) is None:
+            self._send_error(404, "There is no job {0}".format(parts[1]))
+        else:
+            self._send_error(409, "Job {0} has already finished".format(parts[1]))
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def _parts(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def _send_result(self, job_id):
+        path = self.server.jobs.result_path(job_id)
+        if path is None:
+            status = self.server.jobs.status(job_id)
+            if status is None:
+                self._send_error(404, "There is no job {0}".format(job_id))
+            else:
+                self._send_error(409, "Job {0} is {1}".format(job_id, status['status']))
+            return
+
+        name = self.server.jobs.status(job_id)['name'].replace('"', '')
+        # Names outside ASCII may not fit in a header, they fall back to the id
+        if any(ord(char) > 126 for char in name):
+            name = job_id
+        name += os.path.splitext(path)[1]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Content-Disposition', 'attachment; filename="{0}"'.format(name))
+        self.end_headers()
+        with open(path, 'rb') as result_file:
+            shutil.copyfileobj(result_file, self.wfile, _CHUNK_BYTES)
+
+    def _send_json(self, code, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        self._send_json(code, {'error': message})
+
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(jobs, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+    """Creates the HTTP server of the API.
+
+    Args:
+        jobs: JobServer running the jobs.
+        host, port: address the server listens on.
+        socket_path: path of a Unix socket to listen on instead. (default None)
+
+    Returns:
+        The server, requests are handled once serve_forever is called.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+    else:
+        server = _TCPServer((host, port), _Handler)
+    server.jobs = jobs
+    return server
+
+
+def submit(url, job, priority=0):
+    """Submits a job to a server and returns its id.
+
+    The url of a server listening on a Unix socket is unix: followed by
+    the path of the socket, like unix:/tmp/masks.sock.
+
+    Raise:
+        ValueError: If the server rejects the job.
+        IOError: If the server can not be reached.
+    """
+    job = dict(job)
+    job['priority'] = priority
+    return _request(url, '/jobs', 'POST', job)['id']
+
+
+def job_status(url, job_id):
+    """Status of a job in a server, see JobServer.status."""
+    return _request(url, '/jobs/{0}'.format(job_id))
+
+
+def cancel(url, job_id):
+    """Cancels a job in a server, see JobServer.cancel."""
+    return _request(url, '/jobs/{0}'.format(job_id), 'DELETE')
+
+
+def download(url, job_id, path):
+    """Saves the file generated by a job in a server to a path."""
+    with _open(url, '/jobs/{0}/result'.format(job_id)) as response:
+        with open(path, 'wb') as result_file:
+            shutil.copyfileobj(response, result_file, _CHUNK_BYTES)
+
+
+class _UnixConnection(HTTPConnection):
+    """HTTP connection to a server listening on a Unix socket."""
+
+    def __init__(self, socket_path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def _request(url, path, method='GET', value=None):
+    with _open(url, path, method, value) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def _open(url, path, method='GET', value=None):
+    """Opens a request, the error sent by the server is raised as a ValueError."""
+    data = None if value is None else json.dumps(value).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+
+    if not url.startswith(_UNIX_SCHEME):
+        request = Request(url + path, data=data, method=method, headers=headers)
+        try:
+            return urlopen(request)
+        except HTTPError as e:
+            raise ValueError(_error_message(e, e))
+
+    connection = _UnixConnection(url[len(_UNIX_SCHEME):])
+    connection.request(method, path, body=data, headers=headers)
+    response = connection.getresponse()
+    # The response keeps reading from the socket once the connection is closed
+    connection.close()
+    if response.status >= 400:
+        with response:
+            raise ValueError(_error_message(response, '{0} {1}'.format(response.status, response.reason)))
+    return response
+
+
+def _error_message(response, default):
+    """Error sent by the server in the body of a response."""
+    try:
+        return json.loads(response.read().decode('utf-8'))['error']
+    except (ValueError, KeyError):
+        return str(default)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the masks submitted by several users.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on, 0.0.0.0 accepts other machines (default 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help="port to listen on (default {0})".format(DEFAULT_PORT))
+    parser.add_argument('--socket', default=None,
+                        help="listen on this Unix socket instead of a port, its url is unix:<path>")
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help="maximum number of jobs running at the same time (default number of cores)")
+    parser.add_argument('-o', '--output-dir', default='jobs',
+                        help="directory of the generated files (default jobs)")
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help="memory budget in MB of every job, a job can only lower it")
+    parser.add_argument('--cache-dir', default=None,
+                        help="mask cache shared by every job")
+    args = parser.parse_args(argv)
+
+    defaults = {}
+    if args.memory_budget is not None:
+        defaults['memory_budget'] = args.memory_budget
+    if args.cache_dir is not None:
+        defaults['cache_dir'] = args.cache_dir
+
+    jobs = JobServer(args.output_dir, args.processes, defaults)
+    server = serve(jobs, args.host, args.port, args.socket)
+    if args.socket is not None:
+        url = _UNIX_SCHEME + args.socket
+    else:
+        url = 'http://{0}:{1}'.format(args.host, args.port)
+    print("Serving on {0}".format(url))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
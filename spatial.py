@@ -0,0 +1,199 @@
+import numpy as np
+
+
+class GridIndex:
+    """Uniform grid index over axis aligned boxes.
+
+    Every box is registered in the cells of the grid it overlaps, and the
+    registrations are kept sorted by cell so the boxes of a cell are a
+    range of one array. Boxes are usually the bounding boxes of the
+    polygons of a PolygonBatch, and the indices returned by the queries are
+    the positions of the polygons in the batch.
+
+    Atributes:
+        boxes: (N,4) array with the x_min, x_max, y_min and y_max of every box.
+        cell_size: side of the cells of the grid.
+    """
+
+    def __init__(self, x_min, x_max, y_min, y_max, cell_size=None):
+        self.boxes = np.column_stack([np.asarray(c, dtype=float).reshape(-1) for c in (x_min, x_max, y_min, y_max)])
+
+        if len(self.boxes):
+            self._x = self.boxes[:, 0].min()
+            self._y = self.boxes[:, 2].min()
+            width = self.boxes[:, 1].max() - self._x
+            height = self.boxes[:, 3].max() - self._y
+        else:
+            self._x = self._y = width = height = 0.0
+
+        # About one box per cell when none is given
+        if cell_size is None:
+            cell_size = np.sqrt(width * height / max(len(self.boxes), 1))
+        self.cell_size = float(max(cell_size, width / 2.0 ** 15, height / 2.0 ** 15, 1.0e-9))
+
+        self._columns = int(width // self.cell_size) + 1
+        self._rows = int(height // self.cell_size) + 1
+
+        cells, boxes = self._entries(*self.boxes.T)
+        order = np.argsort(cells, kind='stable')
+        self._cells = cells[order]
+        self._cell_boxes = boxes[order]
+
+    @classmethod
+    def from_polygons(cls, polygons, cell_size=None):
+        """Creates the index of the bounding boxes of a PolygonBatch."""
+        return cls(*polygons.bounding_boxes(), cell_size=cell_size)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def query(self, x_min, x_max, y_min, y_max):
+        """Finds the boxes that touch a region.
+
+        Returns:
+            Sorted array with the indices of the boxes.
+        """
+        first_column, last_column, first_row, last_row = [int(c[0]) for c in self._cell_ranges(x_min, x_max,
+                                                                                                  y_min, y_max)]
+        if last_column < first_column or last_row < first_row:
+            return np.empty(0, dtype=np.int64)
+
+        columns, rows = np.meshgrid(np.arange(first_column, last_column + 1),
+                                    np.arange(first_row, last_row + 1), indexing='ij')
+        candidates = self._boxes_in(columns.reshape(-1) * self._rows + rows.reshape(-1))
+
+        boxes = self.boxes[candidates]
+        touching = (boxes[:, 0] <= x_max) & (boxes[:, 1] >= x_min) & (boxes[:, 2] <= y_max) & (boxes[:, 3] >= y_min)
+        return candidates[touching]
+
+    def nearest(self, x, y):
+        """Finds the box closest to a point.
+
+        The rings of cells around the point are searched until no box of
+        the next ring can be closer than the closest one found.
+
+        Returns:
+            (index, distance): index of the closest box, -1 if the index is
+                empty, and its distance to the point, 0 if the point is in it.
+        """
+        if len(self.boxes) == 0:
+            return -1, np.inf
+
+        column = int(np.clip((x - self._x) // self.cell_size, 0, self._columns - 1))
+        row = int(np.clip((y - self._y) // self.cell_size, 0, self._rows - 1))
+        # Distance from the point to the grid, when it is outside of it
+        outside = np.hypot(max(self._x - x, 0, x - (self._x + self._columns * self.cell_size)),
+                           max(self._y - y, 0, y - (self._y + self._rows * self.cell_size)))
+
+        best, best_distance = -1, np.inf
+        for ring in range(max(self._columns, self._rows)):
+            if best_distance <= outside + (ring - 1) * self.cell_size:
+                break
+
+            columns, rows = _ring(column, row, ring)
+            inside = (columns >= 0) & (columns < self._columns) & (rows >= 0) & (rows < self._rows)
+            candidates = self._boxes_in(columns[inside] * self._rows + rows[inside])
+            if len(candidates) == 0:
+                continue
+
+            boxes = self.boxes[candidates]
+            distances = np.hypot(np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 1]), 0),
+                                 np.maximum(np.maximum(boxes[:, 2] - y, y - boxes[:, 3]), 0))
+            closest = np.argmin(distances)
+            if distances[closest] < best_distance:
+                best, best_distance = int(candidates[closest]), float(distances[closest])
+
+        return best, best_distance
+
+    def pairs(self, distance):
+        """Finds the pairs of boxes closer than a distance.
+
+        Every box is grown by half the distance and registered again, the
+        boxes sharing a cell are the candidates.
+
+        Returns:
+            (first, second, distances): indices of the boxes of every pair,
+                first smaller than second, and the distance between them, 0
+                for the boxes that touch or overlap.
+        """
+        if len(self.boxes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+        half = distance / 2.0
+        cells, boxes = self._entries(self.boxes[:, 0] - half, self.boxes[:, 1] + half,
+                                     self.boxes[:, 2] - half, self.boxes[:, 3] + half)
+        order = np.argsort(cells, kind='stable')
+        cells, boxes = cells[order], boxes[order]
+
+        # Every registration is paired with the ones after it in its cell
+        group_ends = np.searchsorted(cells, cells, 'right')
+        partners = group_ends - np.arange(len(cells)) - 1
+        first = np.repeat(boxes, partners)
+        second = boxes[np.arange(partners.sum()) - np.repeat(np.cumsum(partners) - partners, partners) +
+                       np.repeat(np.arange(len(cells)) + 1, partners)]
+
+        first, second = np.minimum(first, second), np.maximum(first, second)
+        keys = np.unique(first * len(self.boxes) + second)
+        first, second = keys // len(self.boxes), keys % len(self.boxes)
+
+        distances = box_distances(self.boxes[first], self.boxes[second])
+        close = distances < distance
+        return first[close], second[close], distances[close]
+
+    def _cell_ranges(self, x_min, x_max, y_min, y_max):
+        """First and last column and row of the cells touched by the boxes, clipped to the grid."""
+        first_column = np.clip(np.floor((np.atleast_1d(x_min) - self._x) / self.cell_size), 0, self._columns - 1)
+        last_column = np.clip(np.floor((np.atleast_1d(x_max) - self._x) / self.cell_size), -1, self._columns - 1)
+        first_row = np.clip(np.floor((np.atleast_1d(y_min) - self._y) / self.cell_size), 0, self._rows - 1)
+        last_row = np.clip(np.floor((np.atleast_1d(y_max) - self._y) / self.cell_size), -1, self._rows - 1)
+        return [c.astype(np.int64) for c in (first_column, last_column, first_row, last_row)]
+
+    def _entries(self, x_min, x_max, y_min, y_max):
+        """Registers boxes in the cells they touch.
+
+        Returns:
+            (cells, boxes): cell and box of every registration.
+        """
+        first_column, last_column, first_row, last_row = self._cell_ranges(x_min, x_max, y_min, y_max)
+        columns = np.maximum(last_column - first_column + 1, 0)
+        rows = np.maximum(last_row - first_row + 1, 0)
+        counts = columns * rows
+
+        boxes = np.repeat(np.arange(len(counts)), counts)
+        position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        column = first_column[boxes] + position // rows[boxes]
+        row = first_row[boxes] + position % rows[boxes]
+        return column * self._rows + row, boxes
+
+    def _boxes_in(self, cells):
+        """Boxes registered in any of the cells, without repetitions."""
+        starts = np.searchsorted(self._cells, cells, 'left')
+        ends = np.searchsorted(self._cells, cells, 'right')
+        counts = ends - starts
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return np.unique(self._cell_boxes[positions])
+
+
+def box_distances(first, second):
+    """Distance between pairs of boxes, 0 if they touch or overlap.
+
+    Args:
+        first, second: (N,4) arrays with the x_min, x_max, y_min and y_max
+                       of the boxes.
+    """
+    dx = np.maximum(np.maximum(first[:, 0], second[:, 0]) - np.minimum(first[:, 1], second[:, 1]), 0)
+    dy = np.maximum(np.maximum(first[:, 2], second[:, 2]) - np.minimum(first[:, 3], second[:, 3]), 0)
+    return np.hypot(dx, dy)
+
+
+def _ring(column, row, ring):
+    """Columns and rows of the cells at a Chebyshev distance from a cell."""
+    if ring == 0:
+        return np.array([column]), np.array([row])
+
+    side = np.arange(-ring, ring + 1)
+    columns = np.concatenate((column + side, column + side, np.full(2 * ring - 1, column - ring),
+                              np.full(2 * ring - 1, column + ring)))
+    rows = np.concatenate((np.full(2 * ring + 1, row - ring), np.full(2 * ring + 1, row + ring),
+                           row + side[1:-1], row + side[1:-1]))
+    return columns, rows
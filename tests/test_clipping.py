@@ -0,0 +1,67 @@
+"""Closed form clipping of rectangles against the margin area."""
+import numpy
+import gdspy
+import pytest
+
+from wafer import Wafer
+from clipping import MarginArea
+from polygons import PolygonBatch
+import grid as Grid
+
+
+def margin_area():
+    wafer = Wafer(51, 5)
+    wafer._create_margin_area()
+    return wafer.margin_area, wafer.margin_points
+
+
+def areas(polygons):
+    """Area of every polygon of a list of (V,2) arrays."""
+    return numpy.array([abs(numpy.dot(points[:, 0], numpy.roll(points[:, 1], 1)) -
+                            numpy.dot(points[:, 1], numpy.roll(points[:, 0], 1))) / 2
+                        for points in polygons])
+
+
+def boolean_area(polygons, margin_points):
+    """Area of each polygon fitted in the margin with a boolean operation."""
+    fitted = []
+    for points in polygons:
+        result = gdspy.fast_boolean([points], [margin_points], 'and', max_points=3000)
+        fitted.append(0 if result is None else areas([numpy.array(p) for p in result.polygons]).sum())
+    return numpy.array(fitted)
+
+
+@pytest.mark.parametrize('horizontal', [False, True])
+def test_clipped_rectangles_match_the_boolean_operation(horizontal):
+    area, margin_points = margin_area()
+    walls = Grid.generate_grid_walls(700, 30, -26000, 26000, 52000, 52000)[int(not horizontal)]
+    rectangles = PolygonBatch.from_vertices(walls)
+    boundary = rectangles.filter(area.classify(rectangles) == MarginArea.BOUNDARY)
+    assert len(boundary)
+
+    solved = 0
+    for index in range(len(boundary)):
+        wall = boundary.filter(numpy.arange(len(boundary)) == index)
+        clipped, unresolved = area.clip_rectangles(wall)
+        if len(unresolved):
+            continue
+
+        solved += 1
+        # The boolean operation rounds the vertices to the database unit
+        assert numpy.isclose(areas(clipped.polygons).sum(), boolean_area(wall.polygons, margin_points)[0],
+                             rtol=1e-6)
+        assert numpy.all(numpy.hypot(clipped.points[:, 0], clipped.points[:, 1]) <= area.radius + 1e-6)
+        assert numpy.all(clipped.points[:, 1] >= area.flat_y - 1e-6)
+
+    assert solved > len(boundary) // 2
+
+
+def test_classify_boxes_matches_classify():
+    area = margin_area()[0]
+    pieces = numpy.concatenate(Grid.generate_grid_pieces(700, 30, -26000, 26000, 52000, 52000))
+    rectangles = PolygonBatch.from_vertices(pieces)
+    x_min, x_max, y_min, y_max = rectangles.bounding_boxes()
+
+    codes = area.classify(rectangles)
+    assert set(codes.tolist()) == set([MarginArea.INSIDE, MarginArea.OUTSIDE, MarginArea.BOUNDARY])
+    assert numpy.array_equal(area.classify_boxes(x_min, x_max, y_min, y_max), codes)
@@ -0,0 +1,46 @@
+"""The estimate has to count the structures the generator writes."""
+import pytest
+
+from wafer import Wafer, PROCESS_MEMORY, TILE_BYTES_PER_VERTEX
+from estimate import estimate
+from observers import Observer
+
+# Memory budget splitting the sections in tiles of 20000 vertices
+TILED_BUDGET = PROCESS_MEMORY + 20000 * TILE_BYTES_PER_VERTEX
+
+SETUPS = [(200, 50, Wafer.PILLARS),
+          (300, 20, Wafer.GRID),
+          (250, 10, Wafer.LINES_H),
+          (400, 30, Wafer.LINES_V),
+          (150, 40, Wafer.PILLARS),
+          (250, 10, Wafer.GRID),
+          (300, 20, Wafer.GRID),
+          (200, 50, Wafer.PILLARS),
+          (500, 50, Wafer.GRID)]
+
+
+class EmittedStructures(Observer):
+    """Adds up the structures emitted for every section."""
+
+    def __init__(self):
+        self.sections = {}
+
+    def notify(self, event):
+        if event['phase'] == 'emit':
+            self.sections[event['section']] = self.sections.get(event['section'], 0) + event['structures']
+
+
+@pytest.mark.parametrize('memory_budget', [None, TILED_BUDGET])
+@pytest.mark.parametrize('split_grid', [False, True])
+@pytest.mark.parametrize('hierarchical', [False, True])
+def test_estimated_structures_are_the_generated_ones(tmpdir, hierarchical, split_grid, memory_budget):
+    wafer = Wafer(51, 5, hierarchical=hierarchical, split_grid=split_grid)
+    wafer.partition(3, 3)
+    for section, (distance, radius, structure) in enumerate(SETUPS, 1):
+        wafer.add_setup(distance, radius, structure, section)
+
+    emitted = EmittedStructures()
+    wafer.generate_setups(str(tmpdir.join('mask')), observer=emitted, memory_budget=memory_budget)
+    report = estimate(wafer, memory_budget=memory_budget)
+
+    assert emitted.sections == dict((section, cost['structures']) for section, cost in report['sections'].items())
@@ -0,0 +1,76 @@
+"""Encoding and reading of GDSII streams."""
+import numpy
+import gdspy
+import pytest
+
+import gdsii
+from gdsii import MAX_VERTICES, StreamWriter, encode_boundaries, read_summary
+from polygons import PolygonBatch
+
+MULTIPLIER = 1000.0
+
+
+def batch():
+    """A triangle on layer 1 and two squares on layer 3, datatype 2."""
+    triangle = numpy.array([[0, 0], [10.5, 0], [0, 7.25]])
+    square = numpy.array([[0, 0], [4, 0], [4, 4], [0, 4]])
+    return [(triangle, 1, 0), (square - 20, 3, 2), (square + 30, 3, 2)]
+
+
+def test_encode_boundaries_matches_gdspy():
+    polygons = batch()
+    points = numpy.concatenate([points for points, _, _ in polygons])
+    counts = [len(points) for points, _, _ in polygons]
+    layers = [layer for _, layer, _ in polygons]
+    datatypes = [datatype for _, _, datatype in polygons]
+
+    expected = b''.join(gdspy.Polygon(points, layer, datatype).to_gds(MULTIPLIER)
+                        for points, layer, datatype in polygons)
+    assert encode_boundaries(points, counts, layers, datatypes, MULTIPLIER) == expected
+
+
+def test_encode_boundaries_rejects_too_many_vertices():
+    angles = numpy.linspace(0, 2 * numpy.pi, MAX_VERTICES, endpoint=False)
+    circle = numpy.column_stack((numpy.cos(angles), numpy.sin(angles)))
+    with pytest.raises(ValueError):
+        encode_boundaries(circle, [len(circle)], 1, 0, MULTIPLIER)
+
+
+def write_stream(path, timestamp, monkeypatch):
+    monkeypatch.setattr(gdsii, '_timestamp', lambda: timestamp)
+    polygons = batch()
+    writer = StreamWriter(path, 'TOP')
+    writer.write([PolygonBatch.from_polygons([points], layer, datatype) for points, layer, datatype in polygons])
+    writer.close()
+
+
+def test_read_summary_tallies_the_polygons(tmpdir, monkeypatch):
+    path = str(tmpdir.join('mask.gds'))
+    write_stream(path, (2020, 1, 2, 3, 4, 5), monkeypatch)
+
+    summary = read_summary(path, regions={'left': (-50, 0, -50, 0), 'right': (0, 50, 0, 50)})
+    assert summary['top_cells'] == ['TOP']
+    assert summary['polygons'] == 3
+    assert summary['vertices'] == 11
+    assert summary['layers'][(1, 0)]['polygons'] == 1
+    assert summary['layers'][(3, 2)]['polygons'] == 2
+    assert summary['bounding_box'] == pytest.approx((-20, 34, -20, 34))
+    assert summary['regions']['left']['polygons'] == 1
+    assert summary['regions']['right']['polygons'] == 2
+
+
+def test_read_summary_digest_ignores_the_modification_times(tmpdir, monkeypatch):
+    first = str(tmpdir.join('first.gds'))
+    second = str(tmpdir.join('second.gds'))
+    write_stream(first, (2020, 1, 2, 3, 4, 5), monkeypatch)
+    write_stream(second, (2021, 6, 7, 8, 9, 10), monkeypatch)
+
+    assert read_summary(first)['digest'] == read_summary(second)['digest']
+    assert read_summary(first, digest=False)['digest'] is None
+
+
+def test_read_summary_rejects_other_files(tmpdir):
+    path = tmpdir.join('text.gds')
+    path.write('not a stream')
+    with pytest.raises(ValueError):
+        read_summary(str(path))
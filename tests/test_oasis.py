@@ -0,0 +1,43 @@
+"""Regular arrays found in the positions written to OASIS files."""
+import numpy
+
+from oasis import repetitions
+
+
+def positions(arrays):
+    """Positions placed by the arrays returned by repetitions."""
+    placed = []
+    for x, y, columns, rows, x_space, y_space in arrays:
+        for row in range(rows):
+            for column in range(columns):
+                placed.append((x + column * x_space, y + row * y_space))
+    return placed
+
+
+def test_full_grid_is_one_array():
+    xs, ys = numpy.meshgrid(numpy.arange(5) * 30 - 60, numpy.arange(4) * 20 + 7)
+    origins = numpy.column_stack((xs.ravel(), ys.ravel()))
+
+    assert repetitions(origins[::-1]) == [(-60, 7, 5, 4, 30, 20)]
+
+
+def test_single_position():
+    assert repetitions([[3, 4]]) == [(3, 4, 1, 1, 0, 0)]
+    assert repetitions(numpy.empty((0, 2))) == []
+
+
+def test_arrays_place_every_position_once():
+    # Rows of a circular field, like the pillars inside the margin
+    random = numpy.random.RandomState(1)
+    xs, ys = numpy.meshgrid(numpy.arange(-20, 21) * 50, numpy.arange(-20, 21) * 50)
+    origins = numpy.column_stack((xs.ravel(), ys.ravel()))
+    origins = origins[numpy.hypot(origins[:, 0], origins[:, 1]) <= 900]
+    origins = numpy.concatenate((origins, random.randint(-5000, 5000, size=(40, 2))))
+    origins = numpy.unique(origins, axis=0)
+
+    arrays = repetitions(origins)
+    placed = positions(arrays)
+
+    assert len(placed) == len(origins)
+    assert sorted(placed) == sorted(map(tuple, origins.tolist()))
+    assert len(arrays) < len(origins) // 10
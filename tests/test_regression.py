@@ -0,0 +1,72 @@
+"""Every way of generating a mask has to write the same file."""
+import pytest
+
+from wafer import Wafer, PROCESS_MEMORY, TILE_BYTES_PER_VERTEX
+from gdsii import read_summary
+from maskcache import MaskCache
+
+# Memory budget splitting the sections in tiles of 20000 vertices
+TILED_BUDGET = PROCESS_MEMORY + 20000 * TILE_BYTES_PER_VERTEX
+
+
+def regression_wafer(hierarchical):
+    """2 inch wafer split in 2x2 sections of pillars and grids."""
+    wafer = Wafer(51, 5, hierarchical=hierarchical)
+    wafer.partition(2, 2)
+    wafer.add_setup(200, 50, Wafer.PILLARS, 1)
+    wafer.add_setup(300, 20, Wafer.GRID, 2)
+    wafer.add_setup(150, 40, Wafer.PILLARS, 3)
+    wafer.add_setup(250, 10, Wafer.GRID, 4)
+    return wafer
+
+
+def generate(tmpdir, name, hierarchical, **options):
+    """Generates the regression wafer and returns the read_summary of its file."""
+    filename = str(tmpdir.join(name))
+    regression_wafer(hierarchical).generate_setups(filename, **options)
+    return read_summary('{0}.{1}'.format(filename, Wafer.GDS), digest=True)
+
+
+@pytest.mark.parametrize('hierarchical', [False, True])
+@pytest.mark.parametrize('mode, options', [('workers', {'workers': 2}),
+                                           ('stream', {'stream': True})])
+def test_mode_writes_the_serial_file(tmpdir, hierarchical, mode, options):
+    assert generate(tmpdir, mode, hierarchical, **options)['digest'] == \
+        generate(tmpdir, 'serial', hierarchical)['digest']
+
+
+@pytest.mark.parametrize('hierarchical', [False, True])
+def test_repeated_generation_writes_the_same_file(tmpdir, hierarchical):
+    wafer = regression_wafer(hierarchical)
+    filename = str(tmpdir.join('repeated'))
+    wafer.generate_setups(filename)
+    first = read_summary(filename + '.' + Wafer.GDS)['digest']
+    wafer.generate_setups(filename)
+
+    assert read_summary(filename + '.' + Wafer.GDS)['digest'] == first
+
+
+@pytest.mark.parametrize('hierarchical', [False, True])
+def test_sections_from_the_mask_cache_write_the_same_file(tmpdir, hierarchical):
+    cache = MaskCache(str(tmpdir.join('cache')))
+    wafer = regression_wafer(hierarchical)
+    wafer.generate_setups(str(tmpdir.join('stored')), mask_cache=cache)
+
+    # Without the mask every section is loaded from the cache
+    cache.invalidate(cache.mask_key(wafer, Wafer.GDS))
+    loaded = generate(tmpdir, 'loaded', hierarchical, mask_cache=cache)
+
+    assert loaded['digest'] == generate(tmpdir, 'serial', hierarchical)['digest']
+
+
+@pytest.mark.parametrize('hierarchical', [False, True])
+@pytest.mark.parametrize('workers', [None, 2])
+def test_tiled_generation_writes_the_same_structures(tmpdir, hierarchical, workers):
+    # Tiles write the structures in another order and split the arrays
+    # of references, only the tallies of the file are the same.
+    budget = TILED_BUDGET * (workers + 1 if workers else 1)
+    tiled = generate(tmpdir, 'tiled', hierarchical, memory_budget=budget, workers=workers)
+    serial = generate(tmpdir, 'serial', hierarchical)
+
+    for key in ('polygons', 'vertices', 'layers', 'bounding_box'):
+        assert tiled[key] == serial[key]
@@ -1,5 +1,17 @@
+import collections
+import threading
+
 import numpy as np
 
+# Fewest points used to approximate a circle, whatever the tolerance
+MIN_CIRCLE_POINTS = 9
+
+# Number of circle templates kept in memory
+TEMPLATE_CACHE_SIZE = 256
+
+_templates = collections.OrderedDict()
+_templates_lock = threading.Lock()
+
 
 def generate_circle_points(radius, initial_angle, final_angle, points=199):
     """
@@ -21,6 +33,63 @@ def generate_circle_points(radius, initial_angle, final_angle, points=199):
 
     return  radius * np.cos(theta) , radius * np.sin(theta) 
     
-    
+def points_for_tolerance(radius, initial_angle, final_angle, tolerance, max_points=199):
+    """Calculates how many points a circle needs to respect a chord error.
+
+    The chord error is the largest distance between the circle and the
+    segments that join consecutive points.
+
+    Args:
+        radius: radius of the circle in microns
+        initial_angle: initial angle of the drawing in degrees
+        final_angle: final angle of the drawing in degrees
+        tolerance: maximum chord error in microns
+        max_points: upper limit of points (default 199)
+
+    Returns:
+        Amount of points between MIN_CIRCLE_POINTS and max_points.
+    """
+    if tolerance >= radius:
+        return MIN_CIRCLE_POINTS
+
+    step = 2 * np.arccos(1 - float(tolerance) / radius)
+    segments = int(np.ceil(np.deg2rad(abs(final_angle - initial_angle)) / step))
+
+    return int(min(max(segments + 1, MIN_CIRCLE_POINTS), max_points))
+
+def circle_template(radius, initial_angle, final_angle, tolerance=None, points=None, max_points=199):
+    """Returns the points of a circle shape, reusing the ones already calculated.
+
+    Templates are kept in a least recently used cache of TEMPLATE_CACHE_SIZE
+    entries. The returned array is shared, so it is read only.
+
+    Args:
+        radius: radius of the circle in microns
+        initial_angle: initial angle of the drawing in degrees
+        final_angle: final angle of the drawing in degrees
+        tolerance: maximum chord error in microns, used when points is None
+        points: amount of points to be generated. If both points and tolerance
+                are None max_points is used.
+        max_points: upper limit of points (default 199)
+
+    Returns:
+        (V,2) array with the points that form the circle
+    """
+    key = (radius, initial_angle, final_angle, tolerance, points, max_points)
+
+    with _templates_lock:
+        template = _templates.pop(key, None)
+        if template is None:
+            if points is None and tolerance is not None:
+                points = points_for_tolerance(radius, initial_angle, final_angle, tolerance, max_points)
+            elif points is None:
+                points = max_points
+
+            template = np.column_stack(generate_circle_points(radius, initial_angle, final_angle, points))
+            template.flags.writeable = False
 
+        _templates[key] = template
+        if len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
 
+    return template
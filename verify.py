@@ -0,0 +1,99 @@
+"""Checks a generated GDSII file against the setups of its wafer.
+
+The file is read with gdsii.read_summary, without loading it, and the
+structures found in every section are compared with the ones the setups
+give, counted by estimate.estimate:
+
+    report = verify_file(wafer, 'mask.gds')
+    for problem in report['problems']:
+        print(problem)
+
+Structures crossing the margin can be left empty by the clipping, or be
+merged with the walls they cross, so a section has to hold at least its
+structures inside the margin and at most all of its structures.
+"""
+from wafer import Wafer
+from estimate import estimate
+from gdsii import read_summary
+
+
+def verify_file(wafer, path, digest=None):
+    """Checks a GDSII file generated from the setups of a wafer.
+
+    Args:
+        wafer: Wafer with the partition and setups used to generate the file.
+        path: path of the .gds file.
+        digest: digest of a previous generation of the same mask, see
+                read_summary. If given the file has to match it. (default None)
+
+    Returns:
+        Dictionary with:
+            sections: dictionary from section number to the inside and
+                      expected structures, and the structures and vertices
+                      found.
+            summary: dictionary returned by read_summary.
+            problems: messages about the differences found, empty if the
+                      file matches the setups.
+
+    Raise:
+        ValueError: If the file is not a GDSII stream.
+    """
+    regions = {}
+    for section in wafer.setups:
+        if section <= wafer.num_sections:
+            x, y, width, height = wafer._section_area(section)
+            regions[section] = (x, x + width, y - height, y)
+
+    summary = read_summary(path, regions)
+    expected = estimate(wafer, max_file_size=None)
+
+    problems = []
+    if abs(summary['unit'] - wafer.unit) > 1e-6 * wafer.unit or \
+            abs(summary['precision'] - wafer.precision) > 1e-6 * wafer.precision:
+        problems.append("The file has a unit of {0} m and a precision of {1} m instead of {2} m and {3} m".format(
+            summary['unit'], summary['precision'], wafer.unit, wafer.precision))
+
+    if summary['top_cells'] != [wafer.cell_name]:
+        problems.append("The top cells of the file are {0} instead of {1}".format(
+            ', '.join(summary['top_cells']), wafer.cell_name))
+
+    tallies = dict((section, dict(tally)) for section, tally in summary['regions'].items())
+    for layer, name in ((Wafer.WAFER_LAYER, "wafer"), (Wafer.MARGIN_LAYER, "margin")):
+        if (layer, 0) not in summary['layers']:
+            problems.append("The {0} outline is missing from layer {1}".format(name, layer))
+            continue
+
+        # The outline is counted in the section holding the center of its
+        # bounding box, like the structures.
+        outline = summary['layers'][(layer, 0)]
+        x_min, x_max, y_min, y_max = outline['bounding_box']
+        for section, (left, right, bottom, top) in regions.items():
+            if left <= (x_min + x_max) / 2.0 <= right and bottom <= (y_min + y_max) / 2.0 <= top:
+                tallies[section]['polygons'] -= outline['polygons']
+                tallies[section]['vertices'] -= outline['vertices']
+                break
+
+    sections = {}
+    for section, cost in sorted(expected['sections'].items()):
+        found = tallies[section]
+        sections[section] = {'inside': cost['inside'],
+                             'expected': cost['structures'],
+                             'found': found['polygons'],
+                             'vertices': found['vertices']}
+
+        if not cost['inside'] <= found['polygons'] <= cost['structures']:
+            problems.append("Section {0} has {1} structures instead of {2} to {3}".format(
+                section, found['polygons'], cost['inside'], cost['structures']))
+
+    structures = sum(cost['structures'] for cost in expected['sections'].values())
+    found = summary['layers'].get((Wafer.STRUCTURES_LAYER, 0), {'polygons': 0})['polygons']
+    if found > structures:
+        problems.append("Layer {0} has {1} structures, only {2} are expected".format(
+            Wafer.STRUCTURES_LAYER, found, structures))
+
+    if digest is not None and summary['digest'] != digest:
+        problems.append("The digest of the file is {0} instead of {1}".format(summary['digest'], digest))
+
+    return {'sections': sections,
+            'summary': summary,
+            'problems': problems}
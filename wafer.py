@@ -1,10 +1,40 @@
+import collections
+import contextlib
+import hashlib
+import multiprocessing
+import os
+
 import numpy
 import gdspy
 
-from tools import generate_circle_points as gc
+from tools import circle_template
+from clipping import MarginArea
+from gdsii import StreamWriter
+from oasis import OasisWriter
+from polygons import PolygonBatch
+import observers
 import pillar as Pillar
 import grid as Grid
 
+# Memory used by every vertex of a tile while it is generated, classified,
+# clipped and encoded. Streamed pillar sections peak at about 50 bytes per
+# vertex, the rest is left for the boolean operation of the clipping.
+TILE_BYTES_PER_VERTEX = 96
+
+# Memory of a process before it builds anything: the interpreter, numpy
+# and gdspy.
+PROCESS_MEMORY = 64 * 2 ** 20
+
+# Vertices counted for every pillar or grid cell of a hierarchical section,
+# only the ones crossing the margin get their outline, the rest are
+# classified.
+_HIERARCHICAL_VERTICES = 2
+
+
+class GenerationCancelled(Exception):
+    """Raised by Wafer.generate_setups when the generation is cancelled."""
+    pass
+
 
 class Wafer:
     """Handles all the processes of modeling on a wafer shape.
@@ -44,6 +74,29 @@ class Wafer:
                     setup['distance']
                     setup['radius']
                     setup['structure']
+        hierarchical: If True the pillar fields are written as arrays of
+                      references to a single pillar cell and only the pillars
+                      crossing the margin are written as clipped polygons.
+                      Sections with the same setup that are not clipped by
+                      the margin are built once in a field cell, placed by a
+                      reference at each of them. (default False)
+        tolerance: Maximum distance in units between a circle and the polygon
+                   that approximates it. The number of vertices of pillars and
+                   outlines comes from it. (default one precision step)
+        circle_points: If set, every pillar has exactly this number of
+                       vertices instead of using the tolerance. (default None)
+        split_grid: If True the walls of Grid sections do not overlap, every
+                    crossing is drawn once. The walls along y are split at
+                    the crossings, or in hierarchical wafers the grid is
+                    written as arrays of references to a cell with one
+                    crossing and only the cells crossing the margin are
+                    written as clipped polygons. (default False)
+        cache: If True the geometry of every section is kept after
+               generating, and the next generation only rebuilds the
+               sections whose setup or wafer parameters changed. (default False)
+        library: gdspy.GdsLibrary holding the cells of this wafer. Every
+                 wafer has its own library, so several wafers with the same
+                 cell name can be generated at the same time.
             
     Raises:
         ValueError: If the specified wafer size is not listed or
@@ -65,8 +118,8 @@ class Wafer:
    
     # Each wafer has a different starting and ending angle
     # where the flat mark is.
-    _ANGLES = {SIZE_2_IN:71.86, SIZE_4_IN:71.03, SIZE_6_IN: 67.46}
-    _FLAT_FRAGMENTS = {SIZE_2_IN: 24.23, SIZE_4_IN: 47.28, SIZE_6_IN: 69.27}
+    _ANGLES = {SIZE_2_IN:71.86, SIZE_4_IN:71.03, SIZE_6_IN: 67.46, SIZE_8_IN: 73.29}
+    _FLAT_FRAGMENTS = {SIZE_2_IN: 24.23, SIZE_4_IN: 47.28, SIZE_6_IN: 69.27, SIZE_8_IN: 95.78}
 
     _ZERO_DEGREES = 0
     _180_DEGREES = 180
@@ -93,9 +146,16 @@ class Wafer:
     
     STRUCTURES = [PILLARS, GRID, LINES_V, LINES_H]
 
+    # File formats, named after their extension
+    GDS = 'gds'
+    OASIS = 'oas'
+
+    FORMATS = [GDS, OASIS]
+
     DEFAULT_FILENAME = 'mask'
 
-    def __init__(self,size, margin, unit=MICRONS, precision=NANOMETERS, cell_name = "WAFER"):
+    def __init__(self,size, margin, unit=MICRONS, precision=NANOMETERS, cell_name = "WAFER",
+                 hierarchical=False, tolerance=None, circle_points=None, cache=False, split_grid=False):
         if size  not in self.SIZES:
             raise ValueError("The wafer must be a valid size: {0}".format(self.SIZES))
         
@@ -114,8 +174,19 @@ class Wafer:
         self.margin = margin * self._MM_IN_MICRONS
         self.unit = unit
         self.precision = precision
-        self.cell = gdspy.Cell(cell_name)
         self.cell_name = cell_name
+        self.library = gdspy.GdsLibrary()
+        self.cell = self._new_cell(cell_name)
+        self.hierarchical = hierarchical
+        self.tolerance = tolerance if tolerance is not None else precision / unit
+        self.circle_points = circle_points
+        self.split_grid = split_grid
+        self.cache = cache
+        self._pillar_cells = {}
+        self._grid_cells = {}
+        self._field_cells = {}
+        self._section_cache = {}
+        self._writer = None
         
         self._create_drawing_area() 
         self.rows = 1
@@ -127,12 +198,9 @@ class Wafer:
     def _create_main_shape(self):
         """Creates the wafer shape in the file."""
 
-        a, b = gc( self.size/2,
-                self._ZERO_DEGREES - self.angle,
-                self._180_DEGREES + self.angle)
-        self.wafer_points = zip(a,b)
+        self._create_wafer_points()
         self.wafer_polygon = gdspy.Polygon(self.wafer_points, self.WAFER_LAYER)
-        self.cell.add(self.wafer_polygon)
+        self._add(self.wafer_polygon)
 
     def _create_margin_shape(self):
         """Creates the margin shape in the file.
@@ -141,16 +209,63 @@ class Wafer:
         margin units away from the wafer shape.
         """
 
-        a, b = gc((self.size/2 - self.margin),
-                   self._ZERO_DEGREES - self.angle,
-                   self._180_DEGREES + self.angle)
-        self.margin_points = zip(a, b)
+        self._create_margin_area()
         self.margin_polygon = gdspy.Polygon(self.margin_points, self.MARGIN_LAYER)
-        self.cell.add(self.margin_polygon)
+        self._add(self.margin_polygon)
     
+    def _create_wafer_points(self):
+        """Calculates the wafer outline without adding it to the file."""
+        self.wafer_points = circle_template(self.size/2,
+                                            self._ZERO_DEGREES - self.angle,
+                                            self._180_DEGREES + self.angle,
+                                            self.tolerance)
+
+    def _create_margin_area(self):
+        """Calculates the margin polygon and its MarginArea without adding them to the file."""
+        self.margin_radius = self.size/2 - self.margin
+        self.margin_points = circle_template(self.margin_radius,
+                                             self._ZERO_DEGREES - self.angle,
+                                             self._180_DEGREES + self.angle,
+                                             self.tolerance)
+
+        # The margin polygon is made of chords, so the closest its edges get
+        # to the center is a bit less than the radius. The flat is the chord
+        # closing the polygon.
+        step = numpy.deg2rad(self._180_DEGREES + 2 * self.angle) / (len(self.margin_points) - 1)
+        self.margin_area = MarginArea(self.margin_radius,
+                                      self.margin_radius * numpy.cos(step / 2),
+                                      self.margin_points[0][1],
+                                      self.margin_points)
+
+    def _add(self, element):
+        """Adds an element to the wafer cell.
+
+        While streaming, the element is written to the file right away
+        instead of being kept in the cell.
+        """
+        if self._writer is None:
+            self.cell.add(element)
+            return
+
+        if isinstance(element, (gdspy.CellArray, gdspy.CellReference)):
+            self._writer.add_cell(element.ref_cell)
+            for cell in element.ref_cell.get_dependencies(True):
+                self._writer.add_cell(cell)
+        self._writer.write([element])
+
+    def _new_cell(self, name):
+        """Creates a cell in the library of the wafer, outside of gdspy's current library."""
+        cell = gdspy.Cell(name, exclude_from_current=True)
+        self.library.add(cell)
+        return cell
+
     def _clear_library(self):
-        gdspy.Cell.cell_dict.pop(self.cell_name)
-        del self.cell
+        """Removes every cell of the wafer and starts again from an empty top cell."""
+        self.library = gdspy.GdsLibrary()
+        self.cell = self._new_cell(self.cell_name)
+        self._pillar_cells = {}
+        self._grid_cells = {}
+        self._field_cells = {}
 
     def _create_drawing_area(self):
         """Creates a rectangular shape fits the margin area in it.
@@ -169,14 +284,33 @@ class Wafer:
         self.drawing_x_step = self.drawing_width 
         self.drawing_y_step = self.drawing_height
 
-    def write(self, filename=DEFAULT_FILENAME):
+    def write(self, filename=DEFAULT_FILENAME, file_format=GDS):
         """Saves the generated structures.
         
         Args:
-            filename: name of the file to be saved ommiting the .gds extension.
+            filename: name of the file to be saved ommiting the extension.
+            file_format: GDS or OASIS, the extension of the file. (default GDS)
+
+        Raise:
+            ValueError: If the format is not one of FORMATS.
         """
+        self._check_format(file_format)
+        path = '{0}.{1}'.format(filename, file_format)
 
-        gdspy.write_gds('{0}.gds'.format(filename), unit=self.unit, precision=self.precision)
+        if file_format == self.GDS:
+            self.library.write_gds(path, unit=self.unit, precision=self.precision)
+            return
+
+        writer = OasisWriter(path, self.cell_name, unit=self.unit, precision=self.precision)
+        writer.write(self.cell.elements)
+        for cell in self.library.cell_dict.values():
+            if cell is not self.cell:
+                writer.add_cell(cell)
+        writer.close()
+
+    def _check_format(self, file_format):
+        if file_format not in self.FORMATS:
+            raise ValueError("The file format has to be a valid one: {0}".format(self.FORMATS))
 
     def partition(self, rows, cols):
         """Partitions the drawing area into the specified rows and colums.
@@ -230,16 +364,11 @@ class Wafer:
         self._create_drawing_area()
         self.partition(self.rows, self.cols)
 
-    def _generate_section_structures(self, distance, radius, structure=PILLARS, section=1):
-        """Generates the desired structures in the selected section.
+    def _section_area(self, section):
+        """Calculates the rectangular area of a section.
 
-        Args:
-            distance: In the case of pillars is the distance between their centers and in 
-                      the case of grid is the distance between the middle oftwo parallel "walls".
-            radius: In the case of pillars is the distance between the center and the edge. In the
-                    case of grid is the distance between each edge.
-            structure: Structure that is going to be generated. (default Pillars)
-            section: Section where the structures are going to be generated.
+        Returns:
+            (x, y, width, height): Top left corner and size of the section.
 
         Raise:
             ValueError: If the selected section is out of range.
@@ -258,51 +387,194 @@ class Wafer:
         width = self.drawing_x_step - self.GAP_BETWEEN_SECTIONS/2 
         height = self.drawing_y_step - self.GAP_BETWEEN_SECTIONS/2
 
-        polygons = []
-        if structure == self.PILLARS:
-            pillars = Pillar.generate_pilars_region(distance,
-                                                    radius, 
-                                                    x, 
-                                                    y, 
-                                                    width, 
-                                                    height)
+        return x, y, width, height
 
-            for pillar in pillars:
-                poly = gdspy.Polygon(pillar, self.STRUCTURES_LAYER)
-                polygons.append(poly)
+    def _section_spec(self, distance, radius, structure, section):
+        """Collects everything needed to build the geometry of a section.
 
-        else:
-            horizontal, vertical = Grid.generate_grid_region(distance,
-                                                             radius,
-                                                             x,
-                                                             y,
-                                                             width,
-                                                             height)
-            if structure == self.GRID:
+        The spec only holds plain values and arrays so it can be sent to
+        a worker process.
+        """
+        x, y, width, height = self._section_area(section)
+
+        return {'section': section,
+                'distance': distance,
+                'radius': radius,
+                'structure': structure,
+                'x': x,
+                'y': y,
+                'width': width,
+                'height': height,
+                'hierarchical': self.hierarchical,
+                'split_grid': self.split_grid,
+                'layer': self.STRUCTURES_LAYER,
+                'tolerance': self.tolerance,
+                'circle_points': self.circle_points,
+                'margin_area': self.margin_area,
+                'margin_points': self.margin_points}
+
+    def _section_key(self, section, setup):
+        """Identifies the geometry of a section.
+
+        The key holds everything build_section depends on, two sections
+        with the same key have the same geometry.
+        """
+        return (section,
+                setup['distance'],
+                setup['radius'],
+                setup['structure'],
+                self.size,
+                self.margin,
+                self.angle,
+                self.rows,
+                self.cols,
+                self.unit,
+                self.precision,
+                self.tolerance,
+                self.circle_points,
+                self.hierarchical,
+                self.split_grid)
+
+    def _generate_section_structures(self, distance, radius, structure=PILLARS, section=1):
+        """Generates the desired structures in the selected section.
+
+        Args:
+            distance: In the case of pillars is the distance between their centers and in 
+                      the case of grid is the distance between the middle oftwo parallel "walls".
+            radius: In the case of pillars is the distance between the center and the edge. In the
+                    case of grid is the distance between each edge.
+            structure: Structure that is going to be generated. (default Pillars)
+            section: Section where the structures are going to be generated.
+
+        Raise:
+            ValueError: If the selected section is out of range.
+        """
+        spec = self._section_spec(distance, radius, structure, section)
+
+        self.setups[section] = {'radius': radius, 'distance': distance, 'structure': structure}
+        self._add_section_geometry(self.setups[section], build_section(spec))
 
-                for h in horizontal:
-                    poly = gdspy.Rectangle(h[0], h[1], self.STRUCTURES_LAYER )
-                    polygons.append(poly)
+    def _field_key(self, setup):
+        """Identifies the geometry of a section that is not clipped by the margin.
 
-                for v in vertical:
-                    poly = gdspy.Rectangle(v[0], v[1], self.STRUCTURES_LAYER )
-                    polygons.append(poly)
+        Such a section only depends on its setup and its size, two of them
+        with the same key are the same geometry at different origins.
+        """
+        return (setup['distance'],
+                setup['radius'],
+                setup['structure'],
+                self.drawing_x_step,
+                self.drawing_y_step,
+                self.tolerance,
+                self.circle_points,
+                self.split_grid)
+
+    def _shared_fields(self, sections):
+        """Finds the sections that can be placed as references to a field cell.
 
-            elif structure == self.LINES_H:
+        Args:
+            sections: list of (section, setup).
 
-                for v in vertical:
-                    poly = gdspy.Rectangle(v[0], v[1], self.STRUCTURES_LAYER)
-                    polygons.append(poly)
-            elif structure == self.LINES_V:
+        Returns:
+            Dictionary from section to its field key, for the sections that
+            are completely inside the margin and have the same field as
+            another one.
+        """
+        fields = {}
+        for section, setup in sections:
+            x, y, width, height = self._section_area(section)
+            if self.margin_area.classify_boxes(x, x + width, y - height, y) == MarginArea.INSIDE:
+                fields[section] = self._field_key(setup)
 
-                for h in horizontal:
-                    poly = gdspy.Rectangle(h[0], h[1], self.STRUCTURES_LAYER)
-                    polygons.append(poly)
+        counts = collections.Counter(fields.values())
+        return dict((section, field) for section, field in fields.items() if counts[field] > 1)
 
-        self.setups[section] = {'radius': radius, 'distance': distance, 'structure': structure}
-        # The fitting the generated rectangular section in the Margin area
-        merged = gdspy.fast_boolean(polygons, self.margin_polygon, 'and', layer=self.STRUCTURES_LAYER,max_points=3000)
-        self.cell.add(merged)
+    def _place_field(self, field, setup, section, geometry):
+        """Places a field cell at the origin of a section.
+
+        The cell is created from the geometry of the section the first
+        time, with its origin at the top left corner of the section.
+
+        Args:
+            field: field key of the section, see _field_key.
+            setup: setup of the section.
+            section: number of the section.
+            geometry: dictionary returned by build_section for the section,
+                      only needed if the cell does not exist yet.
+        """
+        x, y = self._section_area(section)[:2]
+        if field not in self._field_cells:
+            name = '{0}_FIELD_{1}'.format(self.cell_name, hashlib.sha1(repr(field).encode('utf-8')).hexdigest()[:8])
+            arrays = geometry['arrays'].copy()
+            arrays[:, 3] -= x
+            arrays[:, 4] -= y
+            local = {'arrays': arrays,
+                     'inside': geometry['inside'].translate(-x, -y),
+                     'clipped': geometry['clipped'].translate(-x, -y),
+                     'structures': geometry['structures']}
+
+            cell = self._new_cell(name)
+            self._add_section_geometry(setup, local, cell)
+            self._field_cells[field] = (cell, _geometry_counts(local)[0])
+
+        self._add(gdspy.CellReference(self._field_cells[field][0], (x, y)))
+
+    def _add_section_geometry(self, setup, geometry, cell=None):
+        """Adds the geometry built by build_section to the wafer cell.
+
+        Args:
+            setup: setup of the section.
+            geometry: dictionary returned by build_section.
+            cell: cell the geometry is added to instead of the wafer cell.
+                  (default None)
+        """
+        add = self._add if cell is None else cell.add
+        if len(geometry['arrays']):
+            if setup['structure'] == self.PILLARS:
+                reference = self._pillar_cell(setup['radius'])
+            else:
+                reference = self._grid_cell(setup['distance'], setup['radius'])
+
+            for columns, rows, pitch, origin_x, origin_y in geometry['arrays'].tolist():
+                add(gdspy.CellArray(reference,
+                                    int(columns),
+                                    int(rows),
+                                    (pitch, pitch),
+                                    (origin_x, origin_y)))
+
+        # The batches are encoded as they are, without creating a gdspy
+        # object for every structure.
+        for polygons in (geometry['inside'], geometry['clipped']):
+            if len(polygons):
+                add(polygons)
+
+    def _pillar_cell(self, radius):
+        """Returns the cell holding a single pillar of the given radius.
+
+        Cells are created once per radius and shared between sections.
+        """
+        if radius not in self._pillar_cells:
+            name = '{0}_PILLAR_{1}'.format(self.cell_name, len(self._pillar_cells) + 1)
+            template = Pillar.generate_pilar_template(radius, self.tolerance, self.circle_points)
+            cell = self._new_cell(name)
+            cell.add(gdspy.Polygon(template, self.STRUCTURES_LAYER))
+            self._pillar_cells[radius] = cell
+
+        return self._pillar_cells[radius]
+
+    def _grid_cell(self, distance, thickness):
+        """Returns the unit cell of the grids with the given distance and thickness.
+
+        Cells are created once per grid and shared between sections.
+        """
+        if (distance, thickness) not in self._grid_cells:
+            name = '{0}_GRID_{1}'.format(self.cell_name, len(self._grid_cells) + 1)
+            cell = self._new_cell(name)
+            for rectangle in Grid.generate_grid_cell(distance, thickness):
+                cell.add(gdspy.Polygon(rectangle, self.STRUCTURES_LAYER))
+            self._grid_cells[(distance, thickness)] = cell
+
+        return self._grid_cells[(distance, thickness)]
 
     def add_setup(self, distance, radius, structure=PILLARS, section=1):
         """Sets the type of structure and properties per section.
@@ -316,9 +588,13 @@ class Wafer:
             section: Section where the structures are going to be generated.
 
         Raise:
-            ValueError: If the selected section is out of range.
+            ValueError: If the selected section is out of range or the
+                        structure is not one of STRUCTURES.
         """
 
+        if structure not in self.STRUCTURES:
+            raise ValueError("The structure has to be one of {0}".format(self.STRUCTURES))
+
         if section > self.num_sections:
             raise ValueError("Selected Section has to be less or equal than {0}".format(self.num_sections));
         
@@ -326,23 +602,642 @@ class Wafer:
             raise ValueError("Selected Section has to be less or equal than {0}".format(self.num_sections));
         self.setups[section] = {'radius':radius, 'distance':distance, 'structure':structure}
 
-    def generate_setups(self,filename=DEFAULT_FILENAME):
-        """Creates every setup in the file."""
-        
-        self._create_main_shape()
-        self._create_margin_shape()
+    def _plan_fields(self, sections, tiled):
+        """Finds the sections placed as references to a field cell.
+
+        Hierarchical sections repeating a field inside the margin are
+        references to a field cell, only the first one is built. The cells
+        of fields no longer used are removed, so they are not written.
+
+        Args:
+            sections: sorted list of (section, setup).
+            tiled: True if the sections are split in tiles, they are never
+                   placed as fields.
 
-        for section, setup in self.setups.iteritems():
-            self._generate_section_structures(setup['distance'],
-                                              setup['radius'],
-                                              setup['structure'],
-                                              section)
-        self.write(filename)
+        Returns:
+            Dictionary from section to its field key, see _shared_fields.
+        """
+        fields = {}
+        if self.hierarchical and not tiled:
+            fields = self._shared_fields(sections)
+        for field in set(self._field_cells) - set(fields.values()):
+            del self.library.cell_dict[self._field_cells.pop(field)[0].name]
+        return fields
 
+    def _plan_sections(self, sections, fields, max_vertices, mask_cache, timed):
+        """Finds the sections that have to be built and how.
 
+        Sections kept from the previous generation and the ones placed as
+        a field built by an earlier section are not built. Whole sections
+        stored in the mask cache are loaded instead, the rest are split in
+        tiles if needed.
 
+        Args:
+            sections: sorted list of (section, setup).
+            fields: dictionary returned by _plan_fields.
+            max_vertices: vertices of a tile, None for whole sections.
+            mask_cache: maskcache.MaskCache or None.
+            timed: True if the phases of the sections are measured.
+
+        Returns:
+            Dictionary with:
+                keys: section key of every section, see _section_key.
+                tiles: dictionary from section key to the specs of the
+                       tiles, or of the whole section, to be built.
+                stored: dictionary from section key to its key in the
+                        mask cache.
+                loaded: dictionary from section key to the spec of the
+                        sections found in the mask cache.
+                missing: specs to be built, in order.
+        """
+        keys = [self._section_key(section, setup) for section, setup in sections]
+        tiles = {}
+        stored = {}
+        loaded = {}
+        planned = set()
+        for (section, setup), key in zip(sections, keys):
+            field = fields.get(section)
+            if field is not None:
+                if field in self._field_cells or field in planned:
+                    continue
+                planned.add(field)
+
+            if key in self._section_cache:
+                continue
+
+            spec = self._section_spec(setup['distance'],
+                                      setup['radius'],
+                                      setup['structure'],
+                                      section)
+            spec['timed'] = timed
+            if mask_cache is not None and max_vertices is None:
+                stored[key] = mask_cache.section_key(self, section, setup)
+                if mask_cache.has_section(stored[key]):
+                    loaded[key] = spec
+                    continue
+            tiles[key] = [spec] if max_vertices is None else split_section(spec, max_vertices)
+
+        return {'keys': keys,
+                'tiles': tiles,
+                'stored': stored,
+                'loaded': loaded,
+                'missing': [spec for key in keys if key in tiles for spec in tiles[key]]}
+
+    def _section_geometry(self, key, plan, built, mask_cache, observer):
+        """Returns the geometry of a section, or of its next tile.
+
+        It is the one kept from the previous generation, loaded from the
+        mask cache or the next one built. Built sections are stored in the
+        mask cache.
 
+        Args:
+            key: section key, see _section_key.
+            plan: dictionary returned by _plan_sections.
+            built: iterator of the geometries of plan['missing'].
+            mask_cache: maskcache.MaskCache or None.
+            observer: notified of the phases of the built sections, or None.
+        """
+        geometry = self._section_cache.get(key)
+        if key in plan['loaded']:
+            geometry = mask_cache.get_section(plan['stored'][key])
+
+        if geometry is None:
+            # Built here if it left the mask cache meanwhile
+            geometry = build_section(plan['loaded'][key]) if key in plan['loaded'] else next(built)
+            if observer is not None:
+                for event in geometry['phases']:
+                    observer.notify(event)
+            if key in plan['stored']:
+                mask_cache.put_section(plan['stored'][key], geometry)
+        return geometry
+
+    def _emit_section(self, section, setup, field, geometry, clock, observer):
+        """Adds a section, or one of its tiles, to the wafer cell and reports it.
 
+        Args:
+            section: number of the section.
+            setup: setup of the section.
+            field: field key of the section, or None if it is not a field.
+            geometry: dictionary returned by build_section, None for a
+                      field built by an earlier section.
+            clock: clock of the generation, see the observers module.
+            observer: notified of the emit phase, or None.
+        """
+        clock.section = section
+        clock.restart()
+        written = self._writer.bytes_written if self._writer is not None else None
+        if field is not None:
+            self._place_field(field, setup, section, geometry)
+        else:
+            self._add_section_geometry(setup, geometry)
+
+        if observer is not None:
+            if geometry is None:
+                structures, vertices = self._field_cells[field][1], 0
+            else:
+                structures, vertices = _geometry_counts(geometry)
+            clock.mark('emit',
+                       structures=structures,
+                       vertices=vertices,
+                       bytes=self._writer.bytes_written - written if written is not None else None)
+
+    def generate_setups(self,filename=DEFAULT_FILENAME, stream=False, workers=None, observer=None,
+                        cancel=None, file_format=GDS, memory_budget=None, mask_cache=None):
+        """Creates every setup in the file.
 
+        Args:
+            filename: name of the file to be saved ommiting the extension.
+            stream: If True the file is opened before generating and every
+                    section is written to it as soon as it is generated, so
+                    only one section is kept in memory at a time. (default False)
+            workers: Number of processes used to build the sections. If None
+                     the sections are built in this process. (default None)
+            observer: Object notified of the time and counters of every
+                      phase of the generation, see the observers module.
+                      Nothing is measured if None. (default None)
+            cancel: threading.Event checked before every section, once it
+                    is set the generation stops and GenerationCancelled is
+                    raised. No file is left behind. (default None)
+            file_format: GDS or OASIS. OASIS files write the regular arrays
+                         of structures as repetitions. (default GDS)
+            memory_budget: Bytes of memory the generation can use. Sections
+                           are split in tiles that fit in it, and every tile
+                           is built and written to the file before the next
+                           one, so the memory does not grow with the size
+                           of the wafer or the number of structures. Implies
+                           stream and the sections are not cached. If None
+                           the sections are built whole. (default None)
+            mask_cache: maskcache.MaskCache the file is copied from when
+                        the same mask was generated before. Otherwise the
+                        sections found in it are loaded instead of built,
+                        and the file and the whole sections built are
+                        stored in it. (default None)
 
+        Raise:
+            ValueError: If the memory budget is too small for the processes.
+        """
+        self._check_format(file_format)
+        path = '{0}.{1}'.format(filename, file_format)
+        clock = observers.clock(observer is not None, observer)
+
+        max_vertices = None
+        if memory_budget is not None:
+            max_vertices = tile_vertices(memory_budget, workers + 1 if workers else 1)
+            stream = True
+
+        if mask_cache is not None:
+            mask_key = mask_cache.mask_key(self, file_format, max_vertices)
+            if mask_cache.get_mask(mask_key, path):
+                if observer is not None:
+                    clock.mark('write', bytes=os.path.getsize(path))
+                    observer.finish()
+                return
+
+        if stream:
+            writer = StreamWriter if file_format == self.GDS else OasisWriter
+            self._writer = writer(path,
+                                  self.cell_name,
+                                  unit=self.unit,
+                                  precision=self.precision)
+        complete = False
+        try:
+            # Every generation starts from an empty cell
+            self.cell.elements = []
+
+            self._create_main_shape()
+            self._create_margin_shape()
+            clock.mark('outline', structures=2, vertices=len(self.margin_points))
+
+            sections = sorted(self.setups.items())
+            fields = self._plan_fields(sections, max_vertices is not None)
+            plan = self._plan_sections(sections, fields, max_vertices, mask_cache, observer is not None)
+
+            with _section_builder(plan['missing'], workers, max_vertices is not None) as built:
+                section_cache = {}
+                for (section, setup), key in zip(sections, plan['keys']):
+                    field = fields.get(section)
+                    for _ in range(len(plan['tiles'].get(key, [None]))):
+                        if cancel is not None and cancel.is_set():
+                            raise GenerationCancelled()
+
+                        # Sections of a field built before are a reference to it
+                        geometry = None
+                        if field is None or field not in self._field_cells:
+                            geometry = self._section_geometry(key, plan, built, mask_cache, observer)
+
+                            # Tiled generations do not keep any section, they
+                            # would not fit in the budget.
+                            if self.cache and max_vertices is None:
+                                section_cache[key] = geometry
+
+                        self._emit_section(section, setup, field, geometry, clock, observer)
+
+                # Only the sections of this generation are kept
+                self._section_cache = section_cache
+
+            clock.section = None
+            clock.restart()
+            complete = True
+        finally:
+            if stream:
+                self._writer.close()
+                written = self._writer.bytes_written
+                self._writer = None
+
+                # A file with only some of the sections is not kept
+                if not complete:
+                    os.remove(path)
+
+        if not stream:
+            self.write(filename, file_format)
+            written = os.path.getsize(path) if observer is not None else None
+
+        if mask_cache is not None:
+            mask_cache.put_mask(mask_key, path)
+
+        if observer is not None:
+            clock.mark('write', bytes=written)
+            observer.finish()
+
+
+def build_section(spec):
+    """Builds the geometry of one section.
+
+    This function does not depend on any Wafer or gdspy object, it receives
+    and returns plain values and arrays so sections can be built in worker
+    processes.
+
+    Args:
+        spec: dictionary created by Wafer._section_spec. If it has the
+              'columns' and 'rows' slices set by split_section, only that
+              tile of the lattice is built.
+
+    Returns:
+        Dictionary with the geometry of the section:
+            arrays: (K,5) array with the columns, rows, pitch and origin of
+                    each array of pillars.
+            inside: PolygonBatch with the structures completely inside the
+                    margin.
+            clipped: PolygonBatch with the structures fitted in the margin
+                     area.
+            structures: number of structures of the section, the ones
+                        inside the margin or crossing it before they are
+                        fitted, and the ones placed by the arrays counted
+                        one by one. estimate.estimate counts the same.
+            phases: events of the phases of the section if spec['timed']
+                    is set, see the observers module.
+    """
+    distance = spec['distance']
+    radius = spec['radius']
+    structure = spec['structure']
+    area = (spec['x'], spec['y'], spec['width'], spec['height'])
+    margin_area = spec['margin_area']
+    clock = observers.clock(spec.get('timed'), section=spec.get('section'))
+
+    outline = (spec['tolerance'], spec['circle_points'])
+    columns = spec.get('columns')
+    rows = spec.get('rows')
+
+    arrays = numpy.empty((0, 5))
+    codes = None
+    if structure == Wafer.PILLARS and spec['hierarchical']:
+        arrays, vertices = _pillar_arrays(margin_area, distance, radius, area, outline, columns, rows)
+
+    elif structure == Wafer.PILLARS:
+        # Classified as circles, like the pillars of the arrays and the
+        # ones counted by the estimate
+        centers = Pillar.generate_pilars_centers(distance, radius, *area, columns=columns, rows=rows)
+        codes = margin_area.classify_circles(centers[:, 0], centers[:, 1], radius)
+        vertices = Pillar.translate_pilar_template(radius, centers, *outline)
+
+    elif structure == Wafer.GRID and spec['split_grid'] and spec['hierarchical']:
+        arrays, vertices = _grid_arrays(margin_area, distance, radius, area, columns, rows)
+
+    elif structure == Wafer.GRID and spec['split_grid']:
+        vertices = numpy.concatenate(Grid.generate_grid_pieces(distance, radius, *area, walls_x=columns, walls_y=rows))
+
+    else:
+        horizontal, vertical = Grid.generate_grid_walls(distance, radius, *area, walls_x=columns, walls_y=rows)
+        if structure == Wafer.GRID:
+            vertices = numpy.concatenate((horizontal, vertical))
+
+        elif structure == Wafer.LINES_H:
+            vertices = vertical
+
+        elif structure == Wafer.LINES_V:
+            vertices = horizontal
 
+        else:
+            raise ValueError("The structure has to be one of {0}".format(Wafer.STRUCTURES))
+
+    # Every reference of an array places all the polygons of its cell
+    cell_polygons = 1
+    if structure == Wafer.GRID and len(arrays):
+        cell_polygons = len(Grid.generate_grid_cell(distance, radius))
+    referenced = int(numpy.sum(arrays[:, 0] * arrays[:, 1])) * cell_polygons
+
+    polygons = PolygonBatch.from_vertices(vertices, spec['layer'])
+    clock.mark('positions', structures=len(polygons) + referenced, vertices=len(polygons.points))
+
+    # The fitting the generated rectangular section in the Margin area.
+    # Only the structures crossing the margin go through the boolean
+    # operation, the ones inside are kept as they are.
+    if codes is None:
+        inside, boundary = margin_area.split(polygons)
+    else:
+        inside = polygons.filter(codes == MarginArea.INSIDE)
+        boundary = polygons.filter(codes == MarginArea.BOUNDARY)
+    clock.mark('classify', structures=len(inside), clipped=len(boundary))
+    clipped = len(boundary)
+    fitted = [PolygonBatch.empty()]
+
+    # Walls and lines are clipped in closed form, only the ones that
+    # can not be clipped that way go through the boolean operation.
+    if structure != Wafer.PILLARS and len(boundary):
+        rectangles, boundary = margin_area.clip_rectangles(boundary)
+        fitted.append(rectangles)
+
+    for (layer, datatype), boundary_polygons in boundary.get_polygons(by_spec=True).items():
+        merged = gdspy.fast_boolean(boundary_polygons, [spec['margin_points']], 'and', max_points=3000)
+        if merged is not None:
+            fitted.append(PolygonBatch.from_polygons(merged.polygons, layer, datatype))
+
+    fitted = PolygonBatch.concatenate(fitted)
+    clock.mark('clip', structures=len(fitted), vertices=len(fitted.points), clipped=clipped)
+
+    return {'arrays': arrays,
+            'inside': inside,
+            'clipped': fitted,
+            'structures': referenced + len(inside) + clipped,
+            'phases': list(clock.events)}
+
+
+def _geometry_counts(geometry):
+    """Returns the number of structures and vertices of the geometry of a section.
+
+    The structures placed by arrays of references are counted one by one,
+    see build_section, their vertices are the ones of the referenced cell
+    and are not counted.
+    """
+    structures = geometry['structures']
+    vertices = len(geometry['inside'].points) + len(geometry['clipped'].points)
+    return structures, vertices
+
+
+def tile_vertices(memory_budget, processes=1):
+    """Calculates how many vertices a tile can hold.
+
+    Args:
+        memory_budget: bytes of memory the whole generation can use.
+        processes: processes holding a tile at the same time.
+
+    Returns:
+        Largest number of vertices of a tile.
+
+    Raise:
+        ValueError: If the budget does not cover the memory of the processes.
+    """
+    available = memory_budget / float(processes) - PROCESS_MEMORY
+    if available < TILE_BYTES_PER_VERTEX:
+        raise ValueError("The memory budget has to be bigger than {0:.0f} MB".format(
+            processes * (PROCESS_MEMORY + TILE_BYTES_PER_VERTEX) / 2.0 ** 20))
+
+    return int(available // TILE_BYTES_PER_VERTEX)
+
+
+def split_section(spec, max_vertices):
+    """Splits the spec of a section in the specs of its tiles.
+
+    A tile is a block of the lattice of the section: a range of columns and
+    rows of pillars or grid cells, or a range of the walls along one axis. Structures are
+    never cut, every one belongs to exactly one tile, so the tiles together
+    give the structures of the whole section. Tiles take whole columns while
+    they fit, so they follow the order of the structures of the section.
+
+    Args:
+        spec: dictionary created by Wafer._section_spec.
+        max_vertices: largest number of vertices of a tile.
+
+    Returns:
+        List of specs with the 'columns' and 'rows' slices of the lattice of
+        every tile. A section that fits in one tile is returned as it is.
+    """
+    area = (spec['x'], spec['y'], spec['width'], spec['height'])
+    distance = spec['distance']
+    radius = spec['radius']
+    structure = spec['structure']
+
+    cells = structure == Wafer.GRID and spec['split_grid'] and spec['hierarchical']
+    if structure == Wafer.PILLARS or cells:
+        if cells:
+            columns, rows = Grid.generate_grid_lattice(distance, radius, *area)[3:]
+        else:
+            columns, rows = Pillar.generate_pilars_lattice(distance, radius, *area)[3:]
+
+        if spec['hierarchical']:
+            vertices = _HIERARCHICAL_VERTICES
+        else:
+            vertices = len(Pillar.generate_pilar_template(radius, spec['tolerance'], spec['circle_points']))
+
+        structures = max(max_vertices // vertices, 1)
+        tile_rows = max(min(rows, structures), 1)
+        tile_columns = max(structures // tile_rows, 1)
+        tiles = [(slice(column, column + tile_columns), slice(row, row + tile_rows))
+                 for column in range(0, columns, tile_columns)
+                 for row in range(0, rows, tile_rows)]
+    else:
+        walls_x, walls_y = Grid.generate_grid_lattice(distance, radius, *area)[3:]
+        if structure == Wafer.LINES_H:
+            walls_x = 0
+        elif structure == Wafer.LINES_V:
+            walls_y = 0
+
+        # Walls along x first, like in the whole section
+        walls = max(max_vertices // 4, 1)
+        tiles = [(slice(wall, wall + walls), slice(0, 0)) for wall in range(0, walls_x, walls)]
+        if structure == Wafer.GRID and spec['split_grid']:
+            # Walls along y are split in up to walls_x + 1 pieces
+            walls = max(max_vertices // (4 * (walls_x + 1)), 1)
+        tiles += [(slice(0, 0), slice(wall, wall + walls)) for wall in range(0, walls_y, walls)]
+
+    if len(tiles) <= 1:
+        return [spec]
+
+    specs = []
+    for columns, rows in tiles:
+        tile = dict(spec)
+        tile['columns'] = columns
+        tile['rows'] = rows
+        specs.append(tile)
+    return specs
+
+
+@contextlib.contextmanager
+def _section_builder(specs, workers=None, tiled=False):
+    """Builds the specs of the sections in order, in a pool of processes if there are workers.
+
+    Sections are built in parallel but yielded in order, so the file is the
+    same as the one generated serially. Tiled sections are built at most
+    one per worker ahead of the one being added, so they fit in the memory
+    budget. The pool is terminated if the generation fails or is cancelled.
+
+    Yields:
+        Iterator of the geometries returned by build_section.
+    """
+    if not workers or not specs:
+        yield (build_section(spec) for spec in specs)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        if tiled:
+            yield _build_in_order(pool, specs, workers)
+        else:
+            yield pool.imap(build_section, specs)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _build_in_order(pool, specs, window):
+    """Builds the specs in a pool and yields the geometries in order.
+
+    Unlike pool.imap, at most window specs are built ahead of the one
+    being consumed, so the geometries waiting do not pile up in memory.
+    """
+    pending = collections.deque()
+    for spec in specs:
+        pending.append(pool.apply_async(build_section, (spec,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def _pillar_arrays(margin_area, distance, radius, area, outline, tile_columns=None, tile_rows=None):
+    """Splits the pillars of a section in arrays of references and edge pillars.
+
+    Every row of the lattice is split in the pillars that are completely
+    inside the margin, the ones completely outside and the ones crossing it.
+    Consecutive rows with the same inside run are written as one array.
+
+    Args:
+        margin_area: MarginArea the pillars are classified against.
+        distance: distance between the centers of the pillars.
+        radius: radius of the pillars.
+        area: (x, y, width, height) of the section.
+        outline: (tolerance, points) of the pillar outline.
+        tile_columns: slice of the columns of the lattice. (default all)
+        tile_rows: slice of the rows of the lattice. (default all)
+
+    Returns:
+        (arrays, polygons): (K,5) array with the columns, rows, pitch and
+            origin of each array, and the pillars crossing the margin as
+            polygons that still need to be fitted in the margin area.
+    """
+    start_x, start_y, pitch, columns, rows = Pillar.generate_pilars_lattice(distance, radius, *area)
+
+    xs = start_x + numpy.arange(columns)[tile_columns or slice(None)] * pitch
+    ys = start_y - numpy.arange(rows)[tile_rows or slice(None)] * pitch
+    columns, rows = len(xs), len(ys)
+    if columns == 0 or rows == 0:
+        return numpy.empty((0, 5)), []
+
+    # (rows, columns) grid with the class of every pillar
+    classes = margin_area.classify_circles(xs[numpy.newaxis, :], ys[:, numpy.newaxis], radius)
+
+    boundary_rows, boundary_cols = numpy.nonzero(classes == MarginArea.BOUNDARY)
+    polygons = Pillar.translate_pilar_template(radius,
+                                               numpy.column_stack((xs[boundary_cols], ys[boundary_rows])),
+                                               *outline)
+
+    return _inside_arrays(classes == MarginArea.INSIDE, xs, ys, pitch), polygons
+
+
+def _grid_arrays(margin_area, distance, thickness, area, tile_columns=None, tile_rows=None):
+    """Splits a grid in arrays of references to its unit cell and edge walls.
+
+    The cells are classified like the pillars in _pillar_arrays. The cells
+    crossing the margin and the ends of the walls outside of the cells are
+    returned as rectangles, see grid.generate_grid_cell.
+
+    Args:
+        margin_area: MarginArea the cells are classified against.
+        distance: distance between the walls.
+        thickness: thickness of the walls.
+        area: (x, y, width, height) of the section.
+        tile_columns: slice of the columns of cells. (default all)
+        tile_rows: slice of the rows of cells. (default all)
+
+    Returns:
+        (arrays, rectangles): (K,5) array with the columns, rows, pitch and
+            origin of each array, and (N,4,2) array with the rectangles
+            that still need to be fitted in the margin area.
+    """
+    start_x, start_y, pitch, columns, rows = Grid.generate_grid_lattice(distance, thickness, *area)
+    if columns == 0 or rows == 0:
+        # Walls along one axis only, they do not cross
+        return numpy.empty((0, 5)), numpy.concatenate(Grid.generate_grid_walls(distance, thickness, *area))
+
+    xs = start_x + numpy.arange(columns)[tile_columns or slice(None)] * pitch
+    ys = start_y - numpy.arange(rows)[tile_rows or slice(None)] * pitch
+    edges = Grid.generate_grid_edges(distance, thickness, *area, walls_x=tile_columns, walls_y=tile_rows)
+    if len(xs) == 0 or len(ys) == 0:
+        return numpy.empty((0, 5)), edges
+
+    # (rows, columns) grid with the class of every cell
+    classes = margin_area.classify_boxes(xs[numpy.newaxis, :], xs[numpy.newaxis, :] + pitch,
+                                         ys[:, numpy.newaxis] - pitch, ys[:, numpy.newaxis])
+
+    boundary_rows, boundary_cols = numpy.nonzero(classes == MarginArea.BOUNDARY)
+    cell = Grid.generate_grid_cell(distance, thickness)
+    origins = numpy.column_stack((xs[boundary_cols], ys[boundary_rows]))
+    rectangles = (cell[numpy.newaxis, :, :, :] + origins[:, numpy.newaxis, numpy.newaxis, :]).reshape(-1, 4, 2)
+
+    return _inside_arrays(classes == MarginArea.INSIDE, xs, ys, pitch), numpy.concatenate((rectangles, edges))
+
+
+def _inside_arrays(inside, xs, ys, pitch):
+    """Groups the structures inside the margin in arrays of references.
+
+    Every row of structures inside the margin is a contiguous range of
+    columns, the margin area is convex. Consecutive rows with the same
+    range are written as one array.
+
+    Args:
+        inside: (rows, columns) mask of the structures inside the margin.
+        xs, ys: coordinates of the columns and rows of the lattice.
+        pitch: distance between the structures.
+
+    Returns:
+        (K,5) array with the columns, rows, pitch and origin of each array.
+    """
+    rows, columns = inside.shape
+
+    # Inside runs of each row
+    has_inside = inside.any(axis=1)
+    first_cols = numpy.argmax(inside, axis=1)
+    last_cols = columns - 1 - numpy.argmax(inside[:, ::-1], axis=1)
+    runs = [(first_cols[row], last_cols[row]) if has_inside[row] else None for row in range(rows)]
+
+    arrays = []
+    first_row = 0
+    for row in range(1, rows + 1):
+        if row < rows and runs[row] == runs[first_row]:
+            continue
+
+        if runs[first_row] is not None:
+            first_col, last_col = runs[first_row]
+            # Arrays grow up and to the right from the bottom left structure
+            arrays.append((last_col - first_col + 1,
+                           row - first_row,
+                           pitch,
+                           xs[first_col],
+                           ys[row - 1]))
+        first_row = row
+
+    return numpy.array(arrays, dtype=float).reshape(-1, 5)